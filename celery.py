@@ -1,5 +1,6 @@
 import os
 from celery import Celery
+from celery.schedules import crontab
 from decouple import config
 
 # Set the default Django settings module for the 'celery' program.
@@ -16,6 +17,23 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 # Load task modules from all registered Django apps.
 app.autodiscover_tasks()
 
+# Periodic tasks. Kept here rather than in settings so that web workers,
+# which load settings but never schedule tasks, do not import celery.
+app.conf.beat_schedule = {
+    'detect-anomalies-hourly': {
+        'task': 'ip_tracking.tasks.detect_anomalies',
+        'schedule': crontab(minute=0),  # Run every hour at minute 0
+    },
+    'cleanup-expired-blocks': {
+        'task': 'ip_tracking.tasks.cleanup_expired_blocks',
+        'schedule': crontab(minute='*/10'),  # Drop expired temporary blocks
+    },
+    'export-edge-blocklist': {
+        'task': 'ip_tracking.tasks.export_edge_blocklist',
+        'schedule': crontab(minute='*'),  # nginx/ipset/nftables files for the edge
+    },
+}
+
 # Configure Celery to use RabbitMQ as broker in production
 # This is automatically picked up from settings CELERY_BROKER_URL
 
@@ -0,0 +1,72 @@
+"""
+gunicorn configuration, read from the working directory by default.
+
+Command-line options (bind address, workers) still come from the start
+command; this file sets the worker class and adds the worker hooks.
+"""
+
+# Not `from decouple import config`: gunicorn reads every module-level name
+# as a setting, and `config` is one
+import decouple
+
+# Threaded workers: a live feed stream or long-poll (ip_tracking/feed.py)
+# holds one thread for up to IP_TRACKING_FEED_MAX_STREAM_SECONDS (300s)
+# instead of a whole sync worker. With gthread, `timeout` is how long the
+# worker's main loop may stay silent, not a limit on request duration, so
+# long streams do not trip WORKER TIMEOUT; with sync workers it would kill
+# every stream after 30s. Keep IP_TRACKING_FEED_MAX_WATCHERS below
+# `threads` so that streams cannot take every thread.
+worker_class = decouple.config('GUNICORN_WORKER_CLASS', default='gthread')
+threads = decouple.config('GUNICORN_THREADS', default=16, cast=int)
+timeout = decouple.config('GUNICORN_TIMEOUT', default=30, cast=int)
+
+
+def on_starting(server):
+    """Warn when the start command overrides the threaded worker class"""
+    if server.cfg.worker_class_str == 'sync' and server.cfg.threads <= 1:
+        server.log.warning(
+            'Sync workers: live feed streams and long-polls will hit the worker '
+            'timeout and tie up whole workers; use GUNICORN_WORKER_CLASS=gthread'
+        )
+
+
+def post_worker_init(worker):
+    """
+    Runs in each worker after the application is loaded and before it
+    accepts connections: load the URLconf, the blocklist and the hot
+    geolocation entries (see ip_tracking.startup). Disabled with
+    WARM_UP=False.
+    """
+    from ip_tracking.startup import warm_up
+
+    warm_up()
+
+
+def worker_exit(server, worker):
+    """
+    Write the blocked IP hits (see ip_tracking.hits) and the metrics this
+    worker has not flushed yet
+    """
+    from ip_tracking.hits import flush_hits
+    from ip_tracking.metrics import flush_metrics
+
+    flush_hits()
+    flush_metrics()
+
+
+def child_exit(server, worker):
+    """
+    Runs in the master after a worker exits, however it exited: fold its
+    metrics snapshot into the aggregate before its pid can be reused (see
+    ip_tracking.metrics)
+    """
+    import os
+
+    # The master does not load the application; settings as in wsgi.py
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings_prod')
+    from ip_tracking.metrics import mark_process_dead
+
+    try:
+        mark_process_dead(worker.pid)
+    except Exception as e:
+        server.log.warning(f'Failed to fold the metrics of worker {worker.pid}: {e}')
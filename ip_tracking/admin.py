@@ -1,13 +1,29 @@
 from django.contrib import admin
+from .changelist import (
+    CityFilter, CountryFilter, EstimatedCountPaginator, IPAddressFilter, PathCategoryFilter,
+    TimeWindowFilter,
+)
 from .models import RequestLog, BlockedIP, SuspiciousIP
+from .search import IndexedSearchAdminMixin
 
 
 @admin.register(RequestLog)
-class RequestLogAdmin(admin.ModelAdmin):
-    list_display = ('ip_address', 'path', 'country', 'city', 'timestamp')
-    list_filter = ('timestamp', 'ip_address', 'country', 'city')
+class RequestLogAdmin(IndexedSearchAdminMixin, admin.ModelAdmin):
+    """
+    Built for tables with millions of rows: recent rows only by default,
+    estimated counts, no facet counts and text filters instead of
+    SELECT DISTINCT choice lists (see ip_tracking/changelist.py). Search
+    uses the IP and trigram indexes (see ip_tracking/search.py).
+    """
+    list_display = ('ip_address', 'path', 'path_category', 'country', 'city', 'timestamp')
+    list_filter = (TimeWindowFilter, PathCategoryFilter, IPAddressFilter, CountryFilter, CityFilter)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    # Facet counts exist from Django 5.0 on; requirements allow 4.2
+    if hasattr(admin, 'ShowFacets'):
+        show_facets = admin.ShowFacets.NEVER
     search_fields = ('ip_address', 'path', 'country', 'city')
-    readonly_fields = ('ip_address', 'timestamp', 'path', 'country', 'city')
+    readonly_fields = ('ip_address', 'timestamp', 'path', 'path_category', 'country', 'city')
     
     def has_add_permission(self, request):
         # Prevent manual addition through admin
@@ -19,19 +35,19 @@ class RequestLogAdmin(admin.ModelAdmin):
 
 
 @admin.register(BlockedIP)
-class BlockedIPAdmin(admin.ModelAdmin):
-    list_display = ('ip_address', 'reason', 'blocked_at')
-    list_filter = ('blocked_at',)
+class BlockedIPAdmin(IndexedSearchAdminMixin, admin.ModelAdmin):
+    list_display = ('ip_address', 'prefix_length', 'reason', 'blocked_at', 'expires_at', 'hit_count', 'last_hit_at')
+    list_filter = ('blocked_at', 'expires_at', 'last_hit_at')
     search_fields = ('ip_address', 'reason')
-    readonly_fields = ('blocked_at',)
+    readonly_fields = ('blocked_at', 'hit_count', 'last_hit_at')
 
 
 @admin.register(SuspiciousIP)
-class SuspiciousIPAdmin(admin.ModelAdmin):
-    list_display = ('ip_address', 'reason_short', 'flagged_at', 'resolved')
-    list_filter = ('flagged_at', 'resolved')
+class SuspiciousIPAdmin(IndexedSearchAdminMixin, admin.ModelAdmin):
+    list_display = ('ip_address', 'category', 'reason_short', 'hit_count', 'flagged_at', 'last_seen', 'resolved')
+    list_filter = ('flagged_at', 'category', 'resolved')
     search_fields = ('ip_address', 'reason')
-    readonly_fields = ('ip_address', 'reason', 'flagged_at')
+    readonly_fields = ('ip_address', 'category', 'reason', 'hit_count', 'flagged_at', 'last_seen')
     list_editable = ('resolved',)
     
     def reason_short(self, obj):
@@ -14,4 +14,6 @@ router.register(r'suspicious-ips', api_views.SuspiciousIPViewSet, basename='susp
 urlpatterns = [
     path('', include(router.urls)),
     path('stats/', api_views.StatisticsAPIView.as_view(), name='stats'),
+    path('live/', api_views.LiveFeedAPIView.as_view(), name='live-feed'),
+    path('live/stream/', api_views.LiveFeedStreamAPIView.as_view(), name='live-stream'),
 ]
@@ -2,25 +2,40 @@
 API Views and Serializers for IP Tracking Application.
 """
 
+import ipaddress
+import json
+
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
+from rest_framework.renderers import BaseRenderer, JSONRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView
+from django.conf import settings
+from django.http import StreamingHttpResponse
 from django.utils import timezone
 from datetime import timedelta
-from django.db.models import Count
+from django.db.models import Count, Q, Sum
 from drf_spectacular.utils import extend_schema, OpenApiParameter, OpenApiResponse
+from . import feed
+from .blocklist import get_blocklist
+from .search import IndexedSearchFilter
 from .models import RequestLog, BlockedIP, SuspiciousIP
+from .routers import ReplicaReadMixin
+from .utils import normalize_ip
 from .serializers import (
     RequestLogSerializer,
     BlockedIPSerializer,
+    BlocklistBatchCheckSerializer,
+    BlocklistBatchResultSerializer,
     SuspiciousIPSerializer,
     StatisticsSerializer,
+    LiveFeedQuerySerializer,
+    LiveFeedSerializer,
 )
 
 
 @extend_schema(tags=['Request Logs'])
-class RequestLogViewSet(viewsets.ReadOnlyModelViewSet):
+class RequestLogViewSet(ReplicaReadMixin, viewsets.ReadOnlyModelViewSet):
     """
     ViewSet for viewing request logs.
     Provides list and detail views of all logged requests with geolocation data.
@@ -28,7 +43,8 @@ class RequestLogViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = RequestLog.objects.all().order_by('-timestamp')
     serializer_class = RequestLogSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
-    filterset_fields = ['ip_address', 'country', 'city']
+    filterset_fields = ['ip_address', 'country', 'city', 'path_category']
+    filter_backends = [IndexedSearchFilter]
     search_fields = ['ip_address', 'path', 'country', 'city']
     
     @extend_schema(
@@ -64,6 +80,7 @@ class BlockedIPViewSet(viewsets.ModelViewSet):
     serializer_class = BlockedIPSerializer
     permission_classes = [permissions.IsAuthenticated]
     filterset_fields = ['ip_address']
+    filter_backends = [IndexedSearchFilter]
     search_fields = ['ip_address', 'reason']
     
     @extend_schema(
@@ -79,10 +96,19 @@ class BlockedIPViewSet(viewsets.ModelViewSet):
     )
     @action(detail=False, methods=['get'], url_path='check/(?P<ip>[^/.]+)')
     def check_blocked(self, request, ip=None):
-        """Check if a specific IP is blocked"""
-        is_blocked = self.queryset.filter(ip_address=ip).exists()
-        if is_blocked:
-            blocked_ip = self.queryset.get(ip_address=ip)
+        """Check if a specific IP is blocked, on its own or by a network block"""
+        blocked_ip = self.queryset.filter(ip_address=ip).first()
+        normalized = normalize_ip(ip)
+        if blocked_ip is None and normalized is not None:
+            address = ipaddress.ip_address(normalized)
+            blocked_ip = next(
+                (
+                    block for block in self.queryset.filter(prefix_length__isnull=False)
+                    if address in ipaddress.ip_network(block.network, strict=False)
+                ),
+                None,
+            )
+        if blocked_ip is not None:
             serializer = self.get_serializer(blocked_ip)
             return Response({
                 'blocked': True,
@@ -90,16 +116,45 @@ class BlockedIPViewSet(viewsets.ModelViewSet):
             })
         return Response({'blocked': False})
 
+    @extend_schema(
+        description=(
+            "Check many IP addresses at once against the in-memory blocklist "
+            "(no database query). Returns the blocked ones, as submitted."
+        ),
+        request=BlocklistBatchCheckSerializer,
+        responses=BlocklistBatchResultSerializer,
+    )
+    @action(detail=False, methods=['post'], url_path='check-batch')
+    def check_batch(self, request):
+        """Check a batch of IPs in one pass over the blocklist"""
+        serializer = BlocklistBatchCheckSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        submitted = {}
+        invalid = []
+        for value in serializer.validated_data['ips']:
+            ip_address = normalize_ip(value)
+            if ip_address is None:
+                invalid.append(value)
+            else:
+                submitted.setdefault(ip_address, value)
+        blocked = get_blocklist().blocked_among(submitted)
+        return Response({
+            'blocked': [submitted[ip_address] for ip_address in blocked],
+            'invalid': invalid,
+            'checked': len(submitted),
+        })
+
 
 @extend_schema(tags=['Suspicious IPs'])
-class SuspiciousIPViewSet(viewsets.ModelViewSet):
+class SuspiciousIPViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
     """
     ViewSet for managing suspicious IP addresses flagged by anomaly detection.
     """
     queryset = SuspiciousIP.objects.all().order_by('-flagged_at')
     serializer_class = SuspiciousIPSerializer
     permission_classes = [permissions.IsAuthenticated]
-    filterset_fields = ['ip_address', 'resolved']
+    filterset_fields = ['ip_address', 'category', 'resolved']
+    filter_backends = [IndexedSearchFilter]
     search_fields = ['ip_address', 'reason']
     
     @extend_schema(description="Mark a suspicious IP as resolved")
@@ -126,7 +181,7 @@ class SuspiciousIPViewSet(viewsets.ModelViewSet):
 
 
 @extend_schema(tags=['Statistics'])
-class StatisticsAPIView(APIView):
+class StatisticsAPIView(ReplicaReadMixin, APIView):
     """
     API view for getting statistics about IP tracking.
     """
@@ -142,26 +197,37 @@ class StatisticsAPIView(APIView):
         last_hour = now - timedelta(hours=1)
         last_day = now - timedelta(days=1)
         
+        # Sampled rows carry a weight, so request volumes are sums, not counts.
+        # Conditional aggregates keep this to one query per table.
+        requests = RequestLog.objects.aggregate(
+            total=Sum('weight'),
+            last_hour=Sum('weight', filter=Q(timestamp__gte=last_hour)),
+            last_day=Sum('weight', filter=Q(timestamp__gte=last_day)),
+            unique_ips=Count('ip_address', distinct=True),
+            unique_ips_last_day=Count('ip_address', distinct=True, filter=Q(timestamp__gte=last_day)),
+        )
+        suspicious = SuspiciousIP.objects.aggregate(
+            total=Count('id'),
+            unresolved=Count('id', filter=Q(resolved=False)),
+        )
         stats = {
-            'total_requests': RequestLog.objects.count(),
-            'requests_last_hour': RequestLog.objects.filter(timestamp__gte=last_hour).count(),
-            'requests_last_day': RequestLog.objects.filter(timestamp__gte=last_day).count(),
-            'unique_ips_total': RequestLog.objects.values('ip_address').distinct().count(),
-            'unique_ips_last_day': RequestLog.objects.filter(
-                timestamp__gte=last_day
-            ).values('ip_address').distinct().count(),
+            'total_requests': requests['total'] or 0,
+            'requests_last_hour': requests['last_hour'] or 0,
+            'requests_last_day': requests['last_day'] or 0,
+            'unique_ips_total': requests['unique_ips'],
+            'unique_ips_last_day': requests['unique_ips_last_day'],
             'blocked_ips_count': BlockedIP.objects.count(),
-            'suspicious_ips_total': SuspiciousIP.objects.count(),
-            'suspicious_ips_unresolved': SuspiciousIP.objects.filter(resolved=False).count(),
+            'suspicious_ips_total': suspicious['total'],
+            'suspicious_ips_unresolved': suspicious['unresolved'],
             'top_countries': list(
                 RequestLog.objects.exclude(country__isnull=True)
                 .values('country')
-                .annotate(count=Count('id'))
+                .annotate(count=Sum('weight'))
                 .order_by('-count')[:10]
             ),
             'top_paths': list(
                 RequestLog.objects.values('path')
-                .annotate(count=Count('id'))
+                .annotate(count=Sum('weight'))
                 .order_by('-count')[:10]
             ),
             'timestamp': now.isoformat(),
@@ -170,3 +236,122 @@ class StatisticsAPIView(APIView):
         serializer = StatisticsSerializer(data=stats)
         serializer.is_valid()
         return Response(serializer.data)
+
+
+def _feed_filter(params):
+    return feed.FeedFilter(
+        ip_address=params.get('ip'),
+        path_prefix=params.get('path_prefix'),
+        country=params.get('country'),
+    )
+
+
+def _feed_busy(hub):
+    """
+    503 response when this worker already serves IP_TRACKING_FEED_MAX_WATCHERS
+    watchers (default 8): each holds a thread, and the others must be left
+    for ordinary requests
+    """
+    limit = getattr(settings, 'IP_TRACKING_FEED_MAX_WATCHERS', 8)
+    if not limit or hub.watchers < limit:
+        return None
+    response = Response(
+        {'detail': 'Too many live feed watchers on this worker, retry shortly.'},
+        status=status.HTTP_503_SERVICE_UNAVAILABLE,
+    )
+    response['Retry-After'] = '5'
+    return response
+
+
+@extend_schema(tags=['Live Feed'])
+class LiveFeedAPIView(APIView):
+    """
+    Long-poll feed of logged requests, served from memory (see
+    `ip_tracking.feed`): waits up to `timeout` seconds for requests after
+    the cursor `after` that match the filters. Without `after`, starts
+    from now.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    @extend_schema(
+        description="Wait for newly logged requests matching the filters",
+        parameters=[LiveFeedQuerySerializer],
+        responses={
+            200: LiveFeedSerializer,
+            503: OpenApiResponse(description="Too many watchers on this worker"),
+        },
+    )
+    def get(self, request):
+        query = LiveFeedQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        params = query.validated_data
+        timeout = params.get('timeout', getattr(settings, 'IP_TRACKING_FEED_POLL_TIMEOUT', 25))
+        hub = feed.get_hub()
+        busy = _feed_busy(hub)
+        if busy is not None:
+            return busy
+        with hub.watch():
+            events, cursor, reset = hub.read(params.get('after'), _feed_filter(params), timeout, params['limit'])
+        return Response({
+            'events': [event for _, event in events],
+            'cursor': cursor,
+            'reset': reset,
+        })
+
+
+class EventStreamRenderer(BaseRenderer):
+    """text/event-stream; only errors are rendered, the stream itself is not"""
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return f'event: error\ndata: {json.dumps(data)}\n\n'.encode()
+
+
+@extend_schema(tags=['Live Feed'])
+class LiveFeedStreamAPIView(APIView):
+    """
+    Server-Sent Events feed of logged requests matching the filters. Sends
+    a heartbeat comment every `IP_TRACKING_FEED_HEARTBEAT` seconds
+    (default 15) and closes after `IP_TRACKING_FEED_MAX_STREAM_SECONDS`
+    (default 300); EventSource then reconnects with `Last-Event-ID` and
+    resumes. Each open stream holds a worker thread, so gunicorn must run
+    threaded workers (see gunicorn.conf.py).
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    renderer_classes = [EventStreamRenderer, JSONRenderer]
+
+    @extend_schema(
+        description="Stream newly logged requests matching the filters as Server-Sent Events",
+        parameters=[LiveFeedQuerySerializer],
+        responses={
+            200: OpenApiResponse(description="text/event-stream of `request` events"),
+            503: OpenApiResponse(description="Too many watchers on this worker"),
+        },
+    )
+    def get(self, request):
+        query = LiveFeedQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        params = query.validated_data
+        after = params.get('after')
+        last_event_id = request.headers.get('Last-Event-ID')
+        if last_event_id and feed.parse_event_id(last_event_id) is not None:
+            after = last_event_id
+        hub = feed.get_hub()
+        busy = _feed_busy(hub)
+        if busy is not None:
+            return busy
+        response = StreamingHttpResponse(
+            feed.stream(
+                hub,
+                after,
+                _feed_filter(params),
+                heartbeat=getattr(settings, 'IP_TRACKING_FEED_HEARTBEAT', 15),
+                max_seconds=getattr(settings, 'IP_TRACKING_FEED_MAX_STREAM_SECONDS', 300),
+            ),
+            content_type='text/event-stream',
+        )
+        response['Cache-Control'] = 'no-cache'
+        # Tell nginx not to buffer the stream
+        response['X-Accel-Buffering'] = 'no'
+        return response
@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class IpTrackingConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'ip_tracking'
+
+    def ready(self):
+        from django.db.models.signals import post_migrate
+
+        # Register signal handlers
+        from . import signals
+
+        post_migrate.connect(signals.create_search_indexes, sender=self)
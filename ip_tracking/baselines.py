@@ -0,0 +1,286 @@
+"""
+Rolling per-IP and per-subnet baselines for anomaly detection.
+
+For every key (an IP, or its /24 or /48 subnet) a fixed-size record keeps
+exponentially weighted moving averages of two per-period metrics:
+
+- the request rate (weighted requests in the detection window);
+- the path entropy (Shannon entropy, in bits, of the paths requested;
+  scanners touching many distinct paths score high).
+
+Each run compares the window's values with the stored mean and variance
+(a z-score), flags outliers, then folds the new values in. Updates are
+O(1) per key seen in the window and vectorised across keys. Periods in
+which a key was not seen count as zero traffic; that decay is applied
+lazily the next time the key shows up.
+
+A record is 22 bytes (`RECORD`). Records live in a Django cache alias, so
+eviction is the cache's job: on Redis use a TTL (`timeout`) together with
+`maxmemory-policy allkeys-lru`. With `cache=None` they are kept in a
+bounded in-process LRU instead (`lru_size` keys), which is only
+consistent when detection runs in a single process.
+
+Used through the `baseline` rule type:
+
+    {'name': 'rate_baseline', 'type': 'baseline', 'min': 4.0,
+     'scope': 'ip', 'alpha': 0.1, 'min_samples': 24, 'min_rate': 50}
+    {'name': 'subnet_baseline', 'type': 'baseline', 'min': 4.0,
+     'scope': 'subnet'}
+
+`min` is the z-score threshold, applied to the rate and to the entropy.
+"""
+
+import struct
+from collections import OrderedDict
+
+import numpy as np
+from django.core.cache import caches
+
+from .rules import Rule, busiest_members, check_prefix, merge_busiest, register
+
+# period, samples, rate mean, rate variance, entropy mean, entropy variance
+RECORD = struct.Struct('<IHffff')
+FIELDS = ('period', 'samples', 'rate_mean', 'rate_var', 'entropy_mean', 'entropy_var')
+FIELD_TYPES = (np.int64, np.int64, np.float64, np.float64, np.float64, np.float64)
+
+# Absent periods decayed lazily, at most (one week of hours)
+MAX_DECAY_PERIODS = 168
+BATCH_SIZE = 1000
+
+
+class BaselineStore:
+    """Packed baseline records keyed by string, in a cache alias or an LRU"""
+
+    def __init__(self, prefix, cache='default', timeout=7 * 24 * 3600, lru_size=100_000):
+        self.prefix = prefix
+        self.cache = caches[cache] if cache else None
+        self.timeout = timeout
+        self.lru_size = lru_size
+        self.lru = OrderedDict()
+
+    def load(self, keys):
+        """Column arrays of the records for `keys` (zeros where missing)"""
+        packed = {}
+        if self.cache is None:
+            for key in keys:
+                record = self.lru.get(key)
+                if record is not None:
+                    self.lru.move_to_end(key)
+                    packed[key] = record
+        else:
+            for start in range(0, len(keys), BATCH_SIZE):
+                names = {f'{self.prefix}:{key}': key for key in keys[start:start + BATCH_SIZE]}
+                for name, record in self.cache.get_many(list(names)).items():
+                    packed[names[name]] = record
+
+        columns = [np.zeros(len(keys), dtype=dtype) for dtype in FIELD_TYPES]
+        for index, key in enumerate(keys):
+            record = packed.get(key)
+            if record is not None:
+                for column, value in zip(columns, RECORD.unpack(record)):
+                    column[index] = value
+        return dict(zip(FIELDS, columns))
+
+    def save(self, keys, state):
+        rows = zip(*(state[field].tolist() for field in FIELDS))
+        packed = {key: RECORD.pack(*row) for key, row in zip(keys, rows)}
+        if self.cache is None:
+            for key, record in packed.items():
+                self.lru[key] = record
+                self.lru.move_to_end(key)
+            while len(self.lru) > self.lru_size:
+                self.lru.popitem(last=False)
+            return
+        items = list(packed.items())
+        for start in range(0, len(items), BATCH_SIZE):
+            self.cache.set_many(
+                {f'{self.prefix}:{key}': record for key, record in items[start:start + BATCH_SIZE]},
+                self.timeout,
+            )
+
+
+def ewma_update(mean, var, value, alpha):
+    """Incremental exponentially weighted mean and variance"""
+    diff = value - mean
+    increment = alpha * diff
+    return mean + increment, (1 - alpha) * (var + diff * increment)
+
+
+def decay(state, period, alpha):
+    """Fold in zero observations for the periods each key was not seen"""
+    gaps = np.where(state['samples'] > 0, period - state['period'] - 1, 0)
+    gaps = np.clip(gaps, 0, MAX_DECAY_PERIODS)
+    for step in range(int(gaps.max(initial=0))):
+        absent = gaps > step
+        for metric in ('rate', 'entropy'):
+            mean, var = ewma_update(state[f'{metric}_mean'], state[f'{metric}_var'], 0.0, alpha)
+            state[f'{metric}_mean'] = np.where(absent, mean, state[f'{metric}_mean'])
+            state[f'{metric}_var'] = np.where(absent, var, state[f'{metric}_var'])
+        state['samples'] = np.where(absent, state['samples'] + 1, state['samples'])
+
+
+def weighted_entropy(owners, weights, groups):
+    """Weighted Shannon entropy (bits) per group of (owner, weight) entries"""
+    totals = np.bincount(owners, weights=weights, minlength=groups)
+    shares = weights / totals[owners]
+    return -np.bincount(owners, weights=shares * np.log2(shares), minlength=groups)
+
+
+def path_weights(window, group_codes, rows=slice(None)):
+    """
+    Weighted requests per (group, path) over the window's `rows`
+    (group_codes has one code per selected row). Returns the group codes,
+    path codes and weights of the pairs.
+    """
+    base = len(window.paths) or 1
+    pairs, inverse = np.unique(group_codes * base + window.path_codes[rows], return_inverse=True)
+    return pairs // base, pairs % base, np.bincount(inverse, weights=window.weights[rows])
+
+
+@register('baseline')
+class BaselineRule(Rule):
+    """
+    Flags IPs (or the busiest IPs of subnets) whose rate or path entropy
+    is a z-score outlier.
+
+    Every IP lives in one shard, so IP baselines are scored in
+    `evaluate()`. A subnet spreads over all shards: there `evaluate()`
+    returns {cidr: [period, requests, {path: requests}, [[ip, requests],
+    ...]]} with the subnet's `top_ips` busiest addresses, and the subnet is
+    scored once in `finalize()`, after the shards are combined. Its
+    record is then read and written by a single process per run.
+    """
+
+    title = 'Traffic far above its usual baseline'
+
+    def __init__(self, name, min=4.0, scope='ip', alpha=0.1, min_samples=24, min_rate=50,
+                 min_rate_std=5.0, min_entropy_std=0.25, period_seconds=3600,
+                 ipv4_prefix=24, ipv6_prefix=48, top_ips=20, cache='default', timeout=7 * 24 * 3600,
+                 lru_size=100_000, title=None):
+        super().__init__(name, min, title)
+        if scope not in ('ip', 'subnet'):
+            raise ValueError(f"Unknown baseline scope {scope!r}")
+        self.scope = scope
+        self.alpha = alpha
+        self.min_samples = min_samples
+        self.min_rate = min_rate
+        self.min_rate_std = min_rate_std
+        self.min_entropy_std = min_entropy_std
+        self.period_seconds = period_seconds
+        self.ipv4_prefix = ipv4_prefix
+        self.ipv6_prefix = ipv6_prefix
+        self.top_ips = top_ips
+        if scope == 'subnet':
+            check_prefix(4, ipv4_prefix)
+            check_prefix(6, ipv6_prefix)
+        self.store = BaselineStore(f'ip_tracking:baseline:{name}', cache, timeout, lru_size)
+
+    def evaluate(self, window):
+        if window.until is None:
+            return {}
+        period = int(window.until.timestamp() // self.period_seconds)
+
+        if self.scope == 'subnet':
+            return self.subnet_partials(window, period)
+
+        keys = window.ips
+        rates = window.ip_totals
+        owners, _, weights = path_weights(window, window.ip_codes)
+        entropies = weighted_entropy(owners, weights, len(keys))
+        return {keys[code]: hit for code, hit in self.score(period, keys, rates, entropies).items()}
+
+    def subnet_partials(self, window, period):
+        # One level per IP version, so every IP has exactly one subnet;
+        # clients that are not IP addresses have none and are left out
+        owners, subnet_codes, keys = window.networks([(4, self.ipv4_prefix), (6, self.ipv6_prefix)])
+        ip_subnets = np.full(len(window.ips), -1, dtype=np.int64)
+        ip_subnets[owners] = subnet_codes
+        group_codes = ip_subnets[window.ip_codes]
+        rows = group_codes >= 0
+        group_codes = group_codes[rows]
+
+        rates = np.bincount(group_codes, weights=window.weights[rows], minlength=len(keys))
+        paths = [{} for _ in keys]
+        for code, path, weight in zip(*(column.tolist() for column in path_weights(window, group_codes, rows))):
+            paths[code][window.paths[path]] = int(weight)
+        members = busiest_members(window, owners, subnet_codes, len(keys), self.top_ips)
+        return {
+            cidr: [period, int(rate), paths[code], members[code]]
+            for code, (cidr, rate) in enumerate(zip(keys, rates.tolist()))
+        }
+
+    def combine(self, merged, partial):
+        if self.scope == 'ip':
+            return super().combine(merged, partial)
+        for cidr, (period, rate, paths, members) in partial.items():
+            entry = merged.get(cidr)
+            if entry is None:
+                merged[cidr] = [period, rate, dict(paths), list(members)]
+                continue
+            entry[1] += rate
+            for path, weight in paths.items():
+                entry[2][path] = entry[2].get(path, 0) + weight
+            entry[3] = merge_busiest(entry[3], members, self.top_ips)
+
+    def finalize(self, merged):
+        if self.scope == 'ip' or not merged:
+            return super().finalize(merged)
+        keys = list(merged)
+        entries = list(merged.values())
+        period = max(entry[0] for entry in entries)
+        rates = np.array([entry[1] for entry in entries], dtype=np.float64)
+        owners = np.repeat(np.arange(len(keys)), [len(entry[2]) for entry in entries])
+        weights = np.fromiter(
+            (weight for entry in entries for weight in entry[2].values()), dtype=np.float64, count=len(owners)
+        )
+        entropies = weighted_entropy(owners, weights, len(keys))
+        # Flag the busiest IPs of an outlying subnet
+        return {
+            ip_address: hit
+            for code, hit in self.score(period, keys, rates, entropies).items()
+            for ip_address, _ in entries[code][3]
+        }
+
+    def score(self, period, keys, rates, entropies):
+        """
+        Score the window's `rates` and `entropies` of `keys` against their
+        baselines, then fold them in. Returns {key code: [score, detail]}
+        for the outliers.
+        """
+        state = self.store.load(keys)
+        decay(state, period, self.alpha)
+        baseline_rates = state['rate_mean'].copy()
+
+        rate_std = np.maximum(np.sqrt(state['rate_var']), self.min_rate_std)
+        entropy_std = np.maximum(np.sqrt(state['entropy_var']), self.min_entropy_std)
+        rate_z = (rates - state['rate_mean']) / rate_std
+        entropy_z = (entropies - state['entropy_mean']) / entropy_std
+        scores = np.maximum(rate_z, entropy_z)
+        # No verdict until a key has enough history, or for light traffic
+        scores[(state['samples'] < self.min_samples) | (rates < self.min_rate)] = 0
+
+        # A re-run for a period already folded in must not count it twice
+        fresh = state['period'] != period
+        for metric, values in (('rate', rates), ('entropy', entropies)):
+            mean, var = ewma_update(state[f'{metric}_mean'], state[f'{metric}_var'], values, self.alpha)
+            first = state['samples'] == 0
+            state[f'{metric}_mean'] = np.where(fresh, np.where(first, values, mean), state[f'{metric}_mean'])
+            state[f'{metric}_var'] = np.where(fresh, np.where(first, 0.0, var), state[f'{metric}_var'])
+        state['samples'] = np.where(fresh, np.minimum(state['samples'] + 1, 0xFFFF), state['samples'])
+        state['period'] = np.full(len(keys), period, dtype=np.int64)
+        self.store.save(keys, state)
+
+        return {
+            int(code): [
+                round(float(scores[code]), 2),
+                [keys[code], int(rates[code]), round(float(baseline_rates[code]), 1), round(float(entropies[code]), 2)],
+            ]
+            for code in np.flatnonzero(scores >= self.min)
+        }
+
+    def reason(self, value, detail):
+        key, rate, baseline, entropy = detail
+        return (
+            f"{self.title}: {key} made {rate} requests (baseline {baseline}, "
+            f"path entropy {entropy} bits), z-score {value}"
+        )
@@ -0,0 +1,392 @@
+"""
+Benchmark helpers for the IP tracking hot paths.
+
+Used by the `benchmark_ip_tracking` management command:
+
+- micro-benchmarks (pytest-benchmark style statistics) for `get_client_ip`,
+  the blocklist check, the geolocation lookup and the request log insert;
+- macro timings for `detect_anomalies` and `StatisticsAPIView`;
+- an in-process concurrent load generator that drives the WSGI app through
+  Django's test client and reports req/s, latency percentiles and queries
+  per request;
+- connection reuse: a fresh database connection and a fresh HTTP
+  connection per call against persistent ones;
+- dataset fixtures that seed `RequestLog` with N synthetic rows.
+
+Synthetic rows and simulated clients use the 198.18.0.0/15 benchmarking
+range (RFC 2544), so they never trigger geolocation API calls and can be
+removed with `cleanup_benchmark_data()`.
+"""
+
+import ipaddress
+import json
+import random
+import statistics
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from django.db import connection, connections
+from django.db.models import Max
+from django.test import Client, RequestFactory
+from django.utils import timezone
+
+from .models import BlockedIP, RequestLog, SuspiciousIP
+from .paths import PathClassifier
+from .utils import ip_bucket, ip_version_key
+
+BENCHMARK_NETWORK = ipaddress.ip_network('198.18.0.0/15')
+BENCHMARK_PREFIXES = ('198.18.', '198.19.')
+
+DATASET_SIZES = {
+    '10k': 10_000,
+    '100k': 100_000,
+    '1m': 1_000_000,
+    '10m': 10_000_000,
+}
+
+SAMPLE_PATHS = [
+    '/', '/api/stats/', '/api/request-logs/', '/api/blocked-ips/',
+    '/ip_tracking/login/', '/admin/', '/admin/login/', '/login/',
+    '/static/admin/css/base.css', '/swagger/',
+]
+
+# Load test clients live in 198.19.0.0/16, away from the seeded noisy IPs
+LOAD_CLIENT_OFFSET = 2 ** 16
+
+# Metrics where a higher value is better; everything else is a latency
+HIGHER_IS_BETTER = ('ops', 'requests_per_second')
+
+
+def benchmark_ip(index):
+    """Return the index-th address of the benchmarking range"""
+    return str(BENCHMARK_NETWORK[index % BENCHMARK_NETWORK.num_addresses])
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(durations):
+    """pytest-benchmark style statistics for a list of durations in seconds"""
+    ordered = sorted(durations)
+    mean = statistics.fmean(ordered)
+    return {
+        'rounds': len(ordered),
+        'min': ordered[0],
+        'max': ordered[-1],
+        'mean': mean,
+        'stddev': statistics.pstdev(ordered) if len(ordered) > 1 else 0.0,
+        'median': statistics.median(ordered),
+        'p99': percentile(ordered, 0.99),
+        'ops': 1 / mean if mean else 0.0,
+    }
+
+
+def micro_benchmark(func, rounds=1000, warmup=10):
+    """Time `func()` for `rounds` iterations after `warmup` untimed calls"""
+    for _ in range(warmup):
+        func()
+    durations = []
+    clock = time.perf_counter
+    for _ in range(rounds):
+        start = clock()
+        func()
+        durations.append(clock() - start)
+    return summarize(durations)
+
+
+class QueryCounter:
+    """`connection.execute_wrapper` callable counting queries and DB time"""
+
+    def __init__(self):
+        self.queries = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.queries += 1
+
+
+def run_micro_benchmarks(rounds=1000):
+    """Benchmark the per-request building blocks of IPTrackingMiddleware"""
+    from .blocklist import get_blocklist
+    from .middleware import IPTrackingMiddleware
+    from .utils import get_client_ip
+
+    factory = RequestFactory()
+    direct = factory.get('/', REMOTE_ADDR=benchmark_ip(1))
+    proxied = factory.get(
+        '/', REMOTE_ADDR='10.0.0.1',
+        HTTP_X_FORWARDED_FOR=f'{benchmark_ip(2)}, 10.0.0.2, 10.0.0.3',
+    )
+    middleware = IPTrackingMiddleware(lambda request: None)
+    blocklist = get_blocklist()
+    blocklist.maybe_refresh()
+    geo_ip = benchmark_ip(3)
+    middleware.get_geolocation(geo_ip)
+
+    counter = iter(range(10 ** 9))
+
+    def insert_log():
+        RequestLog.objects.create(
+            ip_address=benchmark_ip(next(counter)),
+            path='/',
+            country=None,
+            city=None,
+        )
+
+    return {
+        'get_client_ip.remote_addr': micro_benchmark(lambda: get_client_ip(direct), rounds),
+        'get_client_ip.x_forwarded_for': micro_benchmark(lambda: get_client_ip(proxied), rounds),
+        'blocklist.is_blocked': micro_benchmark(lambda: blocklist.is_blocked(geo_ip), rounds),
+        'geolocation.cached': micro_benchmark(lambda: middleware.get_geolocation(geo_ip), rounds),
+        'request_log.insert': micro_benchmark(insert_log, min(rounds, 500)),
+    }
+
+
+def detect_benchmark_anomalies():
+    """
+    One inline anomaly detection run, flags and escalation included, over
+    the synthetic rows of the last hour only. Real clients are neither
+    flagged nor blocked; the synthetic clients' flags and blocks are
+    removed by `cleanup_benchmark_data()`.
+    """
+    from . import detection
+    from .rules import Window, get_rule_set
+    from .search import ip_key_range
+
+    now = timezone.now()
+    since = now - timedelta(hours=1)
+    rows = RequestLog.objects.filter(ip_key_range(BENCHMARK_NETWORK), timestamp__gte=since, timestamp__lte=now)
+    rule_set = get_rule_set()
+    partial = rule_set.evaluate(Window.fetch(rows, until=now))
+    return detection.record(detection.merge([partial], rule_set), now, since, rule_set)
+
+
+def run_macro_benchmarks(rounds=5):
+    """Time anomaly detection and the statistics endpoint on the current data"""
+    from rest_framework.test import APIRequestFactory
+
+    from .api_views import StatisticsAPIView
+
+    stats_view = StatisticsAPIView.as_view()
+    factory = APIRequestFactory()
+    results = {}
+    for name, func in (
+        ('detect_anomalies', detect_benchmark_anomalies),
+        ('statistics_view', lambda: stats_view(factory.get('/api/stats/'))),
+    ):
+        query_counter = QueryCounter()
+        with connection.execute_wrapper(query_counter):
+            summary = micro_benchmark(func, rounds=rounds, warmup=1)
+        summary['queries_per_call'] = query_counter.queries / (rounds + 1)
+        results[name] = summary
+    return results
+
+
+class _GeoStubHandler(BaseHTTPRequestHandler):
+    """Local stand-in for the geolocation API, with HTTP/1.1 keep-alive"""
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; without this, Nagle plus
+    # delayed ACKs add ~40 ms to every keep-alive response
+    disable_nagle_algorithm = True
+    body = json.dumps({'status': 'success', 'country': 'Kenya', 'city': 'Nairobi'}).encode()
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_connection_benchmarks(rounds=200):
+    """
+    Per-call latency of opening a new database / HTTP connection versus
+    reusing a persistent one. The HTTP side talks to a local stub server,
+    so the difference is the TCP handshake and setup cost alone; against a
+    remote API the saving grows with the round-trip time.
+    """
+    from .http import HTTPPool
+
+    def new_db_connection():
+        connection.close()
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+
+    def persistent_db_connection():
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _GeoStubHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/json/198.18.0.1'
+    pool = HTTPPool(max_concurrency=1, pool_size=1, acquire_timeout=1, retries=0)
+    try:
+        results = {
+            'db.new_connection': micro_benchmark(new_db_connection, rounds),
+            'db.persistent_connection': micro_benchmark(persistent_db_connection, rounds),
+            'http.new_connection': micro_benchmark(lambda: requests.get(url, timeout=2), rounds),
+            'http.pooled_session': micro_benchmark(lambda: pool.get(url, timeout=2), rounds),
+        }
+    finally:
+        pool.close()
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+def seed_request_logs(rows, hours=24, batch_size=10_000, distinct_ips=5_000, stdout=None):
+    """
+    Insert `rows` synthetic RequestLog rows spread over the last `hours`.
+    A handful of IPs are made noisy so that detection has work to do.
+    """
+    rng = random.Random(rows)
+    now = timezone.now()
+    noisy = [benchmark_ip(i) for i in range(10)]
+    classifier = PathClassifier.from_settings()
+    first_id = RequestLog.objects.aggregate(last=Max('id'))['last'] or 0
+    created = 0
+    while created < rows:
+        batch = []
+        for _ in range(min(batch_size, rows - created)):
+            if rng.random() < 0.05:
+                ip_address = rng.choice(noisy)
+            else:
+                ip_address = benchmark_ip(rng.randrange(distinct_ips))
+            path = rng.choice(SAMPLE_PATHS)
+            ip_version, key = ip_version_key(ip_address)
+            batch.append(RequestLog(
+                ip_address=ip_address,
+                ip_bucket=ip_bucket(ip_address),
+                ip_version=ip_version,
+                ip_key=key,
+                path=path,
+                path_category=classifier.category_for(path),
+                country=rng.choice(('Kenya', 'Nigeria', 'Ghana', None)),
+                city=None,
+            ))
+        RequestLog.objects.bulk_create(batch, batch_size=batch_size)
+        created += len(batch)
+        if stdout is not None:
+            stdout.write(f'  seeded {created}/{rows} rows')
+
+    # auto_now_add stamps every row with "now"; spread them over the window
+    last_id = RequestLog.objects.aggregate(last=Max('id'))['last'] or 0
+    step = timedelta(hours=hours) / max(rows, 1)
+    for start in range(first_id, last_id, batch_size):
+        RequestLog.objects.filter(id__gt=start, id__lte=start + batch_size).update(
+            timestamp=now - step * (start - first_id)
+        )
+    return created
+
+
+def cleanup_benchmark_data():
+    """
+    Remove every row created by the benchmarks, including the flags and
+    blocks that detect_anomalies produced for the synthetic clients.
+    """
+    deleted = 0
+    for model in (RequestLog, SuspiciousIP, BlockedIP):
+        for prefix in BENCHMARK_PREFIXES:
+            deleted += model.objects.filter(ip_address__startswith=prefix).delete()[0]
+    return deleted
+
+
+def run_load_test(paths=None, total_requests=1000, concurrency=8, clients=256):
+    """
+    Drive the WSGI app with `concurrency` threads issuing `total_requests`
+    GET requests in total, round-robin over `paths`, from `clients`
+    simulated client IPs.
+    """
+    paths = paths or ['/api/stats/', '/api/request-logs/', '/ip_tracking/login/']
+    latencies = []
+    statuses = {}
+    query_total = [0]
+    lock = threading.Lock()
+    remaining = iter(range(total_requests))
+
+    def worker():
+        client = Client()
+        query_counter = QueryCounter()
+        local_latencies = []
+        local_statuses = {}
+        try:
+            with connection.execute_wrapper(query_counter):
+                for index in remaining:
+                    start = time.perf_counter()
+                    response = client.get(
+                        paths[index % len(paths)],
+                        REMOTE_ADDR=benchmark_ip(LOAD_CLIENT_OFFSET + index % clients),
+                    )
+                    local_latencies.append(time.perf_counter() - start)
+                    local_statuses[response.status_code] = local_statuses.get(response.status_code, 0) + 1
+        finally:
+            connections.close_all()
+        with lock:
+            latencies.extend(local_latencies)
+            query_total[0] += query_counter.queries
+            for status_code, count in local_statuses.items():
+                statuses[status_code] = statuses.get(status_code, 0) + count
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    ordered = sorted(latencies)
+    return {
+        'requests': len(ordered),
+        'concurrency': concurrency,
+        'elapsed': elapsed,
+        'requests_per_second': len(ordered) / elapsed if elapsed else 0.0,
+        'p50': percentile(ordered, 0.50),
+        'p90': percentile(ordered, 0.90),
+        'p99': percentile(ordered, 0.99),
+        'queries_per_request': query_total[0] / len(ordered) if ordered else 0.0,
+        'status_codes': {str(code): count for code, count in sorted(statuses.items())},
+    }
+
+
+def compare_results(current, baseline, threshold=0.10):
+    """
+    Compare two result documents section by section.
+
+    Returns a list of (name, metric, baseline, current, change) tuples for
+    every metric that got worse by more than `threshold` (a fraction).
+    """
+    regressions = []
+    for section in ('micro', 'macro', 'connections', 'load'):
+        for name, metrics in current.get(section, {}).items():
+            old_metrics = baseline.get(section, {}).get(name)
+            if not isinstance(metrics, dict) or not isinstance(old_metrics, dict):
+                continue
+            for metric in ('median', 'p99', 'p50', 'requests_per_second', 'queries_per_request', 'queries_per_call'):
+                new, old = metrics.get(metric), old_metrics.get(metric)
+                if not isinstance(new, (int, float)) or not old:
+                    continue
+                change = (new - old) / old
+                worse = -change if metric in HIGHER_IS_BETTER else change
+                if worse > threshold:
+                    regressions.append((f'{section}.{name}', metric, old, new, change))
+    return regressions
@@ -0,0 +1,345 @@
+"""
+Blocklist shared by all workers of a host through one memory-mapped file.
+
+With `IP_TRACKING_BLOCKLIST_BACKEND = 'shared'` the active blocks are
+compiled into an immutable file (`IP_TRACKING_BLOCKFILTER_PATH`, default
+BASE_DIR/blockfilter.bin) that every worker maps read-only, so the host
+keeps one copy of the list however many workers it runs:
+
+    header     magic, format, hash count, sequence, entry count, bloom size,
+               network count
+    bloom      bit array answering "certainly not blocked" for most clients
+    keys       sorted 16-byte addresses (IPv4 mapped into ::ffff:0:0/96)
+    expiries   uint32 POSIX time per key (0 for permanent blocks)
+    networks   16-byte network address, prefix length (of the mapped
+               address) and uint32 expiry per blocked network
+
+A lookup hashes the IP string with crc32 and tests up to four bloom bits;
+only the rare positives (blocked IPs and ~1% false positives) pay for a
+binary search over the keys. Blocked networks are few; each worker loads
+them into a `NetworkIndex` when it maps the file.
+
+The file carries the blocklist sequence number (see `ip_tracking.blocklist`).
+When a worker needs a newer version it takes an flock, rebuilds the file
+from the database unless another worker just did, and renames it into
+place; the others notice the new inode and remap it. Deltas received from
+the change feed are kept in a small per-worker overlay on top of the
+mapped file, and folded into a new file once the overlay grows past
+`IP_TRACKING_BLOCKFILTER_MAX_OVERLAY` entries (default 1000).
+"""
+
+import fcntl
+import mmap
+import os
+import socket
+import struct
+import time
+import zlib
+from bisect import bisect_left
+from pathlib import Path
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .blocklist import ADD, REMOVE, VERSION_KEY, Blocklist, NetworkIndex, block_key
+
+MAGIC = b'IPBF'
+FORMAT = 2
+# magic, format, hash count, sequence (-1 without one), entries, bloom bytes, networks
+HEADER = struct.Struct('<4sHHqQQQ')
+# network address, mapped prefix length, expiry
+NETWORK = struct.Struct('<16sBI')
+KEY_SIZE = 16
+# ~1.2% false positives
+BITS_PER_ENTRY = 10
+HASHES = 4
+# Fibonacci hashing constant; mixes crc32 into the second probe stride
+GOLDEN = 0x9E3779B97F4A7C15
+PERMANENT = 0
+_V4_PREFIX = b'\x00' * 10 + b'\xff\xff'
+
+
+def get_filter_path():
+    return Path(getattr(settings, 'IP_TRACKING_BLOCKFILTER_PATH', None) or Path(settings.BASE_DIR) / 'blockfilter.bin')
+
+
+def pack_ip(ip_address):
+    """
+    16-byte key of an address; IPv4 is mapped so both families sort
+    together. Raises OSError for anything that is not an IP address.
+    """
+    if ':' in ip_address:
+        return socket.inet_pton(socket.AF_INET6, ip_address)
+    return _V4_PREFIX + socket.inet_pton(socket.AF_INET, ip_address)
+
+
+def pack_network(cidr):
+    """(16-byte key, prefix length of the mapped key) of a CIDR"""
+    ip_address, prefix = cidr.split('/')
+    prefix = int(prefix)
+    return pack_ip(ip_address), prefix if ':' in ip_address else prefix + 96
+
+
+def unpack_network(key, prefix):
+    """The CIDR of a pack_network() pair"""
+    if key.startswith(_V4_PREFIX):
+        return f'{socket.inet_ntop(socket.AF_INET, key[12:])}/{prefix - 96}'
+    return f'{socket.inet_ntop(socket.AF_INET6, key)}/{prefix}'
+
+
+def _expiry(expiry):
+    return PERMANENT if expiry is None else min(int(expiry), 0xFFFFFFFF)
+
+
+def build_filter(entries, seq=None):
+    """
+    The file contents for `entries`, an iterable of (ip_address, expiry)
+    where ip_address is an address or a CIDR and expiry is a POSIX
+    timestamp or None.
+    """
+    addresses = {}
+    networks = []
+    for ip_address, expiry in entries:
+        if '/' in ip_address:
+            networks.append(NETWORK.pack(*pack_network(ip_address), _expiry(expiry)))
+        else:
+            addresses[pack_ip(ip_address)] = (ip_address, expiry)
+    rows = sorted(addresses.items())
+    bloom_bits = 1024
+    while bloom_bits < len(rows) * BITS_PER_ENTRY:
+        bloom_bits *= 2
+    bloom = bytearray(bloom_bits // 8)
+    mask = bloom_bits - 1
+    crc32 = zlib.crc32
+    for _, (ip_address, _) in rows:
+        h1 = crc32(ip_address.encode())
+        h2 = (h1 * GOLDEN) >> 32 | 1
+        for i in range(HASHES):
+            bit = (h1 + i * h2) & mask
+            bloom[bit >> 3] |= 1 << (bit & 7)
+    keys = b''.join(key for key, _ in rows)
+    expiries = struct.pack(f'<{len(rows)}I', *(_expiry(expiry) for _, (_, expiry) in rows))
+    header = HEADER.pack(
+        MAGIC, FORMAT, HASHES, -1 if seq is None else seq, len(rows), len(bloom), len(networks)
+    )
+    return header + bytes(bloom) + keys + expiries + b''.join(networks)
+
+
+def write_filter(path, entries, seq=None):
+    """Write the filter next to path and rename it into place"""
+    path = Path(path)
+    temporary = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    temporary.write_bytes(build_filter(entries, seq))
+    os.replace(temporary, path)
+
+
+class _Keys:
+    """Sequence view of the sorted keys, for bisect"""
+
+    __slots__ = ('data', 'offset', 'count')
+
+    def __init__(self, data, offset, count):
+        self.data = data
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        start = self.offset + index * KEY_SIZE
+        return self.data[start:start + KEY_SIZE]
+
+
+class BlockFilter:
+    """A read-only mapping of one filter file"""
+
+    def __init__(self, data, identity):
+        magic, file_format, hashes, seq, count, bloom_size, network_count = HEADER.unpack_from(data)
+        if magic != MAGIC or file_format != FORMAT or hashes != HASHES:
+            # Also files of an older format, which are rebuilt
+            raise ValueError('Not a blocklist filter file')
+        self.data = data
+        self.identity = identity
+        self.seq = seq
+        self.count = count
+        self.bloom_offset = HEADER.size
+        self.mask = bloom_size * 8 - 1
+        self.keys = _Keys(data, HEADER.size + bloom_size, count)
+        self.expiry_offset = HEADER.size + bloom_size + count * KEY_SIZE
+        # {cidr: expiry} of the blocked networks, and their index
+        self.network_expiries = {}
+        offset = self.expiry_offset + count * 4
+        for _ in range(network_count):
+            key, prefix, expiry = NETWORK.unpack_from(data, offset)
+            self.network_expiries[unpack_network(key, prefix)] = expiry
+            offset += NETWORK.size
+        self.networks = NetworkIndex(self.network_expiries)
+
+    @classmethod
+    def open(cls, path):
+        """Map the file at path, or return None if there is no valid file"""
+        try:
+            with open(path, 'rb') as handle:
+                stat = os.fstat(handle.fileno())
+                data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return None
+        try:
+            return cls(data, (stat.st_ino, stat.st_mtime_ns))
+        except (ValueError, struct.error):
+            return None
+
+    def is_blocked(self, ip_address, now):
+        # Bloom probes, inlined: most lookups stop at the first clear bit
+        h1 = zlib.crc32(ip_address.encode())
+        h2 = (h1 * GOLDEN) >> 32 | 1
+        bloom = self.data
+        offset = self.bloom_offset
+        mask = self.mask
+        for i in range(HASHES):
+            bit = (h1 + i * h2) & mask
+            if not bloom[offset + (bit >> 3)] >> (bit & 7) & 1:
+                return False
+        try:
+            key = pack_ip(ip_address)
+        except OSError:
+            return False
+        index = bisect_left(self.keys, key)
+        if index == self.count or self.keys[index] != key:
+            return False
+        expiry, = struct.unpack_from('<I', bloom, self.expiry_offset + index * 4)
+        return expiry == PERMANENT or expiry > now
+
+    def blocking_networks(self, ip_address, now):
+        """The blocked CIDRs in the file containing ip_address"""
+        return [
+            cidr for cidr in self.networks.match(ip_address)
+            if self.network_expiries[cidr] == PERMANENT or self.network_expiries[cidr] > now
+        ]
+
+
+class SharedBlocklist(Blocklist):
+    """
+    Blocklist backed by the shared filter file plus this worker's overlay
+    of deltas newer than the file: `entries` maps added addresses and
+    CIDRs to (expiry, seq), `networks` indexes the added CIDRs and
+    `removed` maps removed ones to their seq.
+    """
+
+    def __init__(self, refresh_interval=1.0, path=None, max_overlay=1000):
+        super().__init__(refresh_interval)
+        self.path = Path(path or get_filter_path())
+        self.max_overlay = max_overlay
+        self.filter = None
+        self.removed = {}
+
+    def _match(self, ip_address, now):
+        current = self.filter
+        entry = self.entries.get(ip_address)
+        if entry is not None:
+            if entry[0] is None or entry[0] > now:
+                return ip_address
+        elif ip_address not in self.removed and current is not None and current.is_blocked(ip_address, now):
+            return ip_address
+        if self.networks:
+            for cidr in self.networks.match(ip_address):
+                entry = self.entries.get(cidr)
+                if entry is not None and (entry[0] is None or entry[0] > now):
+                    return cidr
+        if current is not None and current.networks:
+            for cidr in current.blocking_networks(ip_address, now):
+                # The overlay has the newer state of the CIDRs it holds
+                if cidr not in self.entries and cidr not in self.removed:
+                    return cidr
+        return None
+
+    def maybe_refresh(self):
+        now = time.monotonic()
+        if self.loaded and now - self.checked_at < self.refresh_interval:
+            return
+        self.checked_at = now
+        if self.subscriber is not None and self.subscriber.in_sync:
+            # Deltas keep the overlay current; only fold it into a new file
+            # when it grows, or pick up a file another worker published
+            if len(self.entries) + len(self.removed) >= self.max_overlay or self._replaced():
+                self.reload(self.version, newer_ok=True)
+            return
+        version = cache.get(VERSION_KEY)
+        if not self.loaded or version != self.version or self._replaced():
+            self.reload(version)
+
+    def _replaced(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return True
+        return self.filter is None or (stat.st_ino, stat.st_mtime_ns) != self.filter.identity
+
+    def reload(self, version=None, newer_ok=False):
+        """
+        Map the file for `version` (or a newer one if `newer_ok`, when the
+        change feed keeps the overlay current), building it if needed.
+        """
+        target = -1 if version is None else version
+        with self.lock:
+            current = BlockFilter.open(self.path)
+            if not self._usable(current, target, newer_ok):
+                current = self._build(target, newer_ok)
+            self.filter = current
+            # Deltas up to the file's sequence are part of it now
+            self.entries = {ip: entry for ip, entry in self.entries.items() if entry[1] > current.seq}
+            self.networks = NetworkIndex(key for key in self.entries if '/' in key)
+            self.removed = {ip: seq for ip, seq in self.removed.items() if seq > current.seq}
+            newest = max(target, current.seq)
+            self.version = None if newest < 0 else newest
+            self.loaded = True
+
+    @staticmethod
+    def _usable(current, target, newer_ok):
+        if current is None:
+            return False
+        return current.seq >= target if newer_ok else current.seq == target
+
+    def _build(self, target, newer_ok):
+        from .models import BlockedIP
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path.with_name(f'{self.path.name}.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Another worker may have built it while we waited for the lock
+            current = BlockFilter.open(self.path)
+            if self._usable(current, target, newer_ok):
+                return current
+            rows = (
+                BlockedIP.objects
+                .filter(Q(expires_at__isnull=True) | Q(expires_at__gt=timezone.now()))
+                .values_list('ip_address', 'prefix_length', 'expires_at')
+            )
+            write_filter(
+                self.path,
+                (
+                    (block_key(ip, prefix_length), expires_at.timestamp() if expires_at else None)
+                    for ip, prefix_length, expires_at in rows.iterator()
+                ),
+                None if target < 0 else target,
+            )
+            return BlockFilter.open(self.path)
+
+    def apply(self, seq, op, ip_address, expires):
+        with self.lock:
+            if op == ADD:
+                expires_at = parse_datetime(expires) if expires else None
+                self.entries[ip_address] = (expires_at.timestamp() if expires_at else None, seq)
+                self.removed.pop(ip_address, None)
+                if '/' in ip_address:
+                    self.networks.add(ip_address)
+            elif op == REMOVE:
+                self.entries.pop(ip_address, None)
+                self.removed[ip_address] = seq
+                if '/' in ip_address:
+                    self.networks.remove(ip_address)
+            self.version = seq
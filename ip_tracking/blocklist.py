@@ -0,0 +1,375 @@
+"""
+Process-local blocklist used by IPTrackingMiddleware.
+
+Each worker keeps the active BlockedIP entries in a dict so that the
+per-request check is a dictionary lookup instead of a database query.
+Entries are keyed by `BlockedIP.network`: an address, or a CIDR for
+network blocks. Networks are also indexed by prefix length
+(`NetworkIndex`), so a client costs one masked lookup per prefix length
+in use, and nothing more while no network is blocked.
+
+Changes reach the workers in one of two ways:
+
+- Change feed (Redis cache): every BlockedIP save/delete publishes a delta
+  `{op, ip, expires}` (`ip` being the entry key) tagged with a sequence number on `CHANNEL`. Each
+  worker runs a `BlocklistSubscriber` thread that applies deltas as they
+  arrive, and does a full resync from the database on startup, after a
+  reconnect, or when a sequence gap shows that a delta was missed. No
+  per-request round trip is needed.
+- Version polling (any other cache, or when the subscriber is down): the
+  same sequence number doubles as a version in the cache, and workers
+  compare it at most once every `IP_TRACKING_BLOCKLIST_REFRESH_INTERVAL`
+  seconds (default: 1), reloading on change.
+
+Set `IP_TRACKING_BLOCKLIST_PUBSUB = False` to always use polling.
+
+With `IP_TRACKING_BLOCKLIST_BACKEND = 'shared'` the snapshot is a file
+mapped by every worker of the host instead of a dict per worker (see
+`ip_tracking.blockfilter`).
+"""
+
+import ipaddress
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .utils import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = 'ip_tracking:blocklist:version'
+CHANNEL = 'ip_tracking:blocklist:changes'
+
+ADD = 'add'
+REMOVE = 'remove'
+
+# Increment the version and publish the delta under the same number, so
+# subscribers see deltas in sequence order and can detect gaps.
+_PUBLISH_SCRIPT = """
+local seq = redis.call('INCR', KEYS[1])
+for i = 2, #ARGV do
+    if i > 2 then
+        seq = redis.call('INCR', KEYS[1])
+    end
+    redis.call('PUBLISH', ARGV[1], seq .. ' ' .. ARGV[i])
+end
+return seq
+"""
+
+_publish_script = None
+
+
+def bump_version():
+    """Signal all workers that the blocklist changed"""
+    cache.add(VERSION_KEY, 0, None)
+    try:
+        return cache.incr(VERSION_KEY)
+    except ValueError:
+        # The key was evicted between add() and incr()
+        cache.set(VERSION_KEY, 1, None)
+        return 1
+
+
+def publish_changes(changes):
+    """
+    Publish blocklist deltas to all workers.
+
+    `changes` is a list of (op, ip_address, expires_at) tuples where op is
+    ADD or REMOVE, ip_address is an address or a CIDR (`BlockedIP.network`)
+    and expires_at is a datetime or None. Falls back to a plain
+    version bump when the cache is not Redis.
+
+    Called after the change is committed, so it never raises: a failed
+    publish falls back to a version bump, which polling workers pick up,
+    and if that fails too the subscribers resync when they reconnect.
+    Returns the new sequence number, or None if nothing was published.
+    """
+    if not changes:
+        return None
+    try:
+        return _publish(changes)
+    except Exception as e:
+        logger.warning(f"Failed to publish {len(changes)} blocklist change(s): {str(e)}")
+    try:
+        return bump_version()
+    except Exception as e:
+        logger.error(f"Failed to bump the blocklist version: {str(e)}")
+        return None
+
+
+def _publish(changes):
+    global _publish_script
+    client = get_redis_client() if _pubsub_enabled() else None
+    if client is None:
+        return bump_version()
+    if _publish_script is None:
+        _publish_script = client.register_script(_PUBLISH_SCRIPT)
+    payloads = [
+        json.dumps({
+            'op': op,
+            'ip': ip_address,
+            'expires': expires_at.isoformat() if expires_at else None,
+        })
+        for op, ip_address, expires_at in changes
+    ]
+    return _publish_script(keys=[cache.make_key(VERSION_KEY)], args=[CHANNEL] + payloads)
+
+
+def _pubsub_enabled():
+    return getattr(settings, 'IP_TRACKING_BLOCKLIST_PUBSUB', True)
+
+
+def block_key(ip_address, prefix_length=None):
+    """The entry key of a block: the address, or its CIDR for networks"""
+    return ip_address if prefix_length is None else f'{ip_address}/{prefix_length}'
+
+
+class NetworkIndex:
+    """
+    Blocked networks as {(ip version, prefix length): {network as int: CIDR}}.
+    `match(ip_address)` masks the address once per prefix length.
+    """
+
+    def __init__(self, cidrs=()):
+        self.levels = {}
+        for cidr in cidrs:
+            self.add(cidr)
+
+    def __bool__(self):
+        return bool(self.levels)
+
+    @staticmethod
+    def _level(cidr):
+        network = ipaddress.ip_network(cidr)
+        return (network.version, network.prefixlen), int(network.network_address)
+
+    def add(self, cidr):
+        level, number = self._level(cidr)
+        self.levels.setdefault(level, {})[number] = cidr
+
+    def remove(self, cidr):
+        level, number = self._level(cidr)
+        networks = self.levels.get(level)
+        if networks is not None and networks.pop(number, None) is not None and not networks:
+            del self.levels[level]
+
+    def match(self, ip_address):
+        """The CIDRs containing ip_address"""
+        try:
+            address = ipaddress.ip_address(ip_address)
+        except ValueError:
+            return []
+        number = int(address)
+        bits = address.max_prefixlen
+        matches = []
+        for (version, prefix), networks in list(self.levels.items()):
+            if version == address.version:
+                cidr = networks.get(number >> bits - prefix << bits - prefix)
+                if cidr is not None:
+                    matches.append(cidr)
+        return matches
+
+
+class Blocklist:
+    """
+    In-memory snapshot of the active blocks: {address or CIDR: expiry}
+    where the expiry is a POSIX timestamp, or None for permanent blocks,
+    plus the NetworkIndex of the CIDRs.
+    """
+
+    def __init__(self, refresh_interval=1.0):
+        self.refresh_interval = refresh_interval
+        self.entries = {}
+        self.networks = NetworkIndex()
+        self.version = None
+        self.loaded = False
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+        self.subscriber = None
+
+    def is_blocked(self, ip_address):
+        return self.blocked_by(ip_address) is not None
+
+    def blocked_by(self, ip_address):
+        """The entry (address or CIDR) blocking ip_address, or None"""
+        self.maybe_refresh()
+        return self._match(ip_address, time.time())
+
+    def blocked_among(self, ip_addresses):
+        """The addresses in ip_addresses that are blocked, in one pass"""
+        self.maybe_refresh()
+        now = time.time()
+        return [ip_address for ip_address in ip_addresses if self._match(ip_address, now) is not None]
+
+    def _match(self, ip_address, now):
+        entries = self.entries
+        if ip_address in entries:
+            expiry = entries[ip_address]
+            if expiry is None or expiry > now:
+                return ip_address
+        if self.networks:
+            for cidr in self.networks.match(ip_address):
+                expiry = entries.get(cidr, 0)
+                if expiry is None or expiry > now:
+                    return cidr
+        return None
+
+    def maybe_refresh(self):
+        """Reload the snapshot if the cached version moved"""
+        if self.subscriber is not None and self.subscriber.in_sync:
+            return
+        now = time.monotonic()
+        if self.loaded and now - self.checked_at < self.refresh_interval:
+            return
+        self.checked_at = now
+        version = cache.get(VERSION_KEY)
+        if not self.loaded or version != self.version:
+            self.reload(version)
+
+    def reload(self, version=None):
+        """Load all active blocks from the database"""
+        from .models import BlockedIP
+
+        with self.lock:
+            rows = (
+                BlockedIP.objects
+                .filter(Q(expires_at__isnull=True) | Q(expires_at__gt=timezone.now()))
+                .values_list('ip_address', 'prefix_length', 'expires_at')
+            )
+            entries = {
+                block_key(ip, prefix_length): expires_at.timestamp() if expires_at else None
+                for ip, prefix_length, expires_at in rows
+            }
+            self.networks = NetworkIndex(key for key in entries if '/' in key)
+            self.entries = entries
+            self.version = version
+            self.loaded = True
+        logger.debug(f"Loaded blocklist version {version} with {len(self.entries)} entries")
+
+    def apply(self, seq, op, ip_address, expires):
+        """Apply one published delta"""
+        with self.lock:
+            if op == ADD:
+                expires_at = parse_datetime(expires) if expires else None
+                self.entries[ip_address] = expires_at.timestamp() if expires_at else None
+                if '/' in ip_address:
+                    self.networks.add(ip_address)
+            elif op == REMOVE:
+                self.entries.pop(ip_address, None)
+                if '/' in ip_address:
+                    self.networks.remove(ip_address)
+            self.version = seq
+
+
+class BlocklistSubscriber(threading.Thread):
+    """
+    Background thread applying published deltas to a Blocklist.
+
+    `in_sync` is True only while the subscription is live and the snapshot
+    is known to be complete; the Blocklist falls back to version polling
+    otherwise.
+    """
+
+    def __init__(self, blocklist, client):
+        super().__init__(name='ip-tracking-blocklist', daemon=True)
+        self.blocklist = blocklist
+        self.client = client
+        self.in_sync = False
+        self.stopped = threading.Event()
+
+    def run(self):
+        backoff = 1.0
+        while not self.stopped.is_set():
+            try:
+                self.listen()
+                backoff = 1.0
+            except Exception as e:
+                self.in_sync = False
+                logger.warning(f"Blocklist subscriber disconnected: {str(e)}")
+                self.stopped.wait(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+    def listen(self):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(CHANNEL)
+            # Subscribe first, then resync, so nothing published in between is lost
+            self.resync()
+            while not self.stopped.is_set():
+                message = pubsub.get_message(timeout=1.0)
+                if message is None:
+                    continue
+                self.handle(message['data'])
+        finally:
+            self.in_sync = False
+            pubsub.close()
+
+    def resync(self):
+        self.in_sync = False
+        try:
+            self.blocklist.reload(cache.get(VERSION_KEY))
+        finally:
+            # Don't keep an idle database connection open in this thread
+            connections.close_all()
+        self.in_sync = True
+
+    def handle(self, data):
+        if isinstance(data, bytes):
+            data = data.decode()
+        seq, payload = data.split(' ', 1)
+        seq = int(seq)
+        last = self.blocklist.version
+        if last is not None and seq <= last:
+            # Already part of the loaded snapshot
+            return
+        change = json.loads(payload)
+        if last is not None and seq > last + 1:
+            logger.info(f"Blocklist sequence gap ({last} -> {seq}), resyncing")
+            self.resync()
+            return
+        self.blocklist.apply(seq, change['op'], change['ip'], change['expires'])
+
+    def stop(self):
+        self.stopped.set()
+
+
+_blocklist = None
+_blocklist_pid = None
+_blocklist_lock = threading.Lock()
+
+
+def get_blocklist():
+    """
+    Return the worker's Blocklist, creating it (and its subscriber thread,
+    when the cache is Redis) on first use in each process.
+    """
+    global _blocklist, _blocklist_pid
+    pid = os.getpid()
+    if _blocklist is None or _blocklist_pid != pid:
+        with _blocklist_lock:
+            if _blocklist is None or _blocklist_pid != pid:
+                refresh_interval = getattr(settings, 'IP_TRACKING_BLOCKLIST_REFRESH_INTERVAL', 1.0)
+                if getattr(settings, 'IP_TRACKING_BLOCKLIST_BACKEND', 'memory') == 'shared':
+                    from .blockfilter import SharedBlocklist
+
+                    blocklist = SharedBlocklist(
+                        refresh_interval=refresh_interval,
+                        max_overlay=getattr(settings, 'IP_TRACKING_BLOCKFILTER_MAX_OVERLAY', 1000),
+                    )
+                else:
+                    blocklist = Blocklist(refresh_interval=refresh_interval)
+                client = get_redis_client() if _pubsub_enabled() else None
+                if client is not None:
+                    blocklist.subscriber = BlocklistSubscriber(blocklist, client)
+                    blocklist.subscriber.start()
+                _blocklist, _blocklist_pid = blocklist, pid
+    return _blocklist
@@ -0,0 +1,193 @@
+"""
+Admin changelist helpers for very large tables (RequestLog).
+
+- `EstimatedCountPaginator` asks the PostgreSQL planner how many rows a
+  changelist query returns instead of running `COUNT(*)`, once the
+  estimate is above `IP_TRACKING_ADMIN_EXACT_COUNT_LIMIT` (default
+  10,000). Smaller results, and other databases, are counted exactly.
+- `TimeWindowFilter` limits the changelist to recent rows by default
+  (`IP_TRACKING_ADMIN_DEFAULT_WINDOW`, default '24h'), so the first page
+  load reads one range of the timestamp index instead of the whole table.
+- `InputFilter` subclasses are free-text sidebar filters: unlike the
+  built-in field filters they do not run `SELECT DISTINCT` over the table
+  to list their choices.
+"""
+
+import ipaddress
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from .paths import PathClassifier
+from .utils import ip_bucket
+
+WINDOWS = (
+    ('1h', 'Last hour', timedelta(hours=1)),
+    ('24h', 'Last 24 hours', timedelta(hours=24)),
+    ('7d', 'Last 7 days', timedelta(days=7)),
+    ('30d', 'Last 30 days', timedelta(days=30)),
+    ('all', 'All time', None),
+)
+
+
+def estimate_count(queryset):
+    """The planner's row estimate for queryset, or None if unavailable"""
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    query = queryset.order_by().query
+    with connection.cursor() as cursor:
+        if not query.where:
+            cursor.execute(
+                'SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                [queryset.model._meta.db_table],
+            )
+            row = cursor.fetchone()
+            # -1 until the table has been vacuumed or analyzed
+            return row[0] if row and row[0] >= 0 else None
+        sql, params = query.get_compiler(using=queryset.db).as_sql()
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator that trusts the planner's estimate for large results"""
+
+    @cached_property
+    def count(self):
+        limit = getattr(settings, 'IP_TRACKING_ADMIN_EXACT_COUNT_LIMIT', 10_000)
+        estimate = estimate_count(self.object_list)
+        if estimate is None or estimate < limit:
+            return super().count
+        return estimate
+
+
+class TimeWindowFilter(admin.SimpleListFilter):
+    """Rows newer than the selected window; a recent window by default"""
+
+    title = 'time window'
+    parameter_name = 'window'
+    field_name = 'timestamp'
+
+    def lookups(self, request, model_admin):
+        return [(value, label) for value, label, _ in WINDOWS]
+
+    def selected(self):
+        default = getattr(settings, 'IP_TRACKING_ADMIN_DEFAULT_WINDOW', '24h')
+        value = self.value() or default
+        return value if value in {value for value, _, _ in WINDOWS} else default
+
+    def choices(self, changelist):
+        selected = self.selected()
+        for value, label in self.lookup_choices:
+            yield {
+                'selected': value == selected,
+                'query_string': changelist.get_query_string({self.parameter_name: value}),
+                'display': label,
+            }
+
+    def queryset(self, request, queryset):
+        delta = {value: delta for value, _, delta in WINDOWS}[self.selected()]
+        if delta is None:
+            return queryset
+        return queryset.filter(**{f'{self.field_name}__gte': timezone.now() - delta})
+
+
+class InputFilter(admin.ListFilter):
+    """Sidebar filter with a text box; subclasses implement `queryset()`"""
+
+    parameter_name = None
+    template = 'admin/ip_tracking/input_filter.html'
+
+    def __init__(self, request, params, model, model_admin):
+        super().__init__(request, params, model, model_admin)
+        if self.parameter_name in params:
+            self.used_parameters[self.parameter_name] = params.pop(self.parameter_name)[-1]
+
+    def value(self):
+        return (self.used_parameters.get(self.parameter_name) or '').strip() or None
+
+    def has_output(self):
+        return True
+
+    def expected_parameters(self):
+        return [self.parameter_name]
+
+    def choices(self, changelist):
+        # The other parameters, kept as hidden inputs when the form is sent
+        hidden = [
+            (key, value) for key, value in changelist.params.items()
+            if key not in (self.parameter_name, 'p')
+        ]
+        yield {
+            'selected': self.value() is None,
+            'query_string': changelist.get_query_string(remove=[self.parameter_name]),
+            'hidden': hidden,
+            'value': self.value() or '',
+        }
+
+
+class IPAddressFilter(InputFilter):
+    """Exact IP address, narrowed by `ip_bucket` so it uses the time index"""
+
+    title = 'IP address'
+    parameter_name = 'ip'
+
+    def queryset(self, request, queryset):
+        value = self.value()
+        if value is None:
+            return queryset
+        try:
+            address = str(ipaddress.ip_address(value))
+        except ValueError:
+            raise IncorrectLookupParameters(f'Invalid IP address: {value}')
+        return queryset.filter(ip_address=address, ip_bucket=ip_bucket(address))
+
+
+class FieldInputFilter(InputFilter):
+    """Exact match on `field_name`"""
+
+    field_name = None
+
+    def queryset(self, request, queryset):
+        value = self.value()
+        if value is None:
+            return queryset
+        return queryset.filter(**{self.field_name: value})
+
+
+class CountryFilter(FieldInputFilter):
+    title = 'country'
+    parameter_name = 'country'
+    field_name = 'country'
+
+
+class CityFilter(FieldInputFilter):
+    title = 'city'
+    parameter_name = 'city'
+    field_name = 'city'
+
+
+class PathCategoryFilter(admin.SimpleListFilter):
+    """Categories from the configured classifier, not from the table"""
+
+    title = 'path category'
+    parameter_name = 'path_category'
+
+    def lookups(self, request, model_admin):
+        return [(category, category) for category in sorted(PathClassifier.from_settings().categories)]
+
+    def queryset(self, request, queryset):
+        if self.value() is None:
+            return queryset
+        return queryset.filter(path_category=self.value())
@@ -0,0 +1,157 @@
+"""
+Anomaly detection, split into a map step and a reduce step.
+
+`scan(since, until, buckets)` reads the request logs of one range of IP
+hash buckets (see `utils.ip_bucket`) once and evaluates every configured
+rule on them (see `ip_tracking.rules`). Every IP lives in exactly one
+bucket, so per-IP thresholds can be applied inside each shard and the
+partials never overlap. Networks do span shards: subnet rules and subnet
+baselines return per-network totals that `merge(partials)` adds up
+through `Rule.combine()`; they are scored in `record(merged, now,
+since)`, which escalates and then flags the IPs in one batch (see
+`escalation`).
+
+`detect_anomalies` runs the shards inline or fans them out as a Celery
+chord, depending on `IP_TRACKING_ANOMALY_SHARDS`.
+
+Partials are plain JSON-serialisable dicts so they can travel through the
+Celery result backend:
+
+    {rule_name: {ip: [value, detail]}}
+    {subnet_rule_name: {cidr: [requests, ips, [[ip, requests], ...]]}}
+    {subnet_baseline_name: {cidr: [period, requests, {path: requests}, [[ip, requests], ...]]}}
+
+Flags are keyed by (ip, rule) through `SuspiciousIP.category`, with at most
+one unresolved flag per key (a partial unique constraint). `upsert_flags`
+writes a whole run with `INSERT ... ON CONFLICT DO UPDATE` (PostgreSQL and
+SQLite), bumping `hit_count` and `last_seen` of flags that are still open
+instead of adding rows.
+"""
+
+import logging
+
+from django.db import connections, router
+from django.db.models import Q
+
+from . import metrics
+from .escalation import escalate
+from .models import RequestLog, SuspiciousIP
+from .rules import Window, get_rule_set
+from .utils import IP_BUCKETS
+
+logger = logging.getLogger(__name__)
+
+
+def shard_ranges(shards):
+    """Split the bucket space into `shards` contiguous [start, end) ranges"""
+    shards = max(1, min(shards, IP_BUCKETS))
+    return [
+        (IP_BUCKETS * index // shards, IP_BUCKETS * (index + 1) // shards)
+        for index in range(shards)
+    ]
+
+
+def scan(since, until, buckets=(0, IP_BUCKETS), rule_set=None):
+    """Rule hits for the IPs in the bucket range `buckets`"""
+    rule_set = rule_set or get_rule_set()
+    start, end = buckets
+    rows = RequestLog.objects.filter(timestamp__gte=since, timestamp__lte=until)
+    in_range = Q(ip_bucket__gte=start, ip_bucket__lt=end)
+    if start == 0:
+        # Rows logged before ip_bucket existed
+        in_range |= Q(ip_bucket__isnull=True)
+    window = Window.fetch(rows.filter(in_range), until=until)
+    return rule_set.evaluate(window)
+
+
+def merge(partials, rule_set=None):
+    """Combine shard partials; shards never share an IP, but may share a network"""
+    rule_set = rule_set or get_rule_set()
+    merged = {}
+    for partial in partials:
+        for kind, hits in partial.items():
+            rule = rule_set.by_name.get(kind)
+            if rule is None:
+                merged.setdefault(kind, {}).update(hits)
+            else:
+                rule.combine(merged.setdefault(kind, {}), hits)
+    return merged
+
+
+def record(merged, now, since, rule_set=None):
+    """
+    Escalate the detected IPs, then flag them, bumping the open flag of
+    IPs the same rule already flagged. `since` is the start of the window
+    the partials cover. Returns the task summary.
+    """
+    rule_set = rule_set or get_rule_set()
+    offenses = []
+    networks = []
+    flags = []
+    summary = {}
+    detected = {}
+
+    for kind, partial in merged.items():
+        rule = rule_set.by_name.get(kind)
+        if rule is None:
+            continue
+        hits = detected[kind] = rule.finalize(partial)
+        summary.update(rule.summarize(hits))
+        for ip_address, (value, detail) in hits.items():
+            offenses.append((ip_address, kind, value))
+            flags.append((ip_address, kind, rule.reason(value, detail)))
+        networks += [(cidr, kind, value) for cidr, value in rule.network_offenses(hits)]
+
+    # Escalate repeat and high-severity offenders to temporary blocks; this
+    # reads the IPs' open flags, so it runs before the upsert
+    blocked_ips = escalate(offenses, now=now, since=since, networks=networks)
+
+    for ip_address, kind in upsert_flags(flags, now):
+        metrics.ANOMALIES_FLAGGED.inc(kind)
+        logger.warning(f"Flagged IP {ip_address} for {kind}: {detected[kind][ip_address][0]}")
+
+    return {
+        **summary,
+        'ips_blocked': len(blocked_ips),
+        'timestamp': now.isoformat()
+    }
+
+
+def upsert_flags(flags, now, batch_size=500):
+    """
+    Write (ip_address, category, reason) flags, one statement per batch.
+    Returns the (ip_address, category) pairs that had no open flag.
+    """
+    if not flags:
+        return []
+    connection = connections[router.db_for_write(SuspiciousIP)]
+    ops = connection.ops
+    table = ops.quote_name(SuspiciousIP._meta.db_table)
+    seen_at = ops.adapt_datetimefield_value(now)
+    created = []
+    with connection.cursor() as cursor:
+        for start in range(0, len(flags), batch_size):
+            batch = flags[start:start + batch_size]
+            params = []
+            for ip_address, category, reason in batch:
+                params += [ops.adapt_ipaddressfield_value(ip_address), category, reason, seen_at, seen_at]
+            values = ', '.join(['(%s, %s, %s, %s, %s, 1, FALSE)'] * len(batch))
+            # The conflict target repeats the partial index condition
+            cursor.execute(
+                f'INSERT INTO {table} '
+                f'(ip_address, category, reason, flagged_at, last_seen, hit_count, resolved) '
+                f'VALUES {values} '
+                f'ON CONFLICT (ip_address, category) WHERE NOT resolved DO UPDATE SET '
+                f'hit_count = {table}.hit_count + 1, '
+                f'last_seen = excluded.last_seen, '
+                f'reason = excluded.reason '
+                f'RETURNING ip_address, category, hit_count',
+                params,
+            )
+            # A hit count of 1 means the row was inserted, not bumped
+            created.extend(
+                (str(ip_address), category)
+                for ip_address, category, hit_count in cursor.fetchall()
+                if hit_count == 1
+            )
+    return created
@@ -0,0 +1,239 @@
+"""
+Export of the active blocks to edge firewall formats.
+
+Blocked clients are rejected by `IPTrackingMiddleware`, but only after a
+full Django request. Compiling `BlockedIP` into files the edge can load
+lets nginx or the kernel drop them before they reach gunicorn:
+
+- `nginx`: a `geo` block setting `$ip_tracking_blocked`, for
+  `include` in the `http` context together with
+  `if ($ip_tracking_blocked) { return 403; }`;
+- `ipset`: an `ipset restore` script filling the `hash:net` sets
+  `ip_tracking_blocked` (IPv4) and `ip_tracking_blocked6` (IPv6);
+- `nftables`: an `nft -f` script filling the interval sets `blocked_v4`
+  and `blocked_v6` of table `inet ip_tracking`.
+
+Network blocks are exported as their CIDR. Adjacent and overlapping
+addresses and networks are collapsed into the fewest CIDRs.
+Exports are written to `IP_TRACKING_EDGE_EXPORT_DIR` (default
+BASE_DIR/edge). The networks of the last export are kept in
+`state.json`; each later export only writes what changed since then:
+
+- `blocklist.<ext>` is the full file, rewritten atomically on change;
+- `diffs/<seq>.<ext>` holds the additions and removals (ipset and
+  nftables only; nginx reloads the full file), numbered so that a loader
+  can apply the ones it has not seen yet in order. The newest
+  `IP_TRACKING_EDGE_EXPORT_KEEP_DIFFS` (default 100) are kept.
+
+`manage.py export_blocklist` and the `export_edge_blocklist` task both
+call `export()`.
+"""
+
+import fcntl
+import ipaddress
+import json
+import logging
+import os
+from pathlib import Path
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import BlockedIP
+
+logger = logging.getLogger(__name__)
+
+IPSET_V4 = 'ip_tracking_blocked'
+IPSET_V6 = 'ip_tracking_blocked6'
+NFT_TABLE = 'inet ip_tracking'
+NFT_V4 = 'blocked_v4'
+NFT_V6 = 'blocked_v6'
+
+
+def get_export_dir():
+    return Path(getattr(settings, 'IP_TRACKING_EDGE_EXPORT_DIR', None) or Path(settings.BASE_DIR) / 'edge')
+
+
+def active_networks(now=None):
+    """The active blocks, collapsed into the fewest CIDRs, IPv4 first"""
+    now = now or timezone.now()
+    addresses = {4: [], 6: []}
+    rows = (
+        BlockedIP.objects
+        .filter(Q(expires_at__isnull=True) | Q(expires_at__gt=now))
+        .values_list('ip_address', 'prefix_length')
+    )
+    for ip_address, prefix_length in rows.iterator():
+        if prefix_length is None:
+            address = ipaddress.ip_address(ip_address)
+        else:
+            address = ipaddress.ip_network(f'{ip_address}/{prefix_length}', strict=False)
+        addresses[address.version].append(address)
+    return [
+        str(network)
+        for version in (4, 6)
+        for network in ipaddress.collapse_addresses(addresses[version])
+    ]
+
+
+def _split(networks):
+    v4 = [network for network in networks if ':' not in network]
+    v6 = [network for network in networks if ':' in network]
+    return v4, v6
+
+
+def _nginx_full(networks):
+    lines = ['geo $ip_tracking_blocked {', '    default 0;']
+    lines += [f'    {network} 1;' for network in networks]
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+
+def _ipset_full(networks):
+    v4, v6 = _split(networks)
+    lines = []
+    # Fill temporary sets and swap them in, so the live sets are never empty
+    for name, family, members in ((IPSET_V4, 'inet', v4), (IPSET_V6, 'inet6', v6)):
+        lines += [
+            f'create {name} hash:net family {family} -exist',
+            f'create {name}-new hash:net family {family} -exist',
+            f'flush {name}-new',
+        ]
+        lines += [f'add {name}-new {network}' for network in members]
+        lines += [f'swap {name}-new {name}', f'destroy {name}-new']
+    return '\n'.join(lines) + '\n'
+
+
+def _ipset_diff(added, removed):
+    lines = []
+    for op, networks in (('del', removed), ('add', added)):
+        for network in networks:
+            name = IPSET_V6 if ':' in network else IPSET_V4
+            lines.append(f'{op} {name} {network} -exist')
+    return '\n'.join(lines) + '\n'
+
+
+def _nft_sets():
+    return [
+        f'table {NFT_TABLE} {{',
+        f'    set {NFT_V4} {{ type ipv4_addr; flags interval; }}',
+        f'    set {NFT_V6} {{ type ipv6_addr; flags interval; }}',
+        '}',
+    ]
+
+
+def _nft_elements(op, networks):
+    v4, v6 = _split(networks)
+    return [
+        f'{op} element {NFT_TABLE} {name} {{ {", ".join(members)} }}'
+        for name, members in ((NFT_V4, v4), (NFT_V6, v6))
+        if members
+    ]
+
+
+def _nft_full(networks):
+    # Declaring the table and sets is idempotent; the flushes make it a full load
+    lines = _nft_sets() + [f'flush set {NFT_TABLE} {NFT_V4}', f'flush set {NFT_TABLE} {NFT_V6}']
+    lines += _nft_elements('add', networks)
+    return '\n'.join(lines) + '\n'
+
+
+def _nft_diff(added, removed):
+    lines = _nft_sets() + _nft_elements('delete', removed) + _nft_elements('add', added)
+    return '\n'.join(lines) + '\n'
+
+
+# format: (extension, full renderer, diff renderer or None)
+FORMATS = {
+    'nginx': ('nginx.conf', _nginx_full, None),
+    'ipset': ('ipset', _ipset_full, _ipset_diff),
+    'nftables': ('nft', _nft_full, _nft_diff),
+}
+
+
+def render(format_name, networks):
+    """The full export of networks in format_name"""
+    return FORMATS[format_name][1](networks)
+
+
+def _write(path, content):
+    """Replace path atomically, so a loader never reads a partial file"""
+    temporary = path.with_name(f'.{path.name}.tmp')
+    temporary.write_text(content)
+    os.replace(temporary, path)
+
+
+def export(formats=None, output_dir=None, full=False):
+    """
+    Write the full blocklist files of `formats` (default: all) and the
+    diffs since the previous export to `output_dir`.
+
+    Returns a summary: the number of networks, what was added and removed
+    since the previous export, the diff sequence number and whether full
+    files were written.
+    """
+    formats = list(formats or FORMATS)
+    output_dir = Path(output_dir or get_export_dir())
+    output_dir.mkdir(parents=True, exist_ok=True)
+    state_path = output_dir / 'state.json'
+
+    # Exports from the command and the task must not interleave
+    with open(output_dir / '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        state = json.loads(state_path.read_text()) if state_path.exists() else None
+        networks = active_networks()
+        current = set(networks)
+        previous = set(state['networks']) if state else set()
+        order = {network: index for index, network in enumerate(networks)}
+        added = sorted(current - previous, key=order.__getitem__)
+        removed = sorted(previous - current)
+        missing = [
+            name for name in formats
+            if not (output_dir / f'blocklist.{FORMATS[name][0]}').exists()
+        ]
+        full = full or state is None or bool(missing)
+        seq = state['seq'] if state else 0
+
+        if full or added or removed:
+            for name in formats:
+                extension, full_renderer, _ = FORMATS[name]
+                _write(output_dir / f'blocklist.{extension}', full_renderer(networks))
+
+        # Loaders that follow the diffs need every change, even on a full export
+        if state is not None and (added or removed):
+            seq += 1
+            diff_dir = output_dir / 'diffs'
+            diff_dir.mkdir(exist_ok=True)
+            # Every format's diff, whichever full files this export writes
+            for extension, _, diff_renderer in FORMATS.values():
+                if diff_renderer is not None:
+                    _write(diff_dir / f'{seq:08d}.{extension}', diff_renderer(added, removed))
+            _prune_diffs(diff_dir, getattr(settings, 'IP_TRACKING_EDGE_EXPORT_KEEP_DIFFS', 100))
+
+        if full or added or removed:
+            _write(state_path, json.dumps({
+                'seq': seq,
+                'exported_at': timezone.now().isoformat(),
+                'networks': networks,
+            }))
+
+    if added or removed:
+        logger.info(f"Exported edge blocklist #{seq}: +{len(added)} -{len(removed)} networks")
+    return {
+        'networks': len(networks),
+        'added': len(added),
+        'removed': len(removed),
+        'seq': seq,
+        'full': full,
+    }
+
+
+def _prune_diffs(diff_dir, keep):
+    """Delete all but the newest `keep` diff sequence numbers"""
+    sequences = sorted({path.name.split('.', 1)[0] for path in diff_dir.iterdir()})
+    stale = set(sequences[:-keep] if keep else sequences)
+    for path in diff_dir.iterdir():
+        if path.name.split('.', 1)[0] in stale:
+            path.unlink()
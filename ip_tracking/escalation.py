@@ -0,0 +1,200 @@
+"""
+Automatic escalation of anomaly flags to temporary blocks.
+
+`detect_anomalies` reports every IP it detects in a run as an offense
+(ip, kind, count). The policy blocks an IP when either:
+
+- the offense is high severity: its count reaches the `severe_thresholds`
+  value for its kind (e.g. 1000 requests/hour), or
+- the IP is a repeat offender: the detection periods it was detected in
+  before, within `repeat_window_hours`, plus this run reach
+  `repeat_threshold`.
+
+Every run records the period (the hour its window starts in) of each IP
+it detects as an `OffensePeriod`; open flags cannot serve as the history,
+since each keeps only its latest `last_seen`. A period is counted once
+however many rules or runs reported the IP in it, so re-running detection
+over the same traffic finds the same offense, not a repeat one. Periods
+recorded before the IP's oldest open flag was raised do not count, so
+resolving an IP's flags clears its record.
+
+Blocks are temporary (`block_minutes`, or `severe_block_minutes` for high
+severity). A network reported by a subnet rule (see
+`rules.SubnetRule`) whose requests reach the rule's `network_thresholds`
+value is blocked as a whole, as a CIDR `BlockedIP`, for
+`severe_block_minutes`; no network is blocked unless a threshold is set.
+Configuration lives in `IP_TRACKING_ESCALATION`; every key is optional:
+
+    IP_TRACKING_ESCALATION = {
+        'enabled': True,
+        'repeat_threshold': 2,
+        'repeat_window_hours': 24,
+        'severe_thresholds': {'high_volume': 1000, 'sensitive_paths': 50},
+        'network_thresholds': {'subnet_volume': 5000},
+        'block_minutes': 60,
+        'severe_block_minutes': 24 * 60,
+    }
+
+All reads and writes are batched (one query per step, not per IP) and the
+workers' in-memory blocklists receive the new blocks through the blocklist
+change feed (see `ip_tracking.blocklist`).
+"""
+
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Min
+from django.utils import timezone
+
+from .blocklist import ADD, block_key, publish_changes
+from .models import BlockedIP, OffensePeriod, SuspiciousIP
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'enabled': True,
+    'repeat_threshold': 2,
+    'repeat_window_hours': 24,
+    'severe_thresholds': {'high_volume': 1000, 'sensitive_paths': 50},
+    'network_thresholds': {},
+    'block_minutes': 60,
+    'severe_block_minutes': 24 * 60,
+}
+
+
+def get_escalation_settings():
+    return {**DEFAULTS, **getattr(settings, 'IP_TRACKING_ESCALATION', {})}
+
+
+def escalate(offenses, now=None, since=None, networks=()):
+    """
+    Turn qualifying offenses into temporary BlockedIP entries.
+
+    `offenses` is an iterable of (ip_address, kind, count) tuples from the
+    current detection run, whose window starts at `since`. They are
+    recorded as an offense in the period of `since` before the earlier
+    periods are counted. `networks` is an iterable of (cidr, kind, count)
+    tuples from the subnet rules.
+
+    Returns the list of IP addresses and CIDRs that were blocked or had
+    their block extended.
+    """
+    config = get_escalation_settings()
+    if not config['enabled']:
+        return []
+
+    now = now or timezone.now()
+    since = since or now
+
+    # IPs detected in this run, one offense each, and their severity
+    current = set()
+    severe = set()
+    for ip_address, kind, count in offenses:
+        current.add(ip_address)
+        threshold = config['severe_thresholds'].get(kind)
+        if threshold is not None and count >= threshold:
+            severe.add(ip_address)
+    network_blocks = {
+        cidr for cidr, kind, count in networks
+        if kind in config['network_thresholds'] and count >= config['network_thresholds'][kind]
+    }
+    if not current and not network_blocks:
+        return []
+
+    # Earlier detection periods within the repeat window, counted from the
+    # IP's oldest open flag (flags are written after escalation, with `now`)
+    period = since.replace(minute=0, second=0, microsecond=0)
+    window_start = now - timedelta(hours=config['repeat_window_hours'])
+    open_since = dict(
+        SuspiciousIP.objects
+        .filter(ip_address__in=list(current), resolved=False)
+        .values('ip_address')
+        .annotate(first=Min('flagged_at'))
+        .values_list('ip_address', 'first')
+    )
+    previous = {}
+    earlier = OffensePeriod.objects.filter(
+        ip_address__in=list(open_since), period__gte=window_start, period__lt=period,
+    ).values_list('ip_address', 'recorded_at')
+    for ip_address, recorded_at in earlier:
+        if recorded_at >= open_since[ip_address]:
+            previous[ip_address] = previous.get(ip_address, 0) + 1
+
+    # Record this period and forget the ones that left the repeat window
+    OffensePeriod.objects.bulk_create(
+        [OffensePeriod(ip_address=ip_address, period=period, recorded_at=now) for ip_address in current],
+        batch_size=500,
+        ignore_conflicts=True,
+    )
+    OffensePeriod.objects.filter(period__lt=window_start).delete()
+
+    to_block = {}
+    for ip_address in current:
+        if ip_address in severe:
+            to_block[ip_address] = (
+                now + timedelta(minutes=config['severe_block_minutes']),
+                'high severity anomaly',
+            )
+        elif previous.get(ip_address, 0) + 1 >= config['repeat_threshold']:
+            to_block[ip_address] = (
+                now + timedelta(minutes=config['block_minutes']),
+                'repeated anomalies',
+            )
+    for cidr in network_blocks:
+        to_block[cidr] = (
+            now + timedelta(minutes=config['severe_block_minutes']),
+            'high volume from one network',
+        )
+    if not to_block:
+        return []
+
+    blocked = []
+    with transaction.atomic():
+        # A network block is the row of its network address
+        existing = {
+            block_key(block.ip_address, block.prefix_length): block
+            for block in BlockedIP.objects.select_for_update().filter(
+                ip_address__in=[key.partition('/')[0] for key in to_block]
+            )
+        }
+        occupied = {block.ip_address for block in existing.values()}
+        to_create = []
+        to_extend = []
+        changes = []
+        for ip_address, (expires_at, why) in to_block.items():
+            block = existing.get(ip_address)
+            reason = f"Automatically blocked until {expires_at.isoformat()}: {why}"
+            if block is None:
+                address, _, prefix_length = ip_address.partition('/')
+                if address in occupied:
+                    # Its network address is blocked on its own, or with another prefix
+                    continue
+                to_create.append(BlockedIP(
+                    ip_address=address,
+                    prefix_length=int(prefix_length) if prefix_length else None,
+                    reason=reason,
+                    expires_at=expires_at,
+                ))
+            elif block.expires_at is not None and block.expires_at < expires_at:
+                # Extend temporary blocks; permanent blocks are left alone
+                block.expires_at = expires_at
+                block.reason = reason
+                to_extend.append(block)
+            else:
+                continue
+            blocked.append(ip_address)
+            changes.append((ADD, ip_address, expires_at))
+            logger.warning(f"Escalated IP {ip_address} to a temporary block until {expires_at}: {why}")
+
+        if to_create:
+            BlockedIP.objects.bulk_create(to_create, ignore_conflicts=True)
+        if to_extend:
+            BlockedIP.objects.bulk_update(to_extend, ['expires_at', 'reason'])
+
+        # Bulk writes bypass the model signals, so notify the workers here
+        if changes:
+            transaction.on_commit(lambda: publish_changes(changes))
+
+    return blocked
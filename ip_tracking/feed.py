@@ -0,0 +1,383 @@
+"""
+Live feed of logged requests, pushed to watchers instead of polled.
+
+The middleware publishes every logged request once; watchers (the SSE
+stream and the long-poll endpoint in `api_views`) read them from a
+per-process `FeedHub`, so N watchers cost one producer stream and no
+database queries.
+
+- Redis cache: events are appended to the Redis stream `STREAM_KEY`
+  (`XADD`, trimmed to about `IP_TRACKING_FEED_BUFFER` entries, default
+  1000). Each process that has watchers runs one `FeedReader` thread
+  doing a blocking `XREAD` and fanning the events out to its local
+  watchers. Event ids are the stream ids, so a watcher that reconnects to
+  another worker resumes where it left off.
+- Any other cache: the hub of the publishing process is the only buffer,
+  which is enough for a single-process development server.
+
+Producers only publish while someone watches: hubs with watchers keep
+`ACTIVE_KEY` alive in Redis, and producers check it at most once per
+`IP_TRACKING_FEED_CHECK_INTERVAL` seconds (default: 1).
+
+Events are dicts with the `RequestLogSerializer` fields. A resume point
+older than everything buffered is reported as `reset`: the watcher missed
+events and should reload from `/api/request-logs/`.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.db import connections
+
+from .utils import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+STREAM_KEY = 'ip_tracking:feed'
+ACTIVE_KEY = 'ip_tracking:feed:active'
+# Watching hubs refresh ACTIVE_KEY every ACTIVE_TTL / 3 seconds
+ACTIVE_TTL = 15
+# Precedes every event id
+ORIGIN = '0-0'
+
+
+def parse_event_id(value):
+    """(milliseconds, sequence) of a stream id like '1700000000000-0', or None"""
+    if isinstance(value, bytes):
+        value = value.decode()
+    try:
+        milliseconds, _, sequence = str(value).partition('-')
+        return int(milliseconds), int(sequence or 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def event_for(log):
+    """The feed event of a RequestLog"""
+    return {
+        'id': log.pk,
+        'ip_address': log.ip_address,
+        'timestamp': log.timestamp.isoformat() if log.timestamp else None,
+        'path': log.path,
+        'country': log.country,
+        'city': log.city,
+        'weight': log.weight,
+        'status_code': log.status_code,
+        'method': log.method,
+        'path_category': log.path_category,
+    }
+
+
+class FeedFilter:
+    """Server-side filters of one watcher; empty values match everything"""
+
+    def __init__(self, ip_address=None, path_prefix=None, country=None):
+        self.ip_address = ip_address or None
+        self.path_prefix = path_prefix or None
+        self.country = country or None
+
+    def matches(self, event):
+        return (
+            (self.ip_address is None or event['ip_address'] == self.ip_address)
+            and (self.path_prefix is None or event['path'].startswith(self.path_prefix))
+            and (self.country is None or event['country'] == self.country)
+        )
+
+
+class FeedHub:
+    """
+    Ring buffer of the latest events of this process, shared by all its
+    watchers: each watcher keeps its own cursor (the last event id it
+    saw) and waits on one condition for new events.
+    """
+
+    def __init__(self, size=1000, client=None):
+        self.events = deque(maxlen=size)
+        self.changed = threading.Condition()
+        self.client = client
+        self.watchers = 0
+        self.head = None
+        self.reader = None
+        # Key of the newest event pushed out of the ring
+        self.evicted = None
+        self._local_id = (0, 0)
+
+    def append(self, event_id, event):
+        key = parse_event_id(event_id)
+        with self.changed:
+            if len(self.events) == self.events.maxlen:
+                self.evicted = self.events[0][0]
+            self.events.append((key, event_id, event))
+            self.head = event_id
+            self.changed.notify_all()
+
+    def publish_local(self, event):
+        """Append an event under the next local id (no Redis)"""
+        with self.changed:
+            milliseconds = int(time.time() * 1000)
+            last_milliseconds, sequence = self._local_id
+            self._local_id = (
+                (last_milliseconds, sequence + 1) if milliseconds <= last_milliseconds else (milliseconds, 0)
+            )
+            self.append('%d-%d' % self._local_id, event)
+
+    def latest(self):
+        """Id of the newest event, to start reading "from now\""""
+        if self.head is not None or self.client is None:
+            return self.head or ORIGIN
+        # The reader has not seen anything yet; ask the stream
+        try:
+            entries = self.client.xrevrange(STREAM_KEY, count=1)
+        except Exception as e:
+            logger.warning(f"Live feed lookup failed: {str(e)}")
+            return ORIGIN
+        if not entries:
+            return ORIGIN
+        entry_id = entries[0][0]
+        return entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+
+    def watch(self):
+        """Context manager counting a watcher; starts the reader if needed"""
+        return _Watching(self)
+
+    def read(self, after, feed_filter, timeout, limit=100):
+        """
+        Events after the id `after` (None: from now) that pass
+        feed_filter, waiting up to `timeout` seconds for the first one.
+        Returns (events, cursor, reset): cursor is the id to resume from,
+        past filtered-out events too.
+        """
+        deadline = time.monotonic() + timeout
+        after_key = parse_event_id(after) if after else None
+        cursor = after if after_key is not None else self.latest()
+        with self.changed:
+            while True:
+                result = self._after(cursor, feed_filter, limit)
+                if result is None:
+                    # Older than the buffer: read the stream below
+                    break
+                found, cursor, reset = result
+                remaining = deadline - time.monotonic()
+                if found or reset or remaining <= 0:
+                    return found, cursor, reset
+                self.changed.wait(remaining)
+        # Without the lock, so that other watchers and the reader's
+        # appends do not wait for Redis
+        backfilled = self._backfill(cursor, feed_filter, limit)
+        if backfilled is not None:
+            return backfilled
+        with self.changed:
+            return self._after(cursor, feed_filter, limit, backfill=False)
+
+    def _after(self, cursor, feed_filter, limit, backfill=True):
+        """
+        (events, cursor, reset) from the buffer, or None when the cursor is
+        older than the buffer and the Redis stream should be read instead
+        (unless `backfill` is False). Called with `changed` held.
+        """
+        cursor_key = parse_event_id(cursor) if cursor else None
+        if cursor_key is None:
+            return [], self.head, False
+        newer = []
+        covered = False
+        for key, event_id, event in reversed(self.events):
+            if key <= cursor_key:
+                covered = True
+                break
+            newer.append((event_id, event))
+        reset = False
+        if newer and not covered:
+            # The cursor is older than every buffered event: the events in
+            # between are in the Redis stream, or gone
+            if self.client is not None:
+                if backfill:
+                    return None
+                reset = True
+            elif self.evicted is not None:
+                reset = cursor_key < self.evicted
+            else:
+                # The ring holds every event of this process; a cursor other
+                # than the origin comes from another process
+                reset = cursor_key != (0, 0)
+        newer.reverse()
+        found = []
+        for event_id, event in newer[:limit]:
+            cursor = event_id
+            if feed_filter.matches(event):
+                found.append((event_id, event))
+        return found, cursor, reset
+
+    def _backfill(self, cursor, feed_filter, limit):
+        """
+        Events after the cursor from the Redis stream, as _after() returns
+        them, or None if the stream cannot provide them
+        """
+        try:
+            entries = self.client.xrange(STREAM_KEY, min=f'({cursor}', count=limit)
+            # Unless the cursor's own event is still in the stream, events
+            # between it and the oldest one left may have been trimmed
+            reset = parse_event_id(cursor) != (0, 0) and not self.client.xrange(STREAM_KEY, min=cursor, max=cursor)
+        except Exception as e:
+            logger.warning(f"Live feed backfill failed: {str(e)}")
+            return None
+        if not entries:
+            return None
+        found = []
+        for entry_id, fields in entries:
+            event_id = entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+            cursor = event_id
+            event = json.loads(fields[b'data'] if b'data' in fields else fields['data'])
+            if feed_filter.matches(event):
+                found.append((event_id, event))
+        return found, cursor, reset
+
+
+class _Watching:
+    def __init__(self, hub):
+        self.hub = hub
+
+    def __enter__(self):
+        hub = self.hub
+        with hub.changed:
+            hub.watchers += 1
+            if hub.client is not None and (hub.reader is None or not hub.reader.is_alive()):
+                hub.reader = FeedReader(hub)
+                hub.reader.start()
+        return hub
+
+    def __exit__(self, *exc_info):
+        with self.hub.changed:
+            self.hub.watchers -= 1
+
+
+class FeedReader(threading.Thread):
+    """Background thread moving events from the Redis stream into a hub"""
+
+    def __init__(self, hub):
+        super().__init__(name='ip-tracking-feed', daemon=True)
+        self.hub = hub
+        self.stopped = threading.Event()
+
+    def run(self):
+        backoff = 1.0
+        while not self.stopped.is_set():
+            try:
+                self.listen()
+                backoff = 1.0
+            except Exception as e:
+                logger.warning(f"Live feed reader disconnected: {str(e)}")
+                self.stopped.wait(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+    def listen(self):
+        client = self.hub.client
+        # Resume after the last event seen, so a reconnect loses nothing
+        last_id = self.hub.head or '$'
+        announced = 0.0
+        while not self.stopped.is_set():
+            if self.hub.watchers > 0 and time.monotonic() - announced > ACTIVE_TTL / 3:
+                client.set(ACTIVE_KEY, 1, ex=ACTIVE_TTL)
+                announced = time.monotonic()
+            response = client.xread({STREAM_KEY: last_id}, count=500, block=1000)
+            for _, entries in response or ():
+                for entry_id, fields in entries:
+                    last_id = entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+                    data = fields[b'data'] if b'data' in fields else fields['data']
+                    self.hub.append(last_id, json.loads(data))
+
+    def stop(self):
+        self.stopped.set()
+
+
+_hub = None
+_hub_pid = None
+_hub_lock = threading.Lock()
+_watched = (0.0, False)
+
+
+def get_hub():
+    """Return this process's FeedHub, creating it on first use"""
+    global _hub, _hub_pid
+    pid = os.getpid()
+    if _hub is None or _hub_pid != pid:
+        with _hub_lock:
+            if _hub is None or _hub_pid != pid:
+                # A forked worker has none of its parent's watchers or reader
+                _hub = FeedHub(
+                    size=getattr(settings, 'IP_TRACKING_FEED_BUFFER', 1000),
+                    client=get_redis_client(),
+                )
+                _hub_pid = pid
+    return _hub
+
+
+def is_watched():
+    """Whether any process has watchers, checked at most once per interval"""
+    global _watched
+    checked_at, watched = _watched
+    now = time.monotonic()
+    if now - checked_at < getattr(settings, 'IP_TRACKING_FEED_CHECK_INTERVAL', 1.0):
+        return watched
+    hub = get_hub()
+    try:
+        watched = hub.watchers > 0 if hub.client is None else bool(hub.client.exists(ACTIVE_KEY))
+    except Exception as e:
+        logger.warning(f"Live feed check failed: {str(e)}")
+        watched = False
+    _watched = (now, watched)
+    return watched
+
+
+def publish(log):
+    """Send a logged request to the watchers, if there are any"""
+    if not is_watched():
+        return
+    hub = get_hub()
+    event = event_for(log)
+    if hub.client is None:
+        hub.publish_local(event)
+        return
+    try:
+        hub.client.xadd(
+            STREAM_KEY,
+            {'data': json.dumps(event)},
+            maxlen=getattr(settings, 'IP_TRACKING_FEED_BUFFER', 1000),
+            approximate=True,
+        )
+    except Exception as e:
+        logger.warning(f"Failed to publish request {log.pk} to the live feed: {str(e)}")
+
+
+def format_sse(event_id, event, name='request'):
+    return f'id: {event_id}\nevent: {name}\ndata: {json.dumps(event)}\n\n'
+
+
+def stream(hub, after, feed_filter, heartbeat, max_seconds):
+    """
+    Server-Sent Events for one watcher: matching events as they arrive, a
+    comment line every `heartbeat` seconds, and a `reset` event when the
+    resume point is lost. Ends after `max_seconds`; the EventSource
+    reconnects with Last-Event-ID.
+    """
+    # The stream may last minutes; don't hold a database connection meanwhile
+    connections.close_all()
+    ends_at = time.monotonic() + max_seconds
+    with hub.watch():
+        cursor = after or hub.latest()
+        yield f'retry: {int(heartbeat * 1000)}\n\n'
+        while True:
+            remaining = ends_at - time.monotonic()
+            if remaining <= 0:
+                return
+            events, cursor, reset = hub.read(cursor, feed_filter, min(heartbeat, remaining))
+            if reset:
+                yield format_sse(cursor or '', {'reason': 'resume point no longer buffered'}, 'reset')
+            if not events:
+                yield ': heartbeat\n\n'
+            for event_id, event in events:
+                yield format_sse(event_id, event)
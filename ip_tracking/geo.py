@@ -0,0 +1,99 @@
+"""
+Process-local LRU in front of the shared geolocation cache.
+
+`IPTrackingMiddleware.get_geolocation` caches lookups in the Django cache
+for 24 hours, which on Redis costs a round trip per logged request. The
+most active clients are looked up over and over, so each worker also
+keeps their results in memory: `IP_TRACKING_GEO_LRU_SIZE` entries
+(default 10,000; 0 turns it off) for at most `IP_TRACKING_GEO_LRU_TTL`
+seconds (default 3600).
+
+`preload(ip_addresses)` fills it with one `get_many` on the shared cache;
+the startup warm-up (see `ip_tracking.startup`) uses it for the IPs with
+the most recent traffic.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+# Geolocation results are cached for 24 hours in the shared cache
+CACHE_TIMEOUT = 86400
+
+
+def geo_cache_key(ip_address):
+    return f'geo_{ip_address}'
+
+
+class LocalGeoCache:
+    """Bounded LRU of {ip_address: (stored_at, geo_data)}"""
+
+    def __init__(self, size=10_000, ttl=3600):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, ip_address):
+        entry = self.entries.get(ip_address)
+        if entry is None:
+            return None
+        stored_at, geo_data = entry
+        if time.monotonic() - stored_at > self.ttl:
+            with self.lock:
+                self.entries.pop(ip_address, None)
+            return None
+        with self.lock:
+            if ip_address in self.entries:
+                self.entries.move_to_end(ip_address)
+        return geo_data
+
+    def set_many(self, items):
+        if not self.size:
+            return
+        now = time.monotonic()
+        with self.lock:
+            for ip_address, geo_data in items:
+                self.entries[ip_address] = (now, geo_data)
+                self.entries.move_to_end(ip_address)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def set(self, ip_address, geo_data):
+        self.set_many([(ip_address, geo_data)])
+
+
+_local = None
+_local_pid = None
+
+
+def get_local_geo_cache():
+    """Return this process's LocalGeoCache, creating it on first use"""
+    global _local, _local_pid
+    pid = os.getpid()
+    if _local is None or _local_pid != pid:
+        _local = LocalGeoCache(
+            size=getattr(settings, 'IP_TRACKING_GEO_LRU_SIZE', 10_000),
+            ttl=getattr(settings, 'IP_TRACKING_GEO_LRU_TTL', 3600),
+        )
+        _local_pid = pid
+    return _local
+
+
+def preload(ip_addresses):
+    """
+    Copy the shared cache's entries for ip_addresses into the local LRU.
+    Returns the number of entries loaded.
+    """
+    local = get_local_geo_cache()
+    if not local.size:
+        return 0
+    keys = {geo_cache_key(ip_address): ip_address for ip_address in ip_addresses}
+    found = cache.get_many(list(keys))
+    entries = [(keys[key], geo_data) for key, geo_data in found.items() if geo_data]
+    local.set_many(entries)
+    return len(entries)
@@ -0,0 +1,148 @@
+"""
+Write-behind hit counters for blocked IPs.
+
+Rejecting a blocked client has to stay as cheap as the blocklist check,
+so `record_hit(entry)` only bumps a counter in this process's memory,
+keyed by the blocklist entry that matched (an address, or the CIDR of a
+network block). A
+daemon thread folds the counters into `BlockedIP.hit_count` and
+`BlockedIP.last_hit_at` every `IP_TRACKING_HIT_FLUSH_INTERVAL` seconds
+(default: 30), with one UPDATE per `IP_TRACKING_HIT_FLUSH_BATCH` IPs
+(default: 500) however many hits they got. The gunicorn `worker_exit`
+hook flushes what is left when a worker stops; the hits of a worker that
+is killed outright are lost.
+
+The UPDATE bypasses `save()` and its signals, so counting hits does not
+bump the blocklist version. Clients rejected at the edge from the
+exported files (see `ip_tracking.edge_export`) never reach Django and
+are not counted.
+"""
+
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Case, DateTimeField, F, PositiveBigIntegerField, Value, When
+from django.db.models.functions import Coalesce, Greatest
+
+logger = logging.getLogger(__name__)
+
+
+def write_hits(batch):
+    """
+    Add [(ip_address, (hits, last_hit_timestamp))] to the BlockedIP rows in
+    one UPDATE; a CIDR counts on the row of its network address. Returns
+    the number of rows updated.
+    """
+    from .models import BlockedIP
+
+    batch = [(ip_address.partition('/')[0], entry) for ip_address, entry in batch]
+    hits = Case(
+        *[When(ip_address=ip_address, then=Value(count)) for ip_address, (count, _) in batch],
+        default=Value(0),
+        output_field=PositiveBigIntegerField(),
+    )
+    last_hit = Case(
+        *[
+            When(ip_address=ip_address, then=Value(datetime.fromtimestamp(last, tz=dt_timezone.utc)))
+            for ip_address, (_, last) in batch
+        ],
+        output_field=DateTimeField(),
+    )
+    return BlockedIP.objects.filter(ip_address__in=[ip_address for ip_address, _ in batch]).update(
+        hit_count=F('hit_count') + hits,
+        # Workers flush in any order; never move last_hit_at backwards
+        last_hit_at=Greatest(Coalesce(F('last_hit_at'), last_hit), last_hit),
+    )
+
+
+class HitCounter:
+    """Pending {ip_address: [hits, last_hit_timestamp]} of this process"""
+
+    def __init__(self, interval=30.0, batch_size=500):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.flusher = None
+
+    def record(self, ip_address):
+        now = time.time()
+        with self.lock:
+            entry = self.pending.get(ip_address)
+            if entry is None:
+                self.pending[ip_address] = [1, now]
+            else:
+                entry[0] += 1
+                entry[1] = now
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self._flush_loop, name='ip-tracking-hits', daemon=True)
+                self.flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning(f"Failed to write blocked IP hits: {str(e)}")
+            finally:
+                # This thread's own connection; requests never use it
+                connections.close_all()
+
+    def flush(self):
+        """Write the pending hits to the database; returns the number of IPs"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        items = list(pending.items())
+        written = 0
+        try:
+            for start in range(0, len(items), self.batch_size):
+                write_hits(items[start:start + self.batch_size])
+                written = start + self.batch_size
+        except Exception:
+            # Keep the unwritten hits for the next flush
+            with self.lock:
+                for ip_address, (count, last) in items[written:]:
+                    entry = self.pending.setdefault(ip_address, [0, last])
+                    entry[0] += count
+                    entry[1] = max(entry[1], last)
+            raise
+        return len(items)
+
+
+_counter = None
+_counter_pid = None
+
+
+def get_hit_counter():
+    """Return this process's HitCounter, creating it on first use"""
+    global _counter, _counter_pid
+    pid = os.getpid()
+    if _counter is None or _counter_pid != pid:
+        _counter = HitCounter(
+            interval=getattr(settings, 'IP_TRACKING_HIT_FLUSH_INTERVAL', 30.0),
+            batch_size=getattr(settings, 'IP_TRACKING_HIT_FLUSH_BATCH', 500),
+        )
+        _counter_pid = pid
+    return _counter
+
+
+def record_hit(ip_address):
+    """Count a rejected request on the blocklist entry (address or CIDR) that matched"""
+    get_hit_counter().record(ip_address)
+
+
+def flush_hits():
+    """Write this process's pending hits now, e.g. before it exits"""
+    if _counter is None or _counter_pid != os.getpid():
+        return 0
+    try:
+        return _counter.flush()
+    except Exception as e:
+        logger.warning(f"Failed to write blocked IP hits: {str(e)}")
+        return 0
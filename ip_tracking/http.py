@@ -0,0 +1,84 @@
+"""
+Shared keep-alive HTTP sessions for outbound calls (geolocation).
+
+`get_http_pool(name)` returns a process-wide `HTTPPool`: one
+`requests.Session` whose adapter keeps up to `pool_size` connections alive
+per host, plus a semaphore bounding how many calls run at once. When all
+slots stay busy for `acquire_timeout` seconds the call fails fast with
+`PoolBusy` instead of queueing up request threads.
+
+The session is only used for plain stateless GETs (no cookies or auth
+mutated after creation), which is the thread-safe subset of requests. A
+forked worker gets its own session instead of sharing the parent's
+sockets.
+
+Settings, per pool name, in `IP_TRACKING_HTTP_POOLS`:
+`{'geo': {'max_concurrency': 8, 'pool_size': 8, 'acquire_timeout': 0.5,
+'retries': 1}}`.
+"""
+
+import os
+import threading
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULTS = {
+    'max_concurrency': 8,
+    'pool_size': 8,
+    'acquire_timeout': 0.5,
+    'retries': 1,
+}
+
+
+class PoolBusy(requests.RequestException):
+    """All concurrency slots of the pool stayed busy"""
+
+
+class HTTPPool:
+    def __init__(self, max_concurrency, pool_size, acquire_timeout, retries):
+        self.acquire_timeout = acquire_timeout
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=pool_size,
+            pool_block=True,
+            max_retries=Retry(total=retries, connect=retries, read=0, backoff_factor=0.1),
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, **kwargs):
+        if not self.slots.acquire(timeout=self.acquire_timeout):
+            raise PoolBusy(f'No free connection slot for {url}')
+        try:
+            return self.session.get(url, **kwargs)
+        finally:
+            self.slots.release()
+
+    def close(self):
+        self.session.close()
+
+
+_pools = {}
+_pools_pid = None
+_lock = threading.Lock()
+
+
+def get_http_pool(name):
+    """Return the process-wide pool `name`, creating it on first use"""
+    global _pools, _pools_pid
+    pid = os.getpid()
+    if _pools_pid == pid and name in _pools:
+        return _pools[name]
+    with _lock:
+        if _pools_pid != pid:
+            # Never reuse sockets inherited from the parent process
+            _pools, _pools_pid = {}, pid
+        if name not in _pools:
+            options = {**DEFAULTS, **getattr(settings, 'IP_TRACKING_HTTP_POOLS', {}).get(name, {})}
+            _pools[name] = HTTPPool(**options)
+        return _pools[name]
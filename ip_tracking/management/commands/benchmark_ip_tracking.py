@@ -0,0 +1,182 @@
+import json
+import platform
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from ip_tracking import benchmarks
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the IP tracking hot paths (micro-benchmarks, detect_anomalies, '
+        'statistics view, connection reuse and an in-process load test) and store '
+        'the results as JSON'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--only',
+            choices=['micro', 'macro', 'connections', 'load'],
+            action='append',
+            help='Run only the given section (can be repeated; default: all)'
+        )
+        parser.add_argument(
+            '--dataset',
+            choices=sorted(benchmarks.DATASET_SIZES),
+            help='Seed this many synthetic RequestLog rows before benchmarking'
+        )
+        parser.add_argument(
+            '--rounds',
+            type=int,
+            default=1000,
+            help='Rounds per micro-benchmark (default: 1000)'
+        )
+        parser.add_argument(
+            '--macro-rounds',
+            type=int,
+            default=5,
+            help='Rounds for detect_anomalies and the statistics view (default: 5)'
+        )
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=1000,
+            help='Total requests for the load test (default: 1000)'
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=8,
+            help='Concurrent client threads for the load test (default: 8)'
+        )
+        parser.add_argument(
+            '--path',
+            action='append',
+            dest='paths',
+            help='Path to request during the load test (can be repeated)'
+        )
+        parser.add_argument(
+            '--with-ratelimit',
+            action='store_true',
+            help='Keep rate limiting enabled during the load test'
+        )
+        parser.add_argument(
+            '--output',
+            type=str,
+            help='Write the results to this JSON file'
+        )
+        parser.add_argument(
+            '--compare',
+            type=str,
+            help='Compare against a previous JSON result and fail on regressions'
+        )
+        parser.add_argument(
+            '--threshold',
+            type=float,
+            default=10.0,
+            help='Regression threshold in percent for --compare (default: 10)'
+        )
+        parser.add_argument(
+            '--keep-data',
+            action='store_true',
+            help='Do not delete the synthetic rows afterwards'
+        )
+
+    def handle(self, *args, **options):
+        sections = options['only'] or ['micro', 'macro', 'connections', 'load']
+        results = {
+            'timestamp': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'dataset': options['dataset'],
+        }
+
+        try:
+            if options['dataset']:
+                rows = benchmarks.DATASET_SIZES[options['dataset']]
+                self.stdout.write(f'Seeding {rows} RequestLog rows...')
+                benchmarks.seed_request_logs(rows, stdout=self.stdout)
+
+            if 'micro' in sections:
+                self.stdout.write('Running micro-benchmarks...')
+                results['micro'] = benchmarks.run_micro_benchmarks(options['rounds'])
+                self.print_timings(results['micro'])
+
+            if 'macro' in sections:
+                self.stdout.write('Running detect_anomalies and statistics view...')
+                results['macro'] = benchmarks.run_macro_benchmarks(options['macro_rounds'])
+                self.print_timings(results['macro'])
+
+            if 'connections' in sections:
+                self.stdout.write('Comparing new and persistent DB/HTTP connections...')
+                results['connections'] = benchmarks.run_connection_benchmarks(min(options['rounds'], 200))
+                self.print_timings(results['connections'])
+                saved = (
+                    results['connections']['db.new_connection']['median']
+                    - results['connections']['db.persistent_connection']['median']
+                    + results['connections']['http.new_connection']['median']
+                    - results['connections']['http.pooled_session']['median']
+                )
+                self.stdout.write(f'  connection reuse saves {saved * 1000:.2f} ms per request with a geo miss')
+
+            if 'load' in sections:
+                self.stdout.write(
+                    f"Running load test: {options['requests']} requests, "
+                    f"concurrency {options['concurrency']}..."
+                )
+                overrides = {'ALLOWED_HOSTS': ['testserver'], 'SECURE_SSL_REDIRECT': False}
+                if not options['with_ratelimit']:
+                    overrides['RATELIMIT_ENABLE'] = False
+                with override_settings(**overrides):
+                    results['load'] = {
+                        'wsgi': benchmarks.run_load_test(
+                            paths=options['paths'],
+                            total_requests=options['requests'],
+                            concurrency=options['concurrency'],
+                        )
+                    }
+                self.print_load(results['load']['wsgi'])
+        finally:
+            if not options['keep_data']:
+                deleted = benchmarks.cleanup_benchmark_data()
+                self.stdout.write(f'Removed {deleted} synthetic rows')
+
+        if options['output']:
+            Path(options['output']).write_text(json.dumps(results, indent=2))
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+
+        if options['compare']:
+            baseline = json.loads(Path(options['compare']).read_text())
+            regressions = benchmarks.compare_results(results, baseline, options['threshold'] / 100)
+            if regressions:
+                for name, metric, old, new, change in regressions:
+                    self.stdout.write(self.style.ERROR(
+                        f'{name} {metric}: {old:.6g} -> {new:.6g} ({change:+.1%})'
+                    ))
+                raise CommandError(f'{len(regressions)} regression(s) above {options["threshold"]}%')
+            self.stdout.write(self.style.SUCCESS('No regressions against baseline'))
+
+    def print_timings(self, timings):
+        for name, stats in timings.items():
+            line = (
+                f"  {name:<32} median {stats['median'] * 1e6:10.1f} us   "
+                f"p99 {stats['p99'] * 1e6:10.1f} us   {stats['ops']:12.0f} ops/s"
+            )
+            if 'queries_per_call' in stats:
+                line += f"   {stats['queries_per_call']:.1f} queries"
+            self.stdout.write(line)
+
+    def print_load(self, load):
+        self.stdout.write(
+            f"  {load['requests_per_second']:.1f} req/s   "
+            f"p50 {load['p50'] * 1000:.2f} ms   p99 {load['p99'] * 1000:.2f} ms   "
+            f"{load['queries_per_request']:.2f} queries/request   "
+            f"status codes {load['status_codes']}"
+        )
+        if settings.DEBUG:
+            self.stdout.write(self.style.WARNING('  DEBUG is on; numbers include debug overhead'))
@@ -0,0 +1,159 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import URLPattern, URLResolver, reverse
+
+from ip_tracking import api_urls
+from ip_tracking.benchmarks import benchmark_ip
+from ip_tracking.models import BlockedIP, RequestLog, SuspiciousIP
+from ip_tracking.querybudget import budget_problems, get_n_plus_one_threshold, track_queries
+
+BENCHMARK_IPV6 = '2001:2::1'
+
+
+class Command(BaseCommand):
+    help = (
+        'Request every route in ip_tracking/api_urls.py against seeded data and '
+        'fail if any exceeds its IP_TRACKING_QUERY_BUDGETS entry or repeats a query'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rows',
+            type=int,
+            default=25,
+            help='Rows to seed per model, so per-row queries show up (default: 25)'
+        )
+        parser.add_argument(
+            '--verbose-sql',
+            action='store_true',
+            help='Print the query shapes of every route'
+        )
+
+    def handle(self, *args, **options):
+        budgets = getattr(settings, 'IP_TRACKING_QUERY_BUDGETS', {})
+        max_repeats = get_n_plus_one_threshold() - 1
+        failures = []
+
+        overrides = {
+            'ALLOWED_HOSTS': ['testserver'],
+            'SECURE_SSL_REDIRECT': False,
+            'RATELIMIT_ENABLE': False,
+        }
+        # Everything runs in a transaction that is rolled back at the end
+        with override_settings(**overrides), transaction.atomic():
+            objects = self.seed(options['rows'])
+            client = Client()
+            client.force_login(objects['user'])
+
+            for name, pattern in self.api_routes():
+                method, url, data = self.build_request(name, pattern, objects)
+                body = {'data': data, 'content_type': 'application/json'} if data is not None else {}
+                budget = budgets.get(name)
+                if budget is None:
+                    failures.append(f'{name}: no entry in IP_TRACKING_QUERY_BUDGETS')
+                    self.stdout.write(self.style.ERROR(f'  {name:<28} no budget defined'))
+                    continue
+
+                with track_queries() as tracker:
+                    response = getattr(client, method)(url, REMOTE_ADDR=benchmark_ip(1), **body)
+
+                problems = budget_problems(tracker, budget, max_repeats)
+                if response.status_code >= 400:
+                    problems.append(f'HTTP {response.status_code}')
+                line = f'  {name:<28} {method.upper():<5} {tracker.queries:3d}/{budget:<3d} queries'
+                if problems:
+                    failures.extend(f'{name}: {problem}' for problem in problems)
+                    self.stdout.write(self.style.ERROR(f"{line}   {'; '.join(problems)}"))
+                else:
+                    self.stdout.write(line)
+                if options['verbose_sql']:
+                    for shape, count in tracker.shapes.most_common():
+                        self.stdout.write(f'      {count}x {shape[:160]}')
+
+            transaction.set_rollback(True)
+
+        if failures:
+            raise CommandError(f'{len(failures)} query budget violation(s)')
+        self.stdout.write(self.style.SUCCESS('All API routes are within their query budgets'))
+
+    def seed(self, rows):
+        """Create enough rows that a per-row query would repeat"""
+        user = get_user_model().objects.create_superuser(
+            username='query-budget-check', email='', password=None
+        )
+        # The by-ip/check routes do not accept dots, so use an IPv6 address
+        # from the 2001:2::/48 benchmarking range
+        ip_address = BENCHMARK_IPV6
+        RequestLog.objects.bulk_create(
+            RequestLog(
+                ip_address=benchmark_ip(i % 5) if i % 5 else ip_address,
+                path='/admin/',
+                country='Kenya',
+            )
+            for i in range(rows)
+        )
+        BlockedIP.objects.bulk_create(
+            [BlockedIP(ip_address=ip_address, reason='query budget check')] + [
+                BlockedIP(ip_address=benchmark_ip(1000 + i), reason='query budget check')
+                for i in range(rows - 1)
+            ]
+        )
+        SuspiciousIP.objects.bulk_create(
+            SuspiciousIP(ip_address=benchmark_ip(2000 + i), reason='query budget check')
+            for i in range(rows)
+        )
+        return {
+            'user': user,
+            'ip': ip_address,
+            RequestLog: RequestLog.objects.filter(ip_address=ip_address).first(),
+            BlockedIP: BlockedIP.objects.order_by('id').first(),
+            SuspiciousIP: SuspiciousIP.objects.order_by('id').first(),
+        }
+
+    def api_routes(self):
+        """(url name, URLPattern) for every named route, once per name"""
+        seen = set()
+
+        def walk(patterns):
+            for entry in patterns:
+                if isinstance(entry, URLResolver):
+                    yield from walk(entry.url_patterns)
+                elif isinstance(entry, URLPattern) and entry.name and entry.name not in seen:
+                    seen.add(entry.name)
+                    yield entry.name, entry
+
+        return list(walk(api_urls.urlpatterns))
+
+    def build_request(self, name, pattern, objects):
+        """Pick the HTTP method, fill in the URL arguments and the body of a route"""
+        callback = pattern.callback
+        actions = getattr(callback, 'actions', None) or {'get': None}
+        method = 'get' if 'get' in actions else next(iter(actions))
+
+        kwargs = {}
+        for argument in pattern.pattern.regex.groupindex:
+            if argument == 'pk':
+                model = callback.cls.queryset.model
+                kwargs['pk'] = objects[model].pk
+            elif argument == 'ip':
+                kwargs['ip'] = objects['ip']
+        data = self.payloads(objects).get(name) if method != 'get' else None
+        url = reverse(name, kwargs=kwargs) + self.query_strings().get(name, '')
+        return method, url, data
+
+    def query_strings(self):
+        """Query strings for the routes that need one"""
+        return {
+            # Don't wait for live events that will not come
+            'live-feed': '?timeout=0',
+        }
+
+    def payloads(self, objects):
+        """Request bodies for the routes that need one"""
+        return {
+            'blockedip-check-batch': {'ips': [objects['ip']] + [benchmark_ip(i) for i in range(200)]},
+        }
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ip_tracking.edge_export import FORMATS, active_networks, export, get_export_dir, render
+
+
+class Command(BaseCommand):
+    help = (
+        'Compile the active blocks into nginx, ipset and nftables files, '
+        'collapsed into CIDRs, with incremental diffs since the last export'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--format',
+            action='append',
+            choices=sorted(FORMATS),
+            dest='formats',
+            help='Format to export (repeatable; default: all)'
+        )
+        parser.add_argument(
+            '--output-dir',
+            help='Directory to write to (default: IP_TRACKING_EDGE_EXPORT_DIR)'
+        )
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Rewrite the full files even if nothing changed'
+        )
+        parser.add_argument(
+            '--print',
+            action='store_true',
+            dest='print_only',
+            help='Print the full export of a single --format instead of writing files'
+        )
+
+    def handle(self, *args, **options):
+        formats = options['formats'] or sorted(FORMATS)
+        if options['print_only']:
+            if len(formats) != 1:
+                raise CommandError('--print needs exactly one --format')
+            self.stdout.write(render(formats[0], active_networks()), ending='')
+            return
+
+        output_dir = options['output_dir'] or get_export_dir()
+        result = export(formats, output_dir, full=options['full'])
+        self.stdout.write(
+            f"{result['networks']} networks, +{result['added']} -{result['removed']} "
+            f"since the last export (diff #{result['seq']})"
+        )
+        self.stdout.write(self.style.SUCCESS(f'Exported {", ".join(formats)} to {output_dir}'))
@@ -0,0 +1,130 @@
+import io
+import pstats
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ip_tracking import profiling
+
+
+class Command(BaseCommand):
+    help = (
+        'Enable, disable or inspect the sampling profiler, and summarize the '
+        'top functions across the collected profiles'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'action',
+            choices=['enable', 'disable', 'status', 'summary', 'clear'],
+            help='What to do'
+        )
+        parser.add_argument(
+            '--rate',
+            type=float,
+            default=0.01,
+            help='Fraction of requests/tasks to profile when enabling (default: 0.01)'
+        )
+        parser.add_argument(
+            '--minutes',
+            type=float,
+            default=10,
+            help='How long to keep profiling enabled (default: 10)'
+        )
+        parser.add_argument(
+            '--kind',
+            choices=['request', 'task'],
+            help='Only summarize request or task profiles'
+        )
+        parser.add_argument(
+            '--match',
+            type=str,
+            help='Only summarize profiles whose file name contains this text'
+        )
+        parser.add_argument(
+            '--sort',
+            choices=['cumulative', 'tottime', 'calls'],
+            default='cumulative',
+            help='Sort order for the summary (default: cumulative)'
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=30,
+            help='Number of functions to show (default: 30)'
+        )
+        parser.add_argument(
+            '--output',
+            type=str,
+            help='Also write the merged profile to this file (for snakeviz etc.)'
+        )
+
+    def handle(self, *args, **options):
+        getattr(self, f"handle_{options['action']}")(options)
+
+    def handle_enable(self, options):
+        rate = options['rate']
+        if not 0 < rate <= 1:
+            raise CommandError('--rate must be in (0, 1]')
+        profiling.enable_runtime_profiling(rate, options['minutes'] * 60)
+        self.stdout.write(self.style.SUCCESS(
+            f"Profiling {rate:.2%} of requests and tasks for {options['minutes']:g} minutes"
+        ))
+        self.stdout.write(f'Profiles are written to {profiling.get_profile_dir()}')
+
+    def handle_disable(self, options):
+        profiling.disable_runtime_profiling()
+        self.stdout.write(self.style.SUCCESS('Runtime profiling disabled'))
+
+    def handle_status(self, options):
+        state = profiling.get_runtime_profiling()
+        if state:
+            remaining = (state['until'] - time.time()) / 60
+            self.stdout.write(f"Runtime profiling: {state['rate']:.2%} for {remaining:.1f} more minutes")
+        else:
+            self.stdout.write('Runtime profiling: off')
+        static_rate = profiling.get_sampler().static_rate
+        self.stdout.write(f'Static sample rate: {static_rate:.2%}')
+        self.stdout.write(f'Collected profiles: {len(self.profile_files(options))}')
+
+    def handle_clear(self, options):
+        files = self.profile_files(options)
+        for path in files:
+            path.unlink(missing_ok=True)
+        self.stdout.write(self.style.SUCCESS(f'Removed {len(files)} profile(s)'))
+
+    def handle_summary(self, options):
+        files = self.profile_files(options)
+        if not files:
+            raise CommandError(f'No profiles found in {profiling.get_profile_dir()}')
+
+        stream = io.StringIO()
+        stats = None
+        for path in files:
+            try:
+                if stats is None:
+                    stats = pstats.Stats(str(path), stream=stream)
+                else:
+                    stats.add(str(path))
+            except (OSError, TypeError, EOFError, ValueError) as e:
+                self.stdout.write(self.style.WARNING(f'Skipping {path.name}: {str(e)}'))
+        if stats is None:
+            raise CommandError('None of the profiles could be read')
+
+        self.stdout.write(f'Aggregated {len(files)} profile(s), {stats.total_tt:.3f}s total')
+        stats.strip_dirs().sort_stats(options['sort']).print_stats(options['limit'])
+        self.stdout.write(stream.getvalue())
+
+        if options['output']:
+            stats.dump_stats(options['output'])
+            self.stdout.write(self.style.SUCCESS(f"Merged profile written to {options['output']}"))
+
+    def profile_files(self, options):
+        directory = profiling.get_profile_dir()
+        if not directory.is_dir():
+            return []
+        pattern = f"{options['kind']}-*.prof" if options['kind'] else '*.prof'
+        files = sorted(directory.glob(pattern))
+        if options['match']:
+            files = [path for path in files if options['match'] in path.name]
+        return files
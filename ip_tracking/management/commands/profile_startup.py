@@ -0,0 +1,96 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ip_tracking import startup
+
+
+class Command(BaseCommand):
+    help = (
+        'Report what a worker spends importing modules at startup, measured '
+        'with python -X importtime in a fresh interpreter'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--module',
+            action='append',
+            dest='modules',
+            help='Module to import after django.setup(); repeatable '
+                 '(default: the WSGI module and the root URLconf)'
+        )
+        parser.add_argument(
+            '--runs',
+            type=int,
+            default=3,
+            help='Interpreters to start; the fastest time of each module is kept (default: 3)'
+        )
+        parser.add_argument(
+            '--sort',
+            choices=['cumulative', 'self'],
+            default='cumulative',
+            help='Sort order (default: cumulative)'
+        )
+        parser.add_argument(
+            '--packages',
+            action='store_true',
+            help='Sum the self time per top-level package instead of listing modules'
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=30,
+            help='Number of rows to show (default: 30)'
+        )
+        parser.add_argument(
+            '--budget-ms',
+            type=float,
+            help='Fail if the total import time is above this many milliseconds'
+        )
+
+    def handle(self, *args, **options):
+        modules = options['modules'] or startup.default_modules()
+        if options['runs'] < 1:
+            raise CommandError('--runs must be at least 1')
+
+        # Fastest (self, cumulative) per module over the runs; imports are noisy
+        best = {}
+        for _ in range(options['runs']):
+            try:
+                rows = startup.measure_imports(modules)
+            except RuntimeError as e:
+                raise CommandError(f'Importing {", ".join(modules)} failed: {str(e)}')
+            for module, self_us, cumulative_us, depth in rows:
+                if module in best:
+                    previous = best[module]
+                    best[module] = (min(previous[0], self_us), min(previous[1], cumulative_us), depth)
+                else:
+                    best[module] = (self_us, cumulative_us, depth)
+
+        total_ms = sum(self_us for self_us, _, _ in best.values()) / 1000
+        self.stdout.write(
+            f'Imported {len(best)} modules in {total_ms:.1f}ms '
+            f'(fastest of {options["runs"]} run(s)): {", ".join(modules)}'
+        )
+
+        if options['packages']:
+            packages = defaultdict(lambda: [0, 0])
+            for module, (self_us, _, _) in best.items():
+                package = packages[module.split('.', 1)[0]]
+                package[0] += self_us
+                package[1] += 1
+            self.stdout.write(f'{"self ms":>10}  {"modules":>7}  package')
+            for package, (self_us, count) in sorted(packages.items(), key=lambda item: -item[1][0])[:options['limit']]:
+                self.stdout.write(f'{self_us / 1000:>10.1f}  {count:>7}  {package}')
+        else:
+            column = 0 if options['sort'] == 'self' else 1
+            ordered = sorted(best.items(), key=lambda item: -item[1][column])
+            self.stdout.write(f'{"self ms":>10}  {"cumul. ms":>10}  module')
+            for module, (self_us, cumulative_us, _) in ordered[:options['limit']]:
+                self.stdout.write(f'{self_us / 1000:>10.1f}  {cumulative_us / 1000:>10.1f}  {module}')
+
+        budget = options['budget_ms']
+        if budget is not None:
+            if total_ms > budget:
+                raise CommandError(f'Startup imports take {total_ms:.1f}ms, over the {budget:g}ms budget')
+            self.stdout.write(self.style.SUCCESS(f'Within the {budget:g}ms budget'))
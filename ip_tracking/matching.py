@@ -0,0 +1,101 @@
+"""
+Compiled path matchers shared by the request logging, rate limiting and
+path classification rules.
+
+Rules are declared in settings as plain prefixes or regular expressions and
+compiled once, when the middleware is instantiated, so that each request
+costs a single trie walk plus at most one combined regex match.
+"""
+
+import re
+
+
+class PrefixTrie:
+    """
+    Character trie mapping path prefixes to values.
+
+    `longest_match()` walks the path once and returns the value attached to
+    the longest prefix that matches, which makes rule precedence independent
+    of declaration order.
+    """
+
+    __slots__ = ('_root', '_size')
+
+    _VALUE = object()
+
+    def __init__(self):
+        self._root = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def insert(self, prefix, value):
+        """Attach value to prefix, replacing any previous value"""
+        node = self._root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        if self._VALUE not in node:
+            self._size += 1
+        node[self._VALUE] = value
+
+    def longest_match(self, path, default=None):
+        """Return the value of the longest prefix of path, or default"""
+        node = self._root
+        found = node.get(self._VALUE, default)
+        for char in path:
+            node = node.get(char)
+            if node is None:
+                break
+            if self._VALUE in node:
+                found = node[self._VALUE]
+        return found
+
+    def all_matches(self, path):
+        """Return the values of every prefix of path, shortest first"""
+        node = self._root
+        found = []
+        if self._VALUE in node:
+            found.append(node[self._VALUE])
+        for char in path:
+            node = node.get(char)
+            if node is None:
+                break
+            if self._VALUE in node:
+                found.append(node[self._VALUE])
+        return found
+
+
+class RegexSet:
+    """
+    Ordered set of regular expressions compiled into one alternation.
+
+    `first_match()` returns the value of the first pattern (in declaration
+    order) that matches, using a single call into the regex engine.
+    """
+
+    __slots__ = ('_pattern', '_values')
+
+    def __init__(self, patterns):
+        patterns = list(patterns)
+        self._values = {}
+        groups = []
+        for index, (pattern, value) in enumerate(patterns):
+            # Validate each pattern on its own so errors point at the rule
+            re.compile(pattern)
+            name = f'r{index}'
+            groups.append(f'(?P<{name}>{pattern})')
+            self._values[name] = value
+        self._pattern = re.compile('|'.join(groups)) if groups else None
+
+    def __len__(self):
+        return len(self._values)
+
+    def first_match(self, path, default=None):
+        """Return the value of the first pattern matching path, or default"""
+        if self._pattern is None:
+            return default
+        match = self._pattern.match(path)
+        if match is None:
+            return default
+        return self._values[match.lastgroup]
@@ -0,0 +1,414 @@
+"""
+Low-overhead in-process metrics with Prometheus text exposition.
+
+Counters, gauges and histograms are plain in-memory structures guarded by a
+per-metric lock; recording a value costs a dict update. Timers use the
+monotonic `time.perf_counter()` clock.
+
+Multi-process (gunicorn, Celery): when `IP_TRACKING_METRICS_DIR` is set,
+a daemon thread in each process writes a snapshot of its values to
+`<dir>/<pid>.json` every `IP_TRACKING_METRICS_FLUSH_INTERVAL` seconds
+(default: 5). The `/metrics` endpoint merges every snapshot in the
+directory with the serving process's live values. When a process exits,
+`mark_process_dead(pid)` folds its counters and histograms into
+`<dir>/aggregate.json` and deletes its snapshot, so totals stay monotonic,
+the directory does not grow with every restart and a new process reusing
+the pid starts from zero; its gauges are dropped. The gunicorn
+`child_exit` hook does this for workers, and `/metrics` for any other
+process it finds dead. Without the setting, only the serving process is
+reported.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+
+class Metric:
+    """Base class: a named family of samples keyed by label values"""
+
+    type = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def snapshot(self):
+        with self.lock:
+            return {json.dumps(key): self._copy(value) for key, value in self.values.items()}
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+
+class Counter(Metric):
+    type = COUNTER
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = GAUGE
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    """
+    Fixed-bucket histogram. Values are stored per label set as
+    [count per bucket..., count above the last bucket, sum].
+    """
+
+    type = HISTOGRAM
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = len(self.buckets)
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = position
+                break
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    @staticmethod
+    def _copy(value):
+        return list(value)
+
+
+class Registry:
+    """Holds the metrics of this process and renders the merged view"""
+
+    def __init__(self):
+        self.metrics = {}
+        self.flusher = None
+        self.started = False
+        self.lock = threading.Lock()
+        # Forked workers must not report the parent's values as their own
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self.lock = threading.Lock()
+        self.started = False
+        self.flusher = None
+        for metric in self.metrics.values():
+            metric.lock = threading.Lock()
+            metric.values = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self.register(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=()):
+        return self.register(Gauge(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    # Multi-process support
+
+    def ensure_flusher(self):
+        """
+        Start the snapshot thread in this process if a directory is set.
+        Cheap to call repeatedly: callers can check `started` first.
+        """
+        if self.started:
+            return
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+            directory = get_metrics_dir()
+            if directory is None:
+                return
+            interval = getattr(settings, 'IP_TRACKING_METRICS_FLUSH_INTERVAL', 5.0)
+            self.flusher = threading.Thread(
+                target=self._flush_loop, args=(directory, interval),
+                name='ip-tracking-metrics', daemon=True,
+            )
+            self.flusher.start()
+
+    def _flush_loop(self, directory, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.flush(directory)
+            except Exception as e:
+                logger.warning(f"Failed to write metrics snapshot: {str(e)}")
+
+    def flush(self, directory):
+        directory.mkdir(parents=True, exist_ok=True)
+        _write_json(directory / f'{os.getpid()}.json', self.snapshot())
+
+    def merge(self, merged, snapshot, alive=True):
+        """Add a snapshot to merged; gauges only count for live processes"""
+        for name, samples in snapshot.items():
+            metric = self.metrics.get(name)
+            if metric is None or (metric.type == GAUGE and not alive):
+                continue
+            target = merged.setdefault(name, {})
+            for key, value in samples.items():
+                if metric.type == HISTOGRAM:
+                    current = target.get(key)
+                    target[key] = value if current is None else [a + b for a, b in zip(current, value)]
+                else:
+                    target[key] = target.get(key, 0) + value
+        return merged
+
+    def mark_process_dead(self, pid, directory):
+        """Fold an exited process's snapshot into the aggregate and delete it"""
+        path = directory / f'{pid}.json'
+        with _locked(directory):
+            try:
+                snapshot = json.loads(path.read_text())
+            except FileNotFoundError:
+                return
+            except (OSError, ValueError):
+                # A torn snapshot; its values are lost either way
+                snapshot = {}
+            aggregate = _read_json(directory / AGGREGATE)
+            _write_json(directory / AGGREGATE, self.merge(aggregate, snapshot, alive=False))
+            path.unlink()
+
+    def collect(self):
+        """
+        Merge the aggregate of exited processes and the snapshots of the
+        others with the live values of this one. Snapshots of processes
+        that are gone are folded into the aggregate first.
+        Returns {name: {label_key: value}}.
+        """
+        merged = {}
+        own_pid = os.getpid()
+        directory = get_metrics_dir()
+        if directory is not None and directory.is_dir():
+            for path in directory.glob('*.json'):
+                try:
+                    pid = int(path.stem)
+                except ValueError:
+                    continue
+                if pid != own_pid and not _pid_alive(pid):
+                    self.mark_process_dead(pid, directory)
+            # Locked, so that a snapshot is never counted both on its own
+            # and in the aggregate while child_exit folds it
+            with _locked(directory):
+                self.merge(merged, _read_json(directory / AGGREGATE), alive=False)
+                for path in directory.glob('*.json'):
+                    try:
+                        pid = int(path.stem)
+                    except ValueError:
+                        continue
+                    if pid != own_pid:
+                        self.merge(merged, _read_json(path))
+        return self.merge(merged, self.snapshot())
+
+    def render(self):
+        """Render all metrics in the Prometheus text exposition format"""
+        lines = []
+        collected = self.collect()
+        for name, metric in self.metrics.items():
+            lines.append(f'# HELP {name} {metric.help}')
+            lines.append(f'# TYPE {name} {metric.type}')
+            for key, value in sorted(collected.get(name, {}).items()):
+                labels = dict(zip(metric.label_names, json.loads(key)))
+                if metric.type == HISTOGRAM:
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets + (float('inf'),), value[:-1]):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f'{name}_bucket{_labels({**labels, "le": le})} {cumulative}')
+                    lines.append(f'{name}_sum{_labels(labels)} {value[-1]}')
+                    lines.append(f'{name}_count{_labels(labels)} {cumulative}')
+                else:
+                    lines.append(f'{name}{_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+    return '{' + pairs + '}'
+
+
+AGGREGATE = 'aggregate.json'
+
+
+def _read_json(path):
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_json(path, data):
+    temporary = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    temporary.write_text(json.dumps(data))
+    os.replace(temporary, path)
+
+
+@contextmanager
+def _locked(directory):
+    """Exclusive lock on the metrics directory, across processes"""
+    if fcntl is None:
+        yield
+        return
+    with open(directory / '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def get_metrics_dir():
+    directory = getattr(settings, 'IP_TRACKING_METRICS_DIR', None)
+    return Path(directory) if directory else None
+
+
+def mark_process_dead(pid):
+    """
+    Fold the snapshot of the exited process `pid` into the aggregate, like
+    prometheus_client's `mark_process_dead`. Called by the gunicorn
+    `child_exit` hook before the pid can be reused.
+    """
+    directory = get_metrics_dir()
+    if directory is not None and directory.is_dir():
+        REGISTRY.mark_process_dead(pid, directory)
+
+
+def flush_metrics():
+    """Write this process's snapshot now, e.g. before it exits"""
+    directory = get_metrics_dir()
+    if directory is not None and REGISTRY.started:
+        try:
+            REGISTRY.flush(directory)
+        except OSError as e:
+            logger.warning(f"Failed to write metrics snapshot: {str(e)}")
+
+
+REGISTRY = Registry()
+
+# Middleware
+REQUESTS = REGISTRY.counter(
+    'ip_tracking_requests_total',
+    'Requests seen by IPTrackingMiddleware by outcome (logged, skipped, blocked)',
+    labels=('outcome',),
+)
+MIDDLEWARE_SECONDS = REGISTRY.histogram(
+    'ip_tracking_middleware_seconds',
+    'Time spent in IPTrackingMiddleware itself, excluding the view',
+)
+BLOCKLIST_CHECK_SECONDS = REGISTRY.histogram(
+    'ip_tracking_blocklist_check_seconds',
+    'Time spent checking the client IP against the blocklist',
+    buckets=(0.000001, 0.000005, 0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.01, 0.1),
+)
+GEO_LOOKUP_SECONDS = REGISTRY.histogram(
+    'ip_tracking_geo_lookup_seconds',
+    'Time spent resolving geolocation, including cache lookups',
+)
+GEO_CACHE = REGISTRY.counter(
+    'ip_tracking_geo_cache_total',
+    'Geolocation cache lookups by result (hit or miss)',
+    labels=('result',),
+)
+GEO_REQUESTS = REGISTRY.counter(
+    'ip_tracking_geo_requests_total',
+    'Outbound geolocation API calls by outcome (ok, error, busy)',
+    labels=('outcome',),
+)
+LOG_INSERT_SECONDS = REGISTRY.histogram(
+    'ip_tracking_log_insert_seconds',
+    'Latency of the RequestLog database insert',
+)
+LOG_QUEUE_DEPTH = REGISTRY.gauge(
+    'ip_tracking_log_queue_depth',
+    'Request log writes in progress (logs are written synchronously by each request)',
+)
+RATE_LIMITED = REGISTRY.counter(
+    'ip_tracking_rate_limited_total',
+    'Requests rejected by the rate limiter',
+)
+
+# Celery tasks
+DETECT_ANOMALIES_SECONDS = REGISTRY.histogram(
+    'ip_tracking_detect_anomalies_seconds',
+    'Duration of detect_anomalies runs',
+    buckets=(0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 1800.0, 3600.0),
+)
+ANOMALIES_FLAGGED = REGISTRY.counter(
+    'ip_tracking_anomalies_flagged_total',
+    'IPs flagged by detect_anomalies by kind',
+    labels=('kind',),
+)
@@ -1,8 +1,15 @@
 from django.http import HttpResponseForbidden
 from django.core.cache import cache
-from .models import RequestLog, BlockedIP
-import requests
+from .models import RequestLog
+from .blocklist import get_blocklist
+from .geo import CACHE_TIMEOUT, geo_cache_key, get_local_geo_cache
+from .hits import record_hit
+from .paths import PathClassifier
+from .sampling import LogRuleSet
+from .utils import get_client_ip, is_public_ip
+from . import feed, metrics
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -10,36 +17,91 @@ logger = logging.getLogger(__name__)
 class IPTrackingMiddleware:
     """
     Middleware to log IP address, timestamp, path, and geolocation data of every incoming request.
-    Also blocks requests from blacklisted IPs.
+    Also blocks requests from blacklisted IPs, counting the rejections per
+    blocked IP in memory (see `ip_tracking.hits`).
+
+    Requests are logged after the view has run, so the log includes the
+    response status code (and the method, so that failed logins answered
+    with 200 can be told from page loads).
+
+    Which requests get logged is decided by the rules in
+    `IP_TRACKING_LOG_RULES` (see `ip_tracking.sampling`), compiled once here.
+    Logged paths are classified by `IP_TRACKING_PATH_CATEGORIES` (see
+    `ip_tracking.paths`) into the indexed `path_category` column.
+
+    Time spent in the blocklist check, geolocation and log insert is
+    recorded in `ip_tracking.metrics`. Logged requests are also published
+    to the live feed (`ip_tracking.feed`) while anyone watches it.
+
+    The HTTP client for geolocation (`requests`, see `ip_tracking.http`) is
+    only imported on the first lookup that misses the caches, so it does
+    not slow down worker startup.
     """
     
     def __init__(self, get_response):
         self.get_response = get_response
+        self.log_rules = LogRuleSet.from_settings()
+        self.path_classifier = PathClassifier.from_settings()
 
     def __call__(self, request):
+        if not metrics.REGISTRY.started:
+            metrics.REGISTRY.ensure_flusher()
+        started = time.perf_counter()
+        
         # Get the client IP address
         ip_address = self.get_client_ip(request)
+        request.client_ip = ip_address
         
-        # Check if the IP is blocked
-        if BlockedIP.objects.filter(ip_address=ip_address).exists():
+        # Check if the IP is blocked (in-memory, refreshed on version bumps)
+        check_started = time.perf_counter()
+        blocked_by = get_blocklist().blocked_by(ip_address)
+        metrics.BLOCKLIST_CHECK_SECONDS.observe(time.perf_counter() - check_started)
+        if blocked_by is not None:
+            metrics.REQUESTS.inc('blocked')
+            # Counted on the address or network block that matched
+            record_hit(blocked_by)
+            metrics.MIDDLEWARE_SECONDS.observe(time.perf_counter() - started)
             return HttpResponseForbidden("Your IP address has been blocked.")
         
-        # Get the request path
-        path = request.path
+        overhead = time.perf_counter() - started
         
-        # Get geolocation data (cached for 24 hours)
-        geo_data = self.get_geolocation(ip_address)
+        # Process the request; it is logged afterwards to record the status
+        response = self.get_response(request)
         
-        # Log the request
-        RequestLog.objects.create(
-            ip_address=ip_address,
-            path=path,
-            country=geo_data.get('country'),
-            city=geo_data.get('city')
-        )
+        started = time.perf_counter()
         
-        # Process the request
-        response = self.get_response(request)
+        # Get the request path
+        path = request.path
+        
+        # Skip or sample the request according to the log rules
+        weight = self.log_rules.weight_for(path)
+        if weight:
+            # Get geolocation data (cached for 24 hours)
+            with metrics.GEO_LOOKUP_SECONDS.time():
+                geo_data = self.get_geolocation(ip_address)
+            
+            # Log the request
+            metrics.LOG_QUEUE_DEPTH.inc()
+            try:
+                with metrics.LOG_INSERT_SECONDS.time():
+                    log = RequestLog.objects.create(
+                        ip_address=ip_address,
+                        path=path,
+                        path_category=self.path_classifier.category_for(path),
+                        country=geo_data.get('country'),
+                        city=geo_data.get('city'),
+                        weight=weight,
+                        status_code=response.status_code,
+                        method=request.method
+                    )
+            finally:
+                metrics.LOG_QUEUE_DEPTH.dec()
+            # Live feed watchers (see ip_tracking.feed); free when nobody watches
+            feed.publish(log)
+            metrics.REQUESTS.inc('logged')
+        else:
+            metrics.REQUESTS.inc('skipped')
+        metrics.MIDDLEWARE_SECONDS.observe(overhead + time.perf_counter() - started)
         
         return response
 
@@ -48,40 +110,45 @@ class IPTrackingMiddleware:
         Extract the client's IP address from the request.
         Handles cases where the request comes through a proxy.
         """
-        x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-        if x_forwarded_for:
-            # Get the first IP in the list (client IP)
-            ip = x_forwarded_for.split(',')[0].strip()
-        else:
-            # Fall back to REMOTE_ADDR
-            ip = request.META.get('REMOTE_ADDR')
-        
-        return ip
+        return get_client_ip(request)
 
     def get_geolocation(self, ip_address):
         """
         Get geolocation data for an IP address.
-        Results are cached for 24 hours to reduce API calls.
+        Results are cached for 24 hours to reduce API calls, and the
+        worker keeps the most used ones in memory (see `ip_tracking.geo`).
         """
+        local = get_local_geo_cache()
+        cached_data = local.get(ip_address)
+        if cached_data:
+            metrics.GEO_CACHE.inc('hit')
+            return cached_data
+
         # Check cache first (24 hours = 86400 seconds)
-        cache_key = f'geo_{ip_address}'
+        cache_key = geo_cache_key(ip_address)
         cached_data = cache.get(cache_key)
         
         if cached_data:
+            metrics.GEO_CACHE.inc('hit')
+            local.set(ip_address, cached_data)
             return cached_data
+        metrics.GEO_CACHE.inc('miss')
         
         # Default values
         geo_data = {'country': None, 'city': None}
         
         # Skip geolocation for local/private IPs
-        if ip_address in ['127.0.0.1', 'localhost', '::1'] or ip_address.startswith('192.168.'):
-            cache.set(cache_key, geo_data, 86400)
+        if not is_public_ip(ip_address):
+            cache.set(cache_key, geo_data, CACHE_TIMEOUT)
             return geo_data
         
+        from .http import PoolBusy, get_http_pool
+
         try:
             # Using ip-api.com free service (no API key required)
             # For production, consider using django-ipgeolocation or paid service
-            response = requests.get(
+            # The shared session keeps connections alive between lookups
+            response = get_http_pool('geo').get(
                 f'http://ip-api.com/json/{ip_address}',
                 timeout=2
             )
@@ -93,10 +160,16 @@ class IPTrackingMiddleware:
                         'country': data.get('country'),
                         'city': data.get('city')
                     }
+            metrics.GEO_REQUESTS.inc('ok')
+        except PoolBusy:
+            # Too many lookups in flight; log without location, retry next time
+            metrics.GEO_REQUESTS.inc('busy')
+            return geo_data
         except Exception as e:
+            metrics.GEO_REQUESTS.inc('error')
             logger.warning(f"Failed to get geolocation for {ip_address}: {str(e)}")
         
         # Cache the result for 24 hours
-        cache.set(cache_key, geo_data, 86400)
+        cache.set(cache_key, geo_data, CACHE_TIMEOUT)
         
         return geo_data
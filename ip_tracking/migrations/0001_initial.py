@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BlockedIP',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ip_address', models.GenericIPAddressField(help_text='IP address to block', unique=True)),
+                ('reason', models.TextField(blank=True, help_text='Reason for blocking this IP address', null=True)),
+                ('blocked_at', models.DateTimeField(auto_now_add=True, help_text='Timestamp when the IP was blocked')),
+            ],
+            options={
+                'verbose_name': 'Blocked IP',
+                'verbose_name_plural': 'Blocked IPs',
+                'ordering': ['-blocked_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='RequestLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ip_address', models.GenericIPAddressField(help_text='IP address of the client making the request')),
+                ('timestamp', models.DateTimeField(auto_now_add=True, help_text='Timestamp when the request was made')),
+                ('path', models.CharField(help_text='URL path of the request', max_length=500)),
+                ('country', models.CharField(blank=True, help_text='Country of the IP address', max_length=100, null=True)),
+                ('city', models.CharField(blank=True, help_text='City of the IP address', max_length=100, null=True)),
+            ],
+            options={
+                'verbose_name': 'Request Log',
+                'verbose_name_plural': 'Request Logs',
+                'ordering': ['-timestamp'],
+            },
+        ),
+        migrations.CreateModel(
+            name='SuspiciousIP',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ip_address', models.GenericIPAddressField(help_text='Suspicious IP address')),
+                ('reason', models.TextField(help_text='Reason why this IP was flagged as suspicious')),
+                ('flagged_at', models.DateTimeField(auto_now_add=True, help_text='Timestamp when the IP was flagged')),
+                ('resolved', models.BooleanField(default=False, help_text='Whether this suspicious activity has been reviewed/resolved')),
+            ],
+            options={
+                'verbose_name': 'Suspicious IP',
+                'verbose_name_plural': 'Suspicious IPs',
+                'ordering': ['-flagged_at'],
+            },
+        ),
+    ]
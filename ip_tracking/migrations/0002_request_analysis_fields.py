@@ -0,0 +1,94 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:33
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F
+
+
+def backfill_last_seen(apps, schema_editor):
+    """Flags raised before last_seen existed were last seen when raised"""
+    SuspiciousIP = apps.get_model('ip_tracking', 'SuspiciousIP')
+    SuspiciousIP.objects.update(last_seen=F('flagged_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ip_tracking', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blockedip',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, db_index=True, help_text='When a temporary block ends (empty for permanent blocks)', null=True),
+        ),
+        migrations.AddField(
+            model_name='blockedip',
+            name='hit_count',
+            field=models.PositiveBigIntegerField(default=0, help_text='Requests rejected because of this block (written behind, see ip_tracking/hits.py)'),
+        ),
+        migrations.AddField(
+            model_name='blockedip',
+            name='last_hit_at',
+            field=models.DateTimeField(blank=True, help_text='When a request was last rejected because of this block', null=True),
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='ip_bucket',
+            field=models.PositiveSmallIntegerField(blank=True, help_text='Hash bucket of the IP address, used to shard anomaly detection', null=True),
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='ip_key',
+            field=models.BigIntegerField(blank=True, help_text='IP address as an integer (the first 64 bits for IPv6), used to group requests by network', null=True),
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='ip_version',
+            field=models.PositiveSmallIntegerField(blank=True, help_text='IP version (4 or 6) that ip_key belongs to', null=True),
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='path_category',
+            field=models.CharField(blank=True, help_text='Category of the path (e.g. admin, auth, probe), set when the request is logged', max_length=32, null=True),
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='status_code',
+            field=models.PositiveSmallIntegerField(blank=True, help_text='HTTP status code of the response', null=True),
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='weight',
+            field=models.PositiveIntegerField(default=1, help_text='Number of requests this row represents (greater than 1 for sampled paths)'),
+        ),
+        migrations.AddField(
+            model_name='suspiciousip',
+            name='category',
+            field=models.CharField(blank=True, db_index=True, help_text='Anomaly rule that raised the flag (empty for manual flags)', max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='suspiciousip',
+            name='hit_count',
+            field=models.PositiveIntegerField(default=1, help_text='Number of detection runs that reported this flag while it was unresolved'),
+        ),
+        migrations.AddField(
+            model_name='suspiciousip',
+            name='last_seen',
+            field=models.DateTimeField(default=django.utils.timezone.now, help_text='When a detection run last reported this flag'),
+        ),
+        migrations.RunPython(backfill_last_seen, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='requestlog',
+            index=models.Index(fields=['timestamp', 'ip_bucket'], name='requestlog_time_bucket_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='requestlog',
+            index=models.Index(fields=['path_category', 'timestamp'], name='requestlog_category_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='requestlog',
+            index=models.Index(fields=['ip_version', 'ip_key', 'timestamp'], name='requestlog_ip_key_time_idx'),
+        ),
+    ]
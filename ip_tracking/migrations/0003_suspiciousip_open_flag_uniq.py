@@ -0,0 +1,46 @@
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def merge_open_flags(apps, schema_editor):
+    """
+    Fold duplicate open flags of one IP and rule into the oldest one, so
+    that the unique constraint below can be created. The kept flag adds
+    up the hit counts and takes the latest last_seen and reason.
+    """
+    SuspiciousIP = apps.get_model('ip_tracking', 'SuspiciousIP')
+    open_flags = SuspiciousIP.objects.filter(resolved=False, category__isnull=False)
+    duplicates = (
+        open_flags.order_by()
+        .values('ip_address', 'category')
+        .annotate(flags=Count('id'))
+        .filter(flags__gt=1)
+    )
+    for group in duplicates.iterator():
+        flags = list(
+            open_flags.filter(ip_address=group['ip_address'], category=group['category'])
+            .order_by('flagged_at', 'id')
+        )
+        kept = flags[0]
+        latest = max(flags, key=lambda flag: flag.last_seen)
+        kept.hit_count = sum(flag.hit_count for flag in flags)
+        kept.last_seen = latest.last_seen
+        kept.reason = latest.reason
+        kept.save(update_fields=['hit_count', 'last_seen', 'reason'])
+        SuspiciousIP.objects.filter(id__in=[flag.id for flag in flags[1:]]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ip_tracking', '0002_request_analysis_fields'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_open_flags, migrations.RunPython.noop),
+        # detection.upsert_flags relies on it for INSERT ... ON CONFLICT
+        migrations.AddConstraint(
+            model_name='suspiciousip',
+            constraint=models.UniqueConstraint(condition=models.Q(('resolved', False)), fields=('ip_address', 'category'), name='suspiciousip_open_flag_uniq'),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ip_tracking', '0003_suspiciousip_open_flag_uniq'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='requestlog',
+            name='method',
+            field=models.CharField(blank=True, help_text='HTTP method of the request', max_length=10, null=True),
+        ),
+    ]
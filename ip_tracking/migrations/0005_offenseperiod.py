@@ -0,0 +1,28 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ip_tracking', '0004_requestlog_method'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OffensePeriod',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ip_address', models.GenericIPAddressField(help_text='IP address reported by detection')),
+                ('period', models.DateTimeField(help_text='Start of the hour the detection window began in')),
+                ('recorded_at', models.DateTimeField(default=django.utils.timezone.now, help_text='When a detection run first reported the IP in this period')),
+            ],
+            options={
+                'verbose_name': 'Offense Period',
+                'verbose_name_plural': 'Offense Periods',
+                'ordering': ['-period'],
+                'indexes': [models.Index(fields=['period'], name='offenseperiod_period_idx')],
+                'constraints': [models.UniqueConstraint(fields=('ip_address', 'period'), name='offenseperiod_ip_period_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ip_tracking', '0005_offenseperiod'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blockedip',
+            name='prefix_length',
+            field=models.PositiveSmallIntegerField(blank=True, help_text='Block the whole network of this prefix length at ip_address (empty for one address)', null=True),
+        ),
+        migrations.AlterField(
+            model_name='blockedip',
+            name='ip_address',
+            field=models.GenericIPAddressField(help_text='IP address to block (the network address for network blocks)', unique=True),
+        ),
+    ]
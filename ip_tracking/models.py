@@ -1,4 +1,10 @@
+import ipaddress
+
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.utils import timezone
+
+from .utils import ip_bucket, ip_version_key
 
 
 class RequestLog(models.Model):
@@ -28,23 +34,79 @@ class RequestLog(models.Model):
         null=True,
         help_text="City of the IP address"
     )
+    weight = models.PositiveIntegerField(
+        default=1,
+        help_text="Number of requests this row represents (greater than 1 for sampled paths)"
+    )
+    status_code = models.PositiveSmallIntegerField(
+        blank=True,
+        null=True,
+        help_text="HTTP status code of the response"
+    )
+    method = models.CharField(
+        max_length=10,
+        blank=True,
+        null=True,
+        help_text="HTTP method of the request"
+    )
+    ip_bucket = models.PositiveSmallIntegerField(
+        blank=True,
+        null=True,
+        help_text="Hash bucket of the IP address, used to shard anomaly detection"
+    )
+    ip_key = models.BigIntegerField(
+        blank=True,
+        null=True,
+        help_text="IP address as an integer (the first 64 bits for IPv6), used to group requests by network"
+    )
+    ip_version = models.PositiveSmallIntegerField(
+        blank=True,
+        null=True,
+        help_text="IP version (4 or 6) that ip_key belongs to"
+    )
+    path_category = models.CharField(
+        max_length=32,
+        blank=True,
+        null=True,
+        help_text="Category of the path (e.g. admin, auth, probe), set when the request is logged"
+    )
 
     class Meta:
         ordering = ['-timestamp']
         verbose_name = 'Request Log'
         verbose_name_plural = 'Request Logs'
+        indexes = [
+            models.Index(fields=['timestamp', 'ip_bucket'], name='requestlog_time_bucket_idx'),
+            models.Index(fields=['path_category', 'timestamp'], name='requestlog_category_time_idx'),
+            # IP and network search (see ip_tracking/search.py)
+            models.Index(fields=['ip_version', 'ip_key', 'timestamp'], name='requestlog_ip_key_time_idx'),
+        ]
 
     def __str__(self):
         return f"{self.ip_address} - {self.path} - {self.timestamp}"
 
+    def save(self, *args, **kwargs):
+        if self.ip_bucket is None:
+            self.ip_bucket = ip_bucket(self.ip_address)
+        if self.ip_key is None:
+            # Both stay NULL for a client that is not an IP address
+            self.ip_version, self.ip_key = ip_version_key(self.ip_address)
+        super().save(*args, **kwargs)
+
 
 class BlockedIP(models.Model):
     """
-    Model to store blocked IP addresses.
+    Model to store blocked IP addresses, or whole networks when
+    `prefix_length` is set (`ip_address` is then the network address).
     """
     ip_address = models.GenericIPAddressField(
         unique=True,
-        help_text="IP address to block"
+        help_text="IP address to block (the network address for network blocks)"
+    )
+    prefix_length = models.PositiveSmallIntegerField(
+        blank=True,
+        null=True,
+        help_text="Block the whole network of this prefix length at ip_address (empty for one address)"
     )
     reason = models.TextField(
         blank=True,
@@ -55,6 +117,21 @@ class BlockedIP(models.Model):
         auto_now_add=True,
         help_text="Timestamp when the IP was blocked"
     )
+    expires_at = models.DateTimeField(
+        blank=True,
+        null=True,
+        db_index=True,
+        help_text="When a temporary block ends (empty for permanent blocks)"
+    )
+    hit_count = models.PositiveBigIntegerField(
+        default=0,
+        help_text="Requests rejected because of this block (written behind, see ip_tracking/hits.py)"
+    )
+    last_hit_at = models.DateTimeField(
+        blank=True,
+        null=True,
+        help_text="When a request was last rejected because of this block"
+    )
 
     class Meta:
         ordering = ['-blocked_at']
@@ -62,7 +139,30 @@ class BlockedIP(models.Model):
         verbose_name_plural = 'Blocked IPs'
 
     def __str__(self):
-        return f"{self.ip_address}"
+        return self.network
+
+    @property
+    def network(self):
+        """The blocked CIDR, or the address of a single-address block"""
+        if self.prefix_length is None:
+            return self.ip_address
+        return f"{self.ip_address}/{self.prefix_length}"
+
+    def clean(self):
+        super().clean()
+        if self.prefix_length is None or not self.ip_address:
+            return
+        try:
+            network = ipaddress.ip_network(self.network)
+        except ValueError as e:
+            raise ValidationError({'prefix_length': str(e)})
+        if network.num_addresses == 1:
+            self.prefix_length = None
+
+    @property
+    def is_active(self):
+        """Whether the block is currently in effect"""
+        return self.expires_at is None or self.expires_at > timezone.now()
 
 
 class SuspiciousIP(models.Model):
@@ -83,11 +183,66 @@ class SuspiciousIP(models.Model):
         default=False,
         help_text="Whether this suspicious activity has been reviewed/resolved"
     )
+    category = models.CharField(
+        max_length=64,
+        blank=True,
+        null=True,
+        db_index=True,
+        help_text="Anomaly rule that raised the flag (empty for manual flags)"
+    )
+    hit_count = models.PositiveIntegerField(
+        default=1,
+        help_text="Number of detection runs that reported this flag while it was unresolved"
+    )
+    last_seen = models.DateTimeField(
+        default=timezone.now,
+        help_text="When a detection run last reported this flag"
+    )
 
     class Meta:
         ordering = ['-flagged_at']
         verbose_name = 'Suspicious IP'
         verbose_name_plural = 'Suspicious IPs'
+        constraints = [
+            # One open flag per IP and rule; detection bumps it instead of adding rows
+            models.UniqueConstraint(
+                fields=['ip_address', 'category'],
+                condition=models.Q(resolved=False),
+                name='suspiciousip_open_flag_uniq',
+            ),
+        ]
 
     def __str__(self):
         return f"{self.ip_address} - {self.reason[:50]}"
+
+
+class OffensePeriod(models.Model):
+    """
+    A detection period in which an IP was reported by any anomaly rule.
+    Open flags keep only their latest `last_seen`, so escalation counts
+    repeat offenses here; rows older than the repeat window are deleted.
+    """
+    ip_address = models.GenericIPAddressField(
+        help_text="IP address reported by detection"
+    )
+    period = models.DateTimeField(
+        help_text="Start of the hour the detection window began in"
+    )
+    recorded_at = models.DateTimeField(
+        default=timezone.now,
+        help_text="When a detection run first reported the IP in this period"
+    )
+
+    class Meta:
+        ordering = ['-period']
+        verbose_name = 'Offense Period'
+        verbose_name_plural = 'Offense Periods'
+        constraints = [
+            models.UniqueConstraint(fields=['ip_address', 'period'], name='offenseperiod_ip_period_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['period'], name='offenseperiod_period_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.ip_address} - {self.period}"
@@ -0,0 +1,89 @@
+"""
+Path classification at ingest time.
+
+Each logged request gets a `path_category` (for example 'admin', 'auth'
+or 'probe') so that anomaly rules and queries can select sensitive
+requests by an indexed column instead of matching path strings. Rules
+are read from the `IP_TRACKING_PATH_CATEGORIES` setting:
+
+    IP_TRACKING_PATH_CATEGORIES = [
+        {'prefix': '/admin', 'category': 'admin'},
+        {'prefix': '/login', 'category': 'auth'},
+        {'regex': r'.*/wp-login\\.php', 'category': 'probe'},
+    ]
+
+Paths are lowercased before matching, so prefixes and patterns should be
+lowercase. Prefix rules are matched longest-prefix-first, so
+`/admin/users/1/` falls under `/admin` and, by default,
+`/admin/login/?next=/` under `/admin/login`;
+regex rules are only consulted when no prefix matches and are tried in
+declaration order with a single combined match (use a leading `.*` to
+match anywhere in the path). Paths matching nothing get no category.
+"""
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .matching import PrefixTrie, RegexSet
+
+# Length of RequestLog.path_category
+MAX_CATEGORY_LENGTH = 32
+
+DEFAULT_CATEGORIES = [
+    {'prefix': '/admin', 'category': 'admin'},
+    {'prefix': '/admin/login', 'category': 'auth'},
+    {'prefix': '/api/admin', 'category': 'admin'},
+    {'prefix': '/login', 'category': 'auth'},
+    {'prefix': '/api/login', 'category': 'auth'},
+    {'prefix': '/accounts/login', 'category': 'auth'},
+    {'prefix': '/ip_tracking/login', 'category': 'auth'},
+    {'prefix': '/wp-', 'category': 'probe'},
+    {'prefix': '/xmlrpc.php', 'category': 'probe'},
+    {'prefix': '/.env', 'category': 'probe'},
+    {'prefix': '/.git', 'category': 'probe'},
+    {'prefix': '/phpmyadmin', 'category': 'probe'},
+    {'regex': r'.*/(wp-login\.php|wp-admin|xmlrpc\.php|phpmyadmin|\.env$|\.git/)', 'category': 'probe'},
+]
+
+
+class PathClassifier:
+    """
+    Compiled set of path categories.
+
+    Build it once with `from_settings()` and call `category_for(path)` per
+    request: a return value of None means the path has no category.
+    """
+
+    def __init__(self, rules=()):
+        self.prefixes = PrefixTrie()
+        regexes = []
+        self.categories = set()
+        for spec in rules:
+            category = spec.get('category')
+            if not category or len(category) > MAX_CATEGORY_LENGTH:
+                raise ImproperlyConfigured(
+                    f"Path category rule {spec!r} needs a 'category' of at most "
+                    f"{MAX_CATEGORY_LENGTH} characters"
+                )
+            self.categories.add(category)
+            if 'prefix' in spec:
+                self.prefixes.insert(spec['prefix'], category)
+            elif 'regex' in spec:
+                regexes.append((spec['regex'], category))
+            else:
+                raise ImproperlyConfigured(
+                    f"Path category rule {spec!r} needs a 'prefix' or 'regex' key"
+                )
+        self.regexes = RegexSet(regexes)
+
+    @classmethod
+    def from_settings(cls):
+        return cls(getattr(settings, 'IP_TRACKING_PATH_CATEGORIES', DEFAULT_CATEGORIES))
+
+    def category_for(self, path):
+        """Return the category of path, or None"""
+        path = path.lower()
+        category = self.prefixes.longest_match(path)
+        if category is None:
+            category = self.regexes.first_match(path)
+        return category
@@ -0,0 +1,216 @@
+"""
+Opt-in sampling profiler for requests and Celery tasks.
+
+A fraction of requests/task runs is executed under cProfile and the
+resulting pstats dumps are written to `IP_TRACKING_PROFILE_DIR`. Profiling
+can be switched on in three ways:
+
+- statically with `IP_TRACKING_PROFILE_SAMPLE_RATE` (0 disables);
+- at runtime with `manage.py profile_ip_tracking enable --rate 0.05
+  --minutes 10`, which stores the rate in the cache; workers pick it up
+  within `IP_TRACKING_PROFILE_POLL_INTERVAL` seconds (default: 10);
+- per request with an `X-Profile: <token>` header when
+  `IP_TRACKING_PROFILE_TOKEN` is set.
+
+The directory is capped: at most every `IP_TRACKING_PROFILE_PRUNE_INTERVAL`
+seconds (default: 60), after a dump, the oldest `.prof` files are deleted
+until at most `IP_TRACKING_PROFILE_MAX_FILES` (default: 500) remain, taking
+up at most `IP_TRACKING_PROFILE_MAX_BYTES` (default: 200 MB); 0 disables
+either limit.
+
+When nothing is enabled, the per-request cost is a single attribute
+comparison. Set `IP_TRACKING_PROFILING = False` to remove the middleware
+entirely. `manage.py profile_ip_tracking summary` aggregates the dumps.
+"""
+
+import cProfile
+import logging
+import os
+import random
+import re
+import time
+from functools import wraps
+from pathlib import Path
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+
+logger = logging.getLogger(__name__)
+
+RUNTIME_KEY = 'ip_tracking:profiling'
+
+_UNSAFE_CHARS = re.compile(r'[^A-Za-z0-9_.-]+')
+
+
+def get_profile_dir():
+    return Path(getattr(settings, 'IP_TRACKING_PROFILE_DIR', None) or Path(settings.BASE_DIR) / 'profiles')
+
+
+def prune_profiles(directory, max_files, max_bytes):
+    """
+    Delete the oldest profiles in directory beyond max_files or max_bytes
+    (0: no limit). Returns the number deleted.
+    """
+    profiles = []
+    for path in directory.glob('*.prof'):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            # Pruned meanwhile by another process
+            continue
+        profiles.append((stat.st_mtime_ns, stat.st_size, path))
+    profiles.sort(reverse=True)
+    kept = total = deleted = 0
+    for _, size, path in profiles:
+        if (max_files and kept >= max_files) or (max_bytes and kept and total + size > max_bytes):
+            try:
+                path.unlink()
+                deleted += 1
+            except FileNotFoundError:
+                pass
+            continue
+        kept += 1
+        total += size
+    return deleted
+
+
+def enable_runtime_profiling(rate, seconds):
+    """Enable sampling on every worker for `seconds`"""
+    cache.set(RUNTIME_KEY, {'rate': rate, 'until': time.time() + seconds}, seconds)
+
+
+def disable_runtime_profiling():
+    cache.delete(RUNTIME_KEY)
+
+
+def get_runtime_profiling():
+    """Return the active runtime setting ({'rate', 'until'}) or None"""
+    state = cache.get(RUNTIME_KEY)
+    if state and state.get('until', 0) > time.time():
+        return state
+    return None
+
+
+class Sampler:
+    """
+    Decides which executions to profile and writes their stats.
+
+    `rate` combines the static setting with the runtime switch; the runtime
+    switch is re-read from the cache at most every `poll_interval` seconds.
+    """
+
+    def __init__(self):
+        self.static_rate = getattr(settings, 'IP_TRACKING_PROFILE_SAMPLE_RATE', 0.0)
+        self.poll_interval = getattr(settings, 'IP_TRACKING_PROFILE_POLL_INTERVAL', 10.0)
+        self.max_files = getattr(settings, 'IP_TRACKING_PROFILE_MAX_FILES', 500)
+        self.max_bytes = getattr(settings, 'IP_TRACKING_PROFILE_MAX_BYTES', 200 * 1024 * 1024)
+        self.prune_interval = getattr(settings, 'IP_TRACKING_PROFILE_PRUNE_INTERVAL', 60.0)
+        self.rate = self.static_rate
+        self.next_poll = 0.0
+        self.next_prune = 0.0
+
+    def current_rate(self):
+        now = time.monotonic()
+        if now >= self.next_poll:
+            self.next_poll = now + self.poll_interval
+            try:
+                runtime = get_runtime_profiling()
+            except Exception as e:
+                logger.warning(f"Failed to read runtime profiling state: {str(e)}")
+                runtime = None
+            self.rate = max(self.static_rate, runtime['rate'] if runtime else 0.0)
+        return self.rate
+
+    def should_sample(self):
+        rate = self.current_rate()
+        return rate > 0 and random.random() < rate
+
+    def run(self, kind, name, func, *args, **kwargs):
+        """Run func under cProfile and dump the stats"""
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already active in this thread
+            return func(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            self.dump(profiler, kind, name, time.perf_counter() - started)
+
+    def dump(self, profiler, kind, name, duration):
+        directory = get_profile_dir()
+        try:
+            directory.mkdir(parents=True, exist_ok=True)
+            safe_name = _UNSAFE_CHARS.sub('_', name).strip('_')[:80] or 'root'
+            filename = f'{kind}-{safe_name}-{os.getpid()}-{time.time_ns()}-{int(duration * 1000)}ms.prof'
+            profiler.dump_stats(str(directory / filename))
+        except OSError as e:
+            logger.warning(f"Failed to write profile: {str(e)}")
+            return
+        self.maybe_prune(directory)
+
+    def maybe_prune(self, directory):
+        """Prune the directory if the last prune was over prune_interval ago"""
+        if not (self.max_files or self.max_bytes):
+            return
+        now = time.monotonic()
+        if now >= self.next_prune:
+            self.next_prune = now + self.prune_interval
+            try:
+                prune_profiles(directory, self.max_files, self.max_bytes)
+            except OSError as e:
+                logger.warning(f"Failed to prune profiles: {str(e)}")
+
+
+_sampler = None
+
+
+def get_sampler():
+    global _sampler
+    if _sampler is None:
+        _sampler = Sampler()
+    return _sampler
+
+
+class ProfilingMiddleware:
+    """
+    Profiles sampled requests. Place it first in MIDDLEWARE so the whole
+    middleware stack is included in the profile.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'IP_TRACKING_PROFILING', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sampler = get_sampler()
+        token = getattr(settings, 'IP_TRACKING_PROFILE_TOKEN', None)
+        self.header_token = token or None
+
+    def __call__(self, request):
+        forced = (
+            self.header_token is not None
+            and request.META.get('HTTP_X_PROFILE') == self.header_token
+        )
+        if forced or self.sampler.should_sample():
+            return self.sampler.run('request', request.path, self.get_response, request)
+        return self.get_response(request)
+
+
+def profiled(name):
+    """
+    Decorator sampling a Celery task (or any function) with the same rate
+    as requests. Apply it below @shared_task so the task name is unchanged.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            sampler = get_sampler()
+            if sampler.should_sample():
+                return sampler.run('task', name, func, *args, **kwargs)
+            return func(*args, **kwargs)
+        return wrapped
+    return decorator
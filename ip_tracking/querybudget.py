@@ -0,0 +1,170 @@
+"""
+Query instrumentation built on `connection.execute_wrapper`.
+
+`QueryTracker` counts queries and database time and groups statements by
+their *shape* (the SQL with literals and parameter lists normalised), so a
+shape that repeats many times within one request or task — the signature
+of an N+1 pattern — can be reported.
+
+- `QueryTrackingMiddleware` tracks every request when `DEBUG` (or
+  `IP_TRACKING_QUERY_TRACKING`) is on, adds `X-DB-Queries`,
+  `X-DB-Time-Ms` and `X-DB-Repeated` response headers, and logs a warning
+  when a URL name exceeds its entry in `IP_TRACKING_QUERY_BUDGETS` or
+  a shape repeats `IP_TRACKING_N_PLUS_ONE_THRESHOLD` (default: 5) times.
+- `tracked(name)` does the same logging for Celery tasks.
+- `assert_query_budget()` raises `QueryBudgetExceeded` inside tests, and
+  `manage.py check_query_budgets` enforces the budget of every route in
+  `api_urls.py`.
+"""
+
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_N_PLUS_ONE_THRESHOLD = 5
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDER_LIST = re.compile(r'\((?:\s*(?:%s|\?)\s*,)+\s*(?:%s|\?)\s*\)')
+_WHITESPACE = re.compile(r'\s+')
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised by assert_query_budget when a block runs too many queries"""
+
+
+def sql_shape(sql):
+    """Normalise a statement so that queries differing only in values match"""
+    shape = _STRING_LITERAL.sub('?', sql)
+    shape = _NUMBER_LITERAL.sub('?', shape)
+    shape = shape.replace('%s', '?')
+    shape = _PLACEHOLDER_LIST.sub('(...)', shape)
+    return _WHITESPACE.sub(' ', shape).strip()
+
+
+def get_n_plus_one_threshold():
+    return getattr(settings, 'IP_TRACKING_N_PLUS_ONE_THRESHOLD', DEFAULT_N_PLUS_ONE_THRESHOLD)
+
+
+class QueryTracker:
+    """`execute_wrapper` callable collecting query counts, time and shapes"""
+
+    def __init__(self):
+        self.queries = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.queries += 1
+            self.shapes[sql_shape(sql)] += 1
+
+    def repeated(self, threshold=None):
+        """Shapes executed at least `threshold` times, most frequent first"""
+        if threshold is None:
+            threshold = get_n_plus_one_threshold()
+        return [(shape, count) for shape, count in self.shapes.most_common() if count >= threshold]
+
+    def summary(self):
+        return f'{self.queries} queries in {self.duration * 1000:.1f} ms'
+
+
+@contextmanager
+def track_queries(tracker=None):
+    """Track queries on every configured database alias in this thread"""
+    tracker = tracker or QueryTracker()
+    with ExitStack() as stack:
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(tracker))
+        yield tracker
+
+
+@contextmanager
+def assert_query_budget(max_queries, max_repeats=None, label='block'):
+    """
+    Fail with QueryBudgetExceeded if the block runs more than `max_queries`
+    queries, or any statement shape more than `max_repeats` times.
+    """
+    with track_queries() as tracker:
+        yield tracker
+    problems = budget_problems(tracker, max_queries, max_repeats)
+    if problems:
+        raise QueryBudgetExceeded(f'{label}: ' + '; '.join(problems))
+
+
+def budget_problems(tracker, max_queries, max_repeats=None):
+    """Human readable budget violations for a finished tracker"""
+    problems = []
+    if max_queries is not None and tracker.queries > max_queries:
+        problems.append(f'{tracker.queries} queries (budget {max_queries})')
+    if max_repeats is not None:
+        for shape, count in tracker.repeated(max_repeats + 1):
+            problems.append(f'{count}x repeated: {shape[:200]}')
+    return problems
+
+
+def log_repeated(tracker, label):
+    for shape, count in tracker.repeated():
+        logger.warning(f"Possible N+1 in {label}: {count}x {shape[:300]}")
+
+
+class QueryTrackingMiddleware:
+    """
+    Per-request query tracking for development. Removed from the stack
+    unless DEBUG or IP_TRACKING_QUERY_TRACKING is on.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'IP_TRACKING_QUERY_TRACKING', settings.DEBUG):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.budgets = getattr(settings, 'IP_TRACKING_QUERY_BUDGETS', {})
+
+    def __call__(self, request):
+        with track_queries() as tracker:
+            response = self.get_response(request)
+
+        repeated = tracker.repeated()
+        response['X-DB-Queries'] = str(tracker.queries)
+        response['X-DB-Time-Ms'] = f'{tracker.duration * 1000:.1f}'
+        response['X-DB-Repeated'] = str(len(repeated))
+
+        match = getattr(request, 'resolver_match', None)
+        url_name = match.url_name if match else None
+        label = url_name or request.path
+        budget = self.budgets.get(url_name)
+        if budget is not None and tracker.queries > budget:
+            logger.warning(f"Query budget exceeded for {label}: {tracker.queries} > {budget}")
+        if repeated:
+            log_repeated(tracker, label)
+        return response
+
+
+def tracked(name):
+    """
+    Decorator logging the query count of a Celery task (or any function)
+    and warning about repeated statement shapes.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            with track_queries() as tracker:
+                result = func(*args, **kwargs)
+            logger.info(f"{name}: {tracker.summary()}")
+            log_repeated(tracker, name)
+            return result
+        return wrapped
+    return decorator
@@ -0,0 +1,545 @@
+"""
+Cache-backed rate limiting engine for the IP tracking app.
+
+Two algorithms are available:
+
+- ``token_bucket``: a bucket of ``limit`` tokens refilled continuously at
+  ``limit / period`` tokens per second. Bursts are capped at ``limit`` and
+  there is no 2x burst at window edges.
+- ``sliding_window``: an exact log of request timestamps over the last
+  ``period`` seconds.
+
+All limits that apply to a request are checked together: with a Redis cache
+the whole check is a single atomic Lua script (one round trip), otherwise a
+process-local store guarded by a lock is used, which matches the semantics
+of the locmem cache used by ``settings.py``. A request is only charged
+against its buckets when every limit allows it.
+
+Route-level policies are enforced by ``RateLimitMiddleware`` (see
+``RoutePolicyTable``). For one-off limits the engine is also available as a
+view decorator:
+
+    @rate_limit(Limit('ip', '5/m'), Limit('user_or_ip', '10/m'), methods=['POST'])
+    def login_view(request):
+        ...
+
+Rejected requests are answered by the view named in ``RATELIMIT_VIEW``
+(``ip_tracking.views.rate_limit_handler`` by default), which receives a
+``RateLimitExceeded`` exception carrying the exact ``retry_after``.
+"""
+
+import math
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from functools import wraps
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, PermissionDenied
+from django.utils.module_loading import import_string
+
+from . import metrics
+from .matching import PrefixTrie
+from .utils import get_client_ip, get_redis_client
+
+TOKEN_BUCKET = 'token_bucket'
+SLIDING_WINDOW = 'sliding_window'
+
+ALGORITHMS = {TOKEN_BUCKET: 'tb', SLIDING_WINDOW: 'sw'}
+
+_PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+_RATE_RE = re.compile(r'^(\d+)/(\d*)([smhd])$')
+
+
+class RateLimitExceeded(PermissionDenied):
+    """Raised (or passed to the rate limit view) when a request is limited"""
+
+    def __init__(self, retry_after=0, limit=None):
+        super().__init__('Rate limit exceeded')
+        self.retry_after = retry_after
+        self.limit = limit
+
+
+def parse_rate(rate):
+    """
+    Parse a rate string such as '5/m' or '100/15m' into (limit, seconds).
+    """
+    match = _RATE_RE.match(rate.strip())
+    if not match:
+        raise ImproperlyConfigured(f"Invalid rate '{rate}', expected e.g. '5/m' or '100/15m'")
+    count, multiplier, unit = match.groups()
+    return int(count), int(multiplier or 1) * _PERIODS[unit]
+
+
+def _key_ip(request):
+    return getattr(request, 'client_ip', None) or get_client_ip(request)
+
+
+def _key_user(request):
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return str(user.pk)
+    return None
+
+
+def _key_user_or_ip(request):
+    user_id = _key_user(request)
+    if user_id is not None:
+        return f'u{user_id}'
+    return f'ip{_key_ip(request)}'
+
+
+KEY_FUNCTIONS = {
+    'ip': _key_ip,
+    'user': _key_user,
+    'user_or_ip': _key_user_or_ip,
+}
+
+
+class Limit:
+    """
+    One rate limit: who is counted (`key`), how much (`rate`) and how.
+
+    `key` is 'ip', 'user', 'user_or_ip' or a callable taking the request and
+    returning an identifier (or None to exempt the request from this limit).
+    """
+
+    __slots__ = ('key', 'key_func', 'rate', 'limit', 'period', 'algorithm', 'cost')
+
+    def __init__(self, key, rate, algorithm=TOKEN_BUCKET, cost=1):
+        if algorithm not in ALGORITHMS:
+            raise ImproperlyConfigured(
+                f"Unknown rate limit algorithm '{algorithm}', expected one of {tuple(ALGORITHMS)}"
+            )
+        if callable(key):
+            self.key_func = key
+            key = getattr(key, '__name__', 'custom')
+        elif key in KEY_FUNCTIONS:
+            self.key_func = KEY_FUNCTIONS[key]
+        else:
+            raise ImproperlyConfigured(
+                f"Unknown rate limit key '{key}', expected one of {tuple(KEY_FUNCTIONS)} or a callable"
+            )
+        self.key = key
+        self.rate = rate
+        self.limit, self.period = parse_rate(rate)
+        self.algorithm = algorithm
+        self.cost = cost
+
+    def __repr__(self):
+        return f"Limit({self.key!r}, {self.rate!r}, algorithm={self.algorithm!r})"
+
+    def cache_key(self, scope, identifier):
+        return f'ip_tracking:rl:{scope}:{self.key}:{self.rate}:{ALGORITHMS[self.algorithm]}:{identifier}'
+
+
+class RateLimitResult:
+    """Outcome of a combined check"""
+
+    __slots__ = ('allowed', 'retry_after', 'remaining', 'limit')
+
+    def __init__(self, allowed, retry_after=0.0, remaining=None, limit=None):
+        self.allowed = allowed
+        self.retry_after = retry_after
+        self.remaining = remaining
+        self.limit = limit
+
+    def __bool__(self):
+        return self.allowed
+
+
+# KEYS: one bucket key per limit
+# ARGV: token, then (algorithm, limit, period, cost) per key
+# Returns {allowed, retry_after_ms, remaining, index of the limiting key}
+_CHECK_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local token = ARGV[1]
+local allowed = 1
+local retry_after = 0
+local remaining = -1
+local blocker = 0
+local tokens_now = {}
+
+for i, key in ipairs(KEYS) do
+    local base = 1 + (i - 1) * 4
+    local algo = ARGV[base + 1]
+    local limit = tonumber(ARGV[base + 2])
+    local period = tonumber(ARGV[base + 3])
+    local cost = tonumber(ARGV[base + 4])
+    local left = 0
+    local wait = 0
+    if algo == 'tb' then
+        local rate = limit / period
+        local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+        local tokens = tonumber(bucket[1]) or limit
+        local ts = tonumber(bucket[2]) or now
+        tokens = math.min(limit, tokens + math.max(0, now - ts) * rate)
+        tokens_now[i] = tokens
+        if tokens >= cost then
+            left = tokens - cost
+        else
+            left = tokens
+            wait = (cost - tokens) / rate
+        end
+    else
+        redis.call('ZREMRANGEBYSCORE', key, '-inf', now - period)
+        local count = redis.call('ZCARD', key)
+        if count + cost <= limit then
+            left = limit - count - cost
+        else
+            left = math.max(0, limit - count)
+            local index = count + cost - limit - 1
+            local oldest = redis.call('ZRANGE', key, index, index, 'WITHSCORES')
+            if oldest[2] then
+                wait = tonumber(oldest[2]) + period - now
+            else
+                wait = period
+            end
+        end
+    end
+    if wait > 0 then
+        allowed = 0
+        if wait > retry_after then
+            retry_after = wait
+            blocker = i
+        end
+    end
+    if remaining < 0 or left < remaining then
+        remaining = left
+    end
+end
+
+if allowed == 1 then
+    for i, key in ipairs(KEYS) do
+        local base = 1 + (i - 1) * 4
+        local algo = ARGV[base + 1]
+        local period = tonumber(ARGV[base + 3])
+        local cost = tonumber(ARGV[base + 4])
+        if algo == 'tb' then
+            redis.call('HSET', key, 'tokens', tokens_now[i] - cost, 'ts', now)
+        else
+            for c = 1, cost do
+                redis.call('ZADD', key, now, token .. ':' .. i .. ':' .. c)
+            end
+        end
+        redis.call('PEXPIRE', key, math.ceil(period * 1000))
+    end
+end
+
+return {allowed, math.ceil(retry_after * 1000), math.floor(remaining), blocker}
+"""
+
+
+class RedisBackend:
+    """Evaluates a combined check with one atomic Lua script"""
+
+    def __init__(self, client):
+        self.client = client
+        self.script = client.register_script(_CHECK_SCRIPT)
+
+    def check(self, entries):
+        keys = []
+        args = [uuid.uuid4().hex]
+        for cache_key, limit in entries:
+            keys.append(cache_key)
+            args.extend([ALGORITHMS[limit.algorithm], limit.limit, limit.period, limit.cost])
+        allowed, retry_ms, remaining, blocker = self.script(keys=keys, args=args)
+        return RateLimitResult(
+            bool(allowed),
+            retry_after=int(retry_ms) / 1000,
+            remaining=int(remaining),
+            limit=entries[int(blocker) - 1][1] if blocker else None,
+        )
+
+
+class LocalBackend:
+    """
+    Process-local implementation with the same semantics as the Lua script.
+    Used when the configured cache is not Redis (e.g. locmem in settings.py).
+
+    Like the script's PEXPIRE, state expires `period` seconds after its
+    last charge, when a bucket is full again and a window log is empty.
+    Expired keys are swept at most every `sweep_interval` seconds, not on
+    every check.
+    """
+
+    def __init__(self, clock=time.monotonic, sweep_interval=60.0):
+        self.clock = clock
+        self.sweep_interval = sweep_interval
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.windows = {}
+        # {cache_key: time after which its state equals no state}
+        self.expires = {}
+        self.next_sweep = clock() + sweep_interval
+
+    def check(self, entries):
+        with self.lock:
+            now = self.clock()
+            allowed = True
+            retry_after = 0.0
+            remaining = None
+            blocker = None
+            pending = []
+            for cache_key, limit in entries:
+                if limit.algorithm == TOKEN_BUCKET:
+                    rate = limit.limit / limit.period
+                    tokens, ts = self.buckets.get(cache_key, (limit.limit, now))
+                    tokens = min(limit.limit, tokens + max(0.0, now - ts) * rate)
+                    pending.append((cache_key, limit, tokens))
+                    if tokens >= limit.cost:
+                        left, wait = tokens - limit.cost, 0.0
+                    else:
+                        left, wait = tokens, (limit.cost - tokens) / rate
+                else:
+                    log = self.windows.get(cache_key)
+                    if log is None:
+                        log = deque()
+                    while log and log[0] <= now - limit.period:
+                        log.popleft()
+                    pending.append((cache_key, limit, log))
+                    if len(log) + limit.cost <= limit.limit:
+                        left, wait = limit.limit - len(log) - limit.cost, 0.0
+                    else:
+                        left = max(0, limit.limit - len(log))
+                        index = len(log) + limit.cost - limit.limit - 1
+                        wait = log[index] + limit.period - now if index < len(log) else limit.period
+                if wait > 0:
+                    allowed = False
+                    if wait > retry_after:
+                        retry_after, blocker = wait, limit
+                if remaining is None or left < remaining:
+                    remaining = left
+
+            if allowed:
+                for cache_key, limit, state in pending:
+                    if limit.algorithm == TOKEN_BUCKET:
+                        self.buckets[cache_key] = (state - limit.cost, now)
+                    else:
+                        state.extend([now] * limit.cost)
+                        self.windows[cache_key] = state
+                    self.expires[cache_key] = now + limit.period
+            if now >= self.next_sweep:
+                self._expire(now)
+
+        return RateLimitResult(
+            allowed,
+            retry_after=math.ceil(retry_after * 1000) / 1000,
+            remaining=math.floor(remaining) if remaining is not None else None,
+            limit=blocker,
+        )
+
+    def _expire(self, now):
+        """Drop the state of keys not charged within their limit's period"""
+        self.next_sweep = now + self.sweep_interval
+        expired = [key for key, deadline in self.expires.items() if deadline <= now]
+        for key in expired:
+            del self.expires[key]
+            self.buckets.pop(key, None)
+            self.windows.pop(key, None)
+
+
+class RateLimiter:
+    """
+    Front-end to the configured backend.
+
+    `check(request, limits, scope)` resolves the identifier for every limit,
+    skips limits that do not apply (identifier None) and evaluates the rest
+    in one combined backend call. `check_scoped()` does the same for
+    (scope, limit) pairs coming from different policies.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def check(self, request, limits, scope):
+        return self.check_scoped(request, [(scope, limit) for limit in limits])
+
+    def check_scoped(self, request, scoped_limits):
+        entries = []
+        for scope, limit in scoped_limits:
+            identifier = limit.key_func(request)
+            if identifier is not None:
+                entries.append((limit.cache_key(scope, identifier), limit))
+        if not entries:
+            return RateLimitResult(True)
+        return self.backend.check(entries)
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """Return the process-wide RateLimiter, creating it on first use"""
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                client = get_redis_client(getattr(settings, 'RATELIMIT_USE_CACHE', 'default'))
+                backend = RedisBackend(client) if client is not None else LocalBackend()
+                _limiter = RateLimiter(backend)
+    return _limiter
+
+
+def rate_limited_response(request, result):
+    """Build the response for a rejected request using RATELIMIT_VIEW"""
+    metrics.RATE_LIMITED.inc()
+    handler = import_string(
+        getattr(settings, 'RATELIMIT_VIEW', 'ip_tracking.views.rate_limit_handler')
+    )
+    return handler(request, RateLimitExceeded(result.retry_after, result.limit))
+
+
+def rate_limit(*limits, methods=None, scope=None):
+    """
+    View decorator applying `limits` (Limit instances) to the view.
+
+    Only requests whose method is in `methods` are counted (all methods when
+    None). `scope` namespaces the buckets and defaults to the view's dotted
+    path, so the same Limit on two views is counted separately.
+    """
+    methods = {method.upper() for method in methods} if methods else None
+
+    def decorator(view_func):
+        view_scope = scope or f'{view_func.__module__}.{view_func.__qualname__}'
+
+        @wraps(view_func)
+        def wrapped(request, *args, **kwargs):
+            if getattr(settings, 'RATELIMIT_ENABLE', True) and (
+                methods is None or request.method in methods
+            ):
+                result = get_rate_limiter().check(request, limits, view_scope)
+                if not result.allowed:
+                    return rate_limited_response(request, result)
+            return view_func(request, *args, **kwargs)
+
+        return wrapped
+
+    return decorator
+
+
+ANONYMOUS = 'anonymous'
+AUTHENTICATED = 'authenticated'
+
+USER_CLASSES = (ANONYMOUS, AUTHENTICATED)
+
+HTTP_METHODS = ('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS')
+ANY_METHOD = '*'
+
+
+class RoutePolicyTable:
+    """
+    Route table mapping (path, method, user class) to the limits to enforce.
+
+    Policies come from `IP_TRACKING_RATE_LIMIT_POLICIES`:
+
+        IP_TRACKING_RATE_LIMIT_POLICIES = [
+            {'name': 'api', 'prefix': '/api/',
+             'limits': [{'key': 'ip', 'rate': '300/m'}]},
+            {'name': 'api-write', 'prefix': '/api/',
+             'methods': ['POST', 'PUT', 'PATCH', 'DELETE'],
+             'limits': [{'key': 'user_or_ip', 'rate': '30/m'}]},
+            {'name': 'api-anon', 'prefix': '/api/', 'users': 'anonymous',
+             'limits': [{'key': 'ip', 'rate': '60/m', 'algorithm': 'sliding_window'}]},
+        ]
+
+    A policy applies to every path starting with its `prefix` (all paths when
+    omitted), to the listed `methods` (all when omitted) and to `users`
+    ('anonymous', 'authenticated' or both when omitted). Every applicable
+    policy is enforced, not just the most specific one.
+
+    At compile time each prefix node gets a dict keyed by (method, user
+    class) holding the merged tuple of (scope, limit) pairs from that prefix
+    and all its ancestors, so a request costs one trie walk and one dict
+    lookup.
+    """
+
+    def __init__(self, policies=()):
+        compiled = []
+        for index, spec in enumerate(policies):
+            name = spec.get('name') or f'policy{index}'
+            users = spec.get('users')
+            if users is None:
+                users = USER_CLASSES
+            elif isinstance(users, str):
+                users = (users,)
+            for user_class in users:
+                if user_class not in USER_CLASSES:
+                    raise ImproperlyConfigured(
+                        f"Unknown user class '{user_class}' in rate limit policy '{name}', "
+                        f"expected one of {USER_CLASSES}"
+                    )
+            methods = tuple(method.upper() for method in spec['methods']) if spec.get('methods') else None
+            limits = tuple(
+                (name, Limit(limit['key'], limit['rate'], limit.get('algorithm', TOKEN_BUCKET)))
+                for limit in spec.get('limits', ())
+            )
+            compiled.append((spec.get('prefix', ''), methods, tuple(users), limits))
+
+        self.routes = PrefixTrie()
+        for prefix in {prefix for prefix, _, _, _ in compiled}:
+            applicable = [policy for policy in compiled if prefix.startswith(policy[0])]
+            self.routes.insert(prefix, self._build_table(applicable))
+
+    @staticmethod
+    def _build_table(policies):
+        table = {}
+        for method in HTTP_METHODS + (ANY_METHOD,):
+            for user_class in USER_CLASSES:
+                limits = []
+                for _, methods, users, policy_limits in policies:
+                    if user_class not in users:
+                        continue
+                    if methods is not None and method not in methods:
+                        continue
+                    limits.extend(policy_limits)
+                if limits:
+                    table[(method, user_class)] = tuple(limits)
+        return table
+
+    @classmethod
+    def from_settings(cls):
+        return cls(getattr(settings, 'IP_TRACKING_RATE_LIMIT_POLICIES', ()))
+
+    def __bool__(self):
+        return bool(len(self.routes))
+
+    def limits_for(self, path, method, user_class):
+        """Return the (scope, limit) pairs that apply to a request"""
+        table = self.routes.longest_match(path)
+        if not table:
+            return ()
+        if method not in HTTP_METHODS:
+            method = ANY_METHOD
+        return table.get((method, user_class), ())
+
+
+class RateLimitMiddleware:
+    """
+    Enforces the route policies in `IP_TRACKING_RATE_LIMIT_POLICIES`.
+
+    The policy table is compiled once when the middleware is created; each
+    request then does a single table lookup and checks all matching limits
+    in one cache round trip. Place it after AuthenticationMiddleware so that
+    session-authenticated users are classified correctly (credentials that
+    only DRF resolves, such as basic auth, count as anonymous here).
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.policies = RoutePolicyTable.from_settings()
+
+    def __call__(self, request):
+        if self.policies and getattr(settings, 'RATELIMIT_ENABLE', True):
+            user = getattr(request, 'user', None)
+            user_class = AUTHENTICATED if user is not None and user.is_authenticated else ANONYMOUS
+            limits = self.policies.limits_for(request.path, request.method, user_class)
+            if limits:
+                result = get_rate_limiter().check_scoped(request, limits)
+                if not result.allowed:
+                    return rate_limited_response(request, result)
+        return self.get_response(request)
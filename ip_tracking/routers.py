@@ -0,0 +1,95 @@
+"""
+Read-replica routing for analytics and API read traffic.
+
+Reads are sent to the replica only inside a `use_replica()` scope: the
+safe-method actions of the API viewsets (`ReplicaReadMixin`), the
+statistics view and the `detect_anomalies` scan. Everything else —
+including the middleware's request log inserts — uses `default`.
+
+Within a scope, the first write pins the remaining reads to the primary
+(read-your-writes), so code that creates a row and then queries it never
+sees replication lag. Models in `IP_TRACKING_PRIMARY_MODELS` (default:
+`BlockedIP`) are always read from the primary, as is anything inside a
+transaction on the primary.
+
+The replica alias is `IP_TRACKING_REPLICA_ALIAS` (default: `replica`).
+When it is not in `DATABASES`, the router does nothing.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from rest_framework.permissions import SAFE_METHODS
+
+DEFAULT_PRIMARY_MODELS = ('ip_tracking.blockedip',)
+
+# Replica alias for reads in the current scope, or None outside of one
+_read_alias = ContextVar('ip_tracking_read_alias', default=None)
+# Set once the current scope has written to the primary
+_pinned = ContextVar('ip_tracking_pinned_to_primary', default=False)
+
+
+def get_replica_alias():
+    alias = getattr(settings, 'IP_TRACKING_REPLICA_ALIAS', 'replica')
+    return alias if alias in settings.DATABASES else None
+
+
+@contextmanager
+def use_replica():
+    """
+    Route reads in this block to the replica until the first write.
+    Also usable as a decorator.
+    """
+    alias_token = _read_alias.set(get_replica_alias())
+    pinned_token = _pinned.set(False)
+    try:
+        yield
+    finally:
+        _pinned.reset(pinned_token)
+        _read_alias.reset(alias_token)
+
+
+class ReplicaRouter:
+    """Database router implementing the scoped replica reads described above"""
+
+    def __init__(self):
+        self.primary_models = {
+            label.lower() for label in getattr(settings, 'IP_TRACKING_PRIMARY_MODELS', DEFAULT_PRIMARY_MODELS)
+        }
+
+    def db_for_read(self, model, **hints):
+        alias = _read_alias.get()
+        if alias is None or _pinned.get():
+            return None
+        if model._meta.label_lower in self.primary_models:
+            return None
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        return alias
+
+    def db_for_write(self, model, **hints):
+        if _read_alias.get() is not None:
+            _pinned.set(True)
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both aliases hold the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replica follows the primary; never migrate it directly
+        if db == get_replica_alias():
+            return False
+        return None
+
+
+class ReplicaReadMixin:
+    """View mixin running safe-method (GET/HEAD/OPTIONS) requests in use_replica()"""
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method in SAFE_METHODS:
+            with use_replica():
+                return super().dispatch(request, *args, **kwargs)
+        return super().dispatch(request, *args, **kwargs)
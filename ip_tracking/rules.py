@@ -0,0 +1,586 @@
+"""
+Declarative anomaly rules evaluated together over column arrays.
+
+`Window.fetch()` reads the detection window once and turns it into NumPy
+columns: per-row IP, path, path category, method and country codes
+(indexes into the lists of distinct values), weight and status code, plus the packed
+integer and version of each distinct IP (`RequestLog.ip_key` and
+`RequestLog.ip_version`). Every rule is then a handful of vectorised
+operations (`bincount`, `unique`, boolean masks) over those columns, so
+adding a rule does not add another pass over `RequestLog`.
+
+Rules come from `IP_TRACKING_ANOMALY_RULES`, a list of dicts with a
+`type` from `RULE_TYPES`, a unique `name` (the flag/escalation kind) and
+the type's options. `min` is the smallest value that triggers the rule.
+
+    IP_TRACKING_ANOMALY_RULES = [
+        # More than 100 requests in the window
+        {'name': 'high_volume', 'type': 'rate', 'min': 101},
+        # Requests to paths classified at ingest (see ip_tracking.paths);
+        # a dict maps a category to the smallest status that counts, or to
+        # {method: min_status} with '*' for the other methods
+        {'name': 'sensitive_paths', 'type': 'rate', 'min': 5,
+         'categories': {'admin': {'GET': 300, '*': 400},
+                        'auth': {'POST': 0, '*': 400}, 'probe': 0}},
+        # Or to matching paths: 'paths' (exact), 'prefixes', 'pattern'
+        {'name': 'wp_probes', 'type': 'rate', 'min': 5, 'prefixes': ['/wp-']},
+        # Distinct paths requested
+        {'name': 'path_fanout', 'type': 'fanout', 'min': 50},
+        # Distinct countries seen for one IP
+        {'name': 'country_change', 'type': 'country_change', 'min': 2},
+        # Share of responses with a status >= min_status
+        {'name': 'error_ratio', 'type': 'error_ratio', 'min': 0.5,
+         'min_status': 400, 'min_requests': 20},
+        # Requests per /24 and /16 (IPv4) or /64 and /48 (IPv6) network,
+        # from at least min_ips addresses; the top_ips busiest are flagged
+        {'name': 'subnet_volume', 'type': 'subnet', 'min': 500,
+         'ipv4_prefixes': [24, 16], 'ipv6_prefixes': [64, 48], 'min_ips': 4},
+    ]
+
+Custom rule types subclass `Rule` and are added with `@register('type')`.
+"""
+
+import heapq
+import ipaddress
+import re
+
+import numpy as np
+from django.conf import settings
+from django.utils.functional import cached_property
+from django.utils.module_loading import import_string
+
+from .utils import ip_version_key
+
+DEFAULT_RULES = [
+    {'name': 'high_volume', 'type': 'rate', 'min': 101},
+    {
+        'name': 'sensitive_paths',
+        'type': 'rate',
+        'min': 5,
+        # Staff browsing the admin and login page loads are not attacks.
+        # Login attempts count whatever their status (a failed Django admin
+        # login is a 200), anonymous admin GETs by their redirect to the
+        # login page, other admin/auth requests when they fail; probes always
+        'categories': {
+            'admin': {'GET': 300, '*': 400},
+            'auth': {'POST': 0, '*': 400},
+            'probe': 0,
+        },
+    },
+]
+
+RULE_TYPES = {}
+
+# Bits of an address kept in RequestLog.ip_key, per IP version
+KEY_BITS = {4: 32, 6: 64}
+
+
+def register(type_name):
+    """Class decorator adding a rule type to RULE_TYPES"""
+    def decorator(cls):
+        RULE_TYPES[type_name] = cls
+        return cls
+    return decorator
+
+
+class Window:
+    """The rows of one detection window (or shard) as column arrays"""
+
+    def __init__(self, ips, paths, countries, ip_codes, path_codes, country_codes, weights, statuses,
+                 categories=(), category_codes=None, until=None, keys=None, versions=None,
+                 methods=(), method_codes=None):
+        self.ips = ips
+        self.paths = paths
+        self.countries = countries
+        self.categories = list(categories)
+        self.ip_codes = ip_codes
+        self.path_codes = path_codes
+        self.country_codes = country_codes
+        if category_codes is None:
+            category_codes = np.full(len(ip_codes), -1, dtype=np.int64)
+        self.category_codes = category_codes
+        self.methods = list(methods)
+        if method_codes is None:
+            method_codes = np.full(len(ip_codes), -1, dtype=np.int64)
+        self.method_codes = method_codes
+        self.weights = weights
+        self.statuses = statuses
+        # End of the window; rules keeping state across runs key it on this
+        self.until = until
+        # RequestLog.ip_key and ip_version of each distinct IP (None where not stored)
+        self.keys = keys
+        self.versions = versions
+
+    def __len__(self):
+        return len(self.ip_codes)
+
+    @classmethod
+    def fetch(cls, queryset, until=None, chunk_size=20_000):
+        """Read the queryset once, coding strings as they stream in"""
+        ip_index, path_index, country_index, category_index = {}, {}, {None: -1}, {None: -1}
+        method_index = {None: -1}
+        ip_codes, path_codes, country_codes, category_codes, weights, statuses = [], [], [], [], [], []
+        keys, versions, method_codes = [], [], []
+        rows = queryset.order_by().values_list(
+            'ip_address', 'ip_version', 'ip_key', 'path', 'country', 'path_category', 'weight', 'status_code',
+            'method',
+        )
+        for ip_address, version, key, path, country, category, weight, status_code, method in rows.iterator(
+            chunk_size=chunk_size
+        ):
+            code = ip_index.setdefault(ip_address, len(ip_index))
+            if code == len(keys):
+                keys.append(key)
+                versions.append(version)
+            ip_codes.append(code)
+            path_codes.append(path_index.setdefault(path, len(path_index)))
+            country_codes.append(country_index.setdefault(country, len(country_index) - 1))
+            category_codes.append(category_index.setdefault(category, len(category_index) - 1))
+            method_codes.append(method_index.setdefault(method, len(method_index) - 1))
+            weights.append(weight)
+            statuses.append(status_code or 0)
+        return cls(
+            ips=list(ip_index),
+            paths=list(path_index),
+            countries=[country for country in country_index if country is not None],
+            categories=[category for category in category_index if category is not None],
+            category_codes=np.array(category_codes, dtype=np.int64),
+            methods=[method for method in method_index if method is not None],
+            method_codes=np.array(method_codes, dtype=np.int64),
+            ip_codes=np.array(ip_codes, dtype=np.int64),
+            path_codes=np.array(path_codes, dtype=np.int64),
+            country_codes=np.array(country_codes, dtype=np.int64),
+            weights=np.array(weights, dtype=np.int64),
+            statuses=np.array(statuses, dtype=np.int16),
+            until=until,
+            keys=keys,
+            versions=versions,
+        )
+
+    def per_ip(self, values):
+        """Sum `values` (one per row) per IP"""
+        return np.bincount(self.ip_codes, weights=values, minlength=len(self.ips))
+
+    @cached_property
+    def ip_totals(self):
+        """Weighted requests per IP, shared by the rules that need them"""
+        return self.per_ip(self.weights)
+
+    @cached_property
+    def ip_families(self):
+        """(version, ip_key) of each IP; (0, 0) for clients that are not IPs"""
+        keys = self.keys or [None] * len(self.ips)
+        versions = self.versions or [None] * len(self.ips)
+        families = []
+        for ip, version, key in zip(self.ips, versions, keys):
+            if version is None or key is None:
+                # Rows logged before ip_version existed
+                version, key = ip_version_key(ip)
+            families.append((version or 0, key or 0))
+        return families
+
+    @cached_property
+    def ip_keys(self):
+        """Packed integer of each IP as uint64 (see `utils.ip_key`)"""
+        return np.array([key for _, key in self.ip_families], dtype=np.int64).view(np.uint64)
+
+    @cached_property
+    def ip_versions(self):
+        return np.array([version for version, _ in self.ip_families], dtype=np.int8)
+
+    def networks(self, levels):
+        """
+        Group the IPs into networks at every (version, prefix length) of
+        `levels` by shifting their packed keys; the work is per distinct
+        IP, not per row. Returns, for every (IP, level) pair, the IP code
+        and the network code, and the CIDR of each network code.
+        """
+        if not levels or not self.ips:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), []
+        owners, groups, cidrs = [], [], []
+        for version, prefix in levels:
+            members = np.flatnonzero(self.ip_versions == version)
+            numbers, inverse = np.unique(
+                self.ip_keys[members] >> np.uint64(KEY_BITS[version] - prefix), return_inverse=True
+            )
+            owners.append(members)
+            groups.append(inverse.reshape(-1) + len(cidrs))
+            cidrs.extend(network_cidr(version, prefix, number) for number in numbers.tolist())
+        return np.concatenate(owners), np.concatenate(groups), cidrs
+
+    def distinct_pairs(self, codes, mask=None):
+        """
+        Distinct (IP, code) pairs over the rows in `mask`, as two arrays
+        sorted by IP code.
+        """
+        ip_codes = self.ip_codes
+        if mask is not None:
+            ip_codes, codes = ip_codes[mask], codes[mask]
+        base = int(codes.max(initial=0)) + 1
+        pairs = np.unique(ip_codes * base + codes)
+        return pairs // base, pairs % base
+
+    def distinct_per_ip(self, codes, mask=None):
+        """Number of distinct `codes` per IP, over the rows in `mask`"""
+        owners, _ = self.distinct_pairs(codes, mask)
+        return np.bincount(owners, minlength=len(self.ips))
+
+
+def check_prefix(version, prefix):
+    """Raise ValueError for prefix lengths RequestLog.ip_key cannot group by"""
+    if not 0 < prefix <= KEY_BITS[version]:
+        raise ValueError(f"IPv{version} prefix length must be between 1 and {KEY_BITS[version]}, not {prefix}")
+
+
+def network_cidr(version, prefix, number):
+    """CIDR of the network `number` (an ip_key shifted right to `prefix` bits)"""
+    if version == 4:
+        # Formatted by hand: ipaddress is ~20x slower and this runs per network
+        address = number << 32 - prefix
+        return f'{address >> 24}.{address >> 16 & 255}.{address >> 8 & 255}.{address & 255}/{prefix}'
+    return f'{ipaddress.IPv6Address(number << 128 - prefix)}/{prefix}'
+
+
+def pair_lookup(owners, values, names):
+    """detail() callback listing the names of an IP's distinct codes"""
+    def detail(code):
+        start, end = np.searchsorted(owners, [code, code + 1])
+        return sorted(names[value] for value in values[start:end])
+    return detail
+
+
+class Rule:
+    """
+    Base class. `evaluate(window)` returns {ip: [value, detail]} for the
+    IPs that trigger the rule; `detail` is a JSON-serialisable list.
+
+    Rules whose groups span shards (see `SubnetRule`) return partial
+    aggregates from `evaluate()` instead, add up the shards in `combine()`
+    and apply their threshold in `finalize()`.
+    """
+
+    title = 'Anomalous activity'
+
+    def __init__(self, name, min, title=None):
+        self.name = name
+        self.min = min
+        if title:
+            self.title = title
+
+    def evaluate(self, window):
+        raise NotImplementedError
+
+    def reason(self, value, detail):
+        return f"{self.title}: {value}"
+
+    def combine(self, merged, partial):
+        """Add one shard's evaluate() result to merged"""
+        merged.update(partial)
+
+    def finalize(self, merged):
+        """{ip: [value, detail]} from the combined shard results"""
+        return merged
+
+    def summarize(self, hits):
+        """Entries for the task summary"""
+        return {f'{self.name}_ips_flagged': len(hits)}
+
+    def network_offenses(self, hits):
+        """[(cidr, value)] of the networks behind hits, for network blocks"""
+        return []
+
+    def hits(self, window, values, detail=None):
+        """Format the IPs whose value reaches `min`"""
+        result = {}
+        for code in np.flatnonzero(values >= self.min):
+            value = values[code]
+            value = int(value) if float(value).is_integer() else round(float(value), 4)
+            result[window.ips[code]] = [value, detail(code) if detail else []]
+        return result
+
+
+@register('rate')
+class RateRule(Rule):
+    """
+    Weighted requests per IP, optionally only to paths in `categories` (the
+    `path_category` column) or matching `paths`, `prefixes` or `pattern`.
+    `categories` is a list, or a dict mapping a category to the smallest
+    status code that counts, or to {method: min_status} with '*' for the
+    methods not listed (and rows logged without a method).
+    """
+
+    def __init__(self, name, min, categories=None, paths=None, prefixes=None, pattern=None,
+                 title=None):
+        super().__init__(name, min, title)
+        if not isinstance(categories, dict):
+            categories = {category: 0 for category in categories or ()}
+        # {category: {method or '*': min_status}}
+        self.path_categories = {}
+        for category, min_status in categories.items():
+            if isinstance(min_status, dict):
+                min_status = {method.upper(): value for method, value in min_status.items()}
+            else:
+                min_status = {'*': min_status}
+            self.path_categories[category] = min_status
+        self.exact = set(paths or ())
+        self.prefixes = tuple(prefixes or ())
+        self.pattern = re.compile(pattern) if pattern else None
+        self.filtered = bool(self.path_categories or self.exact or self.prefixes or self.pattern)
+        if not title:
+            self.title = (
+                'Multiple attempts to access sensitive paths' if self.filtered
+                else 'High volume of requests'
+            )
+
+    def matches(self, path):
+        return (
+            path in self.exact
+            or (self.prefixes and path.startswith(self.prefixes))
+            or (self.pattern is not None and self.pattern.search(path) is not None)
+        )
+
+    def evaluate(self, window):
+        if not self.filtered:
+            return self.hits(window, window.ip_totals)
+
+        mask = np.zeros(len(window), dtype=bool)
+        if self.path_categories:
+            method_codes = {method: code for code, method in enumerate(window.methods)}
+            for code, category in enumerate(window.categories):
+                thresholds = self.path_categories.get(category)
+                if thresholds is None:
+                    continue
+                in_category = window.category_codes == code
+                # Rows of the listed methods, then the rest under '*'
+                listed = np.zeros(len(window), dtype=bool)
+                for method, min_status in thresholds.items():
+                    if method == '*' or method not in method_codes:
+                        continue
+                    selected = in_category & (window.method_codes == method_codes[method])
+                    listed |= selected
+                    if min_status:
+                        selected &= window.statuses >= min_status
+                    mask |= selected
+                if '*' in thresholds:
+                    selected = in_category & ~listed
+                    if thresholds['*']:
+                        selected &= window.statuses >= thresholds['*']
+                    mask |= selected
+        if self.exact or self.prefixes or self.pattern:
+            # Match each distinct path once, then select rows by path code
+            matching = np.array([bool(self.matches(path)) for path in window.paths], dtype=bool)
+            mask |= matching[window.path_codes]
+        if not mask.any():
+            return {}
+        values = window.per_ip(np.where(mask, window.weights, 0))
+        owners, path_codes = window.distinct_pairs(window.path_codes, mask)
+        return self.hits(window, values, pair_lookup(owners, path_codes, window.paths))
+
+    def reason(self, value, detail):
+        if self.filtered:
+            return f"{self.title}: {value} attempts to [{', '.join(detail)}]"
+        return f"{self.title}: {value} requests in the last hour"
+
+
+@register('fanout')
+class FanoutRule(Rule):
+    """Distinct paths requested per IP (scanners, crawlers)"""
+
+    title = 'Requests to many distinct paths'
+
+    def evaluate(self, window):
+        return self.hits(window, window.distinct_per_ip(window.path_codes))
+
+    def reason(self, value, detail):
+        return f"{self.title}: {value} paths in the last hour"
+
+
+@register('country_change')
+class CountryChangeRule(Rule):
+    """Distinct countries seen per IP (geolocation flapping, proxies)"""
+
+    title = 'Requests from several countries'
+
+    def evaluate(self, window):
+        known = window.country_codes >= 0
+        if not known.any():
+            return {}
+        owners, country_codes = window.distinct_pairs(window.country_codes, known)
+        values = np.bincount(owners, minlength=len(window.ips))
+        return self.hits(window, values, pair_lookup(owners, country_codes, window.countries))
+
+    def reason(self, value, detail):
+        return f"{self.title}: {', '.join(detail)}"
+
+
+@register('error_ratio')
+class ErrorRatioRule(Rule):
+    """Share of responses with an error status, for IPs with enough traffic"""
+
+    title = 'High share of error responses'
+
+    def __init__(self, name, min, min_status=400, min_requests=20, title=None):
+        super().__init__(name, min, title)
+        self.min_status = min_status
+        self.min_requests = min_requests
+
+    def evaluate(self, window):
+        totals = window.ip_totals
+        errors = window.per_ip(np.where(window.statuses >= self.min_status, window.weights, 0))
+        # Rows logged without a status do not count towards the total
+        known = window.per_ip(np.where(window.statuses > 0, window.weights, 0))
+        ratios = np.divide(errors, known, out=np.zeros_like(errors), where=known > 0)
+        ratios[totals < self.min_requests] = 0
+        return self.hits(window, ratios)
+
+    def reason(self, value, detail):
+        return f"{self.title}: {value:.0%} of requests in the last hour"
+
+
+def busiest_first(member):
+    """Sort key of [ip, requests] pairs: most requests, then by address"""
+    return -member[1], member[0]
+
+
+def busiest_members(window, owners, groups, size, limit):
+    """
+    The `limit` busiest IPs of each of `size` groups, as lists of [ip,
+    requests] sorted by `busiest_first`. owners and groups are the IP code
+    and group code of every (IP, group) pair.
+    """
+    requests = window.ip_totals[owners]
+    addresses = np.argsort(np.array(window.ips)).argsort()[owners]
+    order = np.lexsort((addresses, -requests, groups))
+    starts = np.searchsorted(groups[order], np.arange(size))
+    order = order[np.arange(len(order)) - starts[groups[order]] < limit]
+    members = [[] for _ in range(size)]
+    ips = window.ips
+    for code, owner, value in zip(groups[order].tolist(), owners[order].tolist(), requests[order].tolist()):
+        members[code].append([ips[owner], int(value)])
+    return members
+
+
+def merge_busiest(members, more, limit):
+    """The `limit` busiest of two busiest_members() lists of disjoint IPs"""
+    return heapq.nsmallest(limit, members + more, key=busiest_first)
+
+
+@register('subnet')
+class SubnetRule(Rule):
+    """
+    Weighted requests per network, for distributed scanners that rotate
+    through the addresses of one /24 or /64 and keep each of them under
+    the per-IP thresholds. All prefix lengths in `ipv4_prefixes` and
+    `ipv6_prefixes` are grouped in the same pass over the window (see
+    `Window.networks`). A network needs traffic from at least `min_ips`
+    addresses; its `top_ips` busiest addresses are flagged with the
+    network's CIDR, the most specific one if several levels trigger.
+
+    A network spreads over all shards, so `evaluate()` returns
+    {cidr: [requests, ips, [[ip, requests], ...]]} for every network, with
+    only the `top_ips` busiest addresses listed, and the threshold is only
+    applied to the combined totals. Shards never share an IP, so the
+    address counts add up and the busiest addresses overall are among the
+    shards' busiest.
+    """
+
+    title = 'High volume of requests from one network'
+
+    def __init__(self, name, min, ipv4_prefixes=(24,), ipv6_prefixes=(64,), min_ips=2, top_ips=20, title=None):
+        super().__init__(name, min, title)
+        self.levels = [(4, prefix) for prefix in ipv4_prefixes] + [(6, prefix) for prefix in ipv6_prefixes]
+        for version, prefix in self.levels:
+            check_prefix(version, prefix)
+        self.min_ips = min_ips
+        self.top_ips = top_ips
+
+    def evaluate(self, window):
+        owners, groups, cidrs = window.networks(self.levels)
+        if not cidrs:
+            return {}
+        totals = np.bincount(groups, weights=window.ip_totals[owners], minlength=len(cidrs))
+        counts = np.bincount(groups, minlength=len(cidrs))
+        top = busiest_members(window, owners, groups, len(cidrs), self.top_ips)
+        return {
+            cidr: [int(total), count, top[code]]
+            for code, (cidr, total, count) in enumerate(zip(cidrs, totals.tolist(), counts.tolist()))
+        }
+
+    def combine(self, merged, partial):
+        for cidr, (requests, count, top) in partial.items():
+            entry = merged.get(cidr)
+            if entry is None:
+                merged[cidr] = [requests, count, list(top)]
+                continue
+            entry[0] += requests
+            entry[1] += count
+            entry[2] = merge_busiest(entry[2], top, self.top_ips)
+
+    def finalize(self, merged):
+        result = {}
+        # Shortest prefixes first, so an IP ends up with its most specific network
+        for cidr, (requests, count, top) in sorted(merged.items(), key=lambda item: int(item[0].rsplit('/', 1)[1])):
+            if requests >= self.min and count >= self.min_ips:
+                for ip_address, _ in top:
+                    result[ip_address] = [requests, [cidr, count]]
+        return result
+
+    def summarize(self, hits):
+        return {
+            **super().summarize(hits),
+            f'{self.name}_networks': sorted({cidr for _, (cidr, _) in hits.values()}),
+        }
+
+    def network_offenses(self, hits):
+        return sorted({(cidr, requests) for requests, (cidr, _) in hits.values()})
+
+    def reason(self, value, detail):
+        cidr, addresses = detail
+        return f"{self.title}: {value} requests from {addresses} addresses of {cidr} in the last hour"
+
+
+def build_rule(config):
+    options = dict(config)
+    type_name = options.pop('type')
+    rule_class = RULE_TYPES.get(type_name)
+    if rule_class is None:
+        rule_class = import_string(type_name)
+    return rule_class(**options)
+
+
+class RuleSet:
+    def __init__(self, rules):
+        self.rules = rules
+        self.by_name = {rule.name: rule for rule in rules}
+        if len(self.by_name) != len(rules):
+            raise ValueError('Anomaly rule names must be unique')
+
+    @classmethod
+    def from_settings(cls):
+        return cls([build_rule(config) for config in getattr(settings, 'IP_TRACKING_ANOMALY_RULES', DEFAULT_RULES)])
+
+    def evaluate(self, window):
+        """{rule name: evaluate() result} for every rule"""
+        if not len(window):
+            return {rule.name: {} for rule in self.rules}
+        return {rule.name: rule.evaluate(window) for rule in self.rules}
+
+
+_rule_set = (None, None)
+
+
+def get_rule_set():
+    """
+    The RuleSet for IP_TRACKING_ANOMALY_RULES, built once per process so
+    stateful rules (see `baselines`) keep their in-process state between
+    runs. Rebuilt when the setting is replaced.
+    """
+    global _rule_set
+    config = getattr(settings, 'IP_TRACKING_ANOMALY_RULES', DEFAULT_RULES)
+    if _rule_set[0] is not config:
+        _rule_set = (config, RuleSet([build_rule(rule) for rule in config]))
+    return _rule_set[1]
+
+
+# Rule types defined in their own modules register themselves on import
+from . import baselines  # noqa: E402,F401
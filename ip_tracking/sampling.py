@@ -0,0 +1,102 @@
+"""
+Per-path sampling and exclusion rules for request logging.
+
+Rules are read from the `IP_TRACKING_LOG_RULES` setting, for example:
+
+    IP_TRACKING_LOG_RULES = [
+        {'prefix': '/static/', 'action': 'skip'},
+        {'prefix': '/swagger/', 'action': 'sample', 'rate': 0.05},
+        {'regex': r'^/api/schema', 'action': 'sample', 'rate': 0.1},
+        {'prefix': '/admin/', 'action': 'always'},
+    ]
+
+Prefix rules are matched longest-prefix-first; regex rules are only consulted
+when no prefix rule matches and are tried in declaration order. Requests that
+match nothing use `IP_TRACKING_LOG_DEFAULT_ACTION` (default: 'always').
+
+Sampled requests are stored with `weight = round(1 / rate)` so that
+aggregates computed with `Sum('weight')` estimate the true request volume.
+"""
+
+import random
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .matching import PrefixTrie, RegexSet
+
+ALWAYS = 'always'
+SAMPLE = 'sample'
+SKIP = 'skip'
+
+ACTIONS = (ALWAYS, SAMPLE, SKIP)
+
+
+class LogRule:
+    """A single compiled logging decision"""
+
+    __slots__ = ('action', 'rate', 'weight')
+
+    def __init__(self, action, rate=1.0):
+        if action not in ACTIONS:
+            raise ImproperlyConfigured(
+                f"Unknown request log action '{action}', expected one of {ACTIONS}"
+            )
+        if action == SAMPLE and not 0 < rate <= 1:
+            raise ImproperlyConfigured(
+                f"Request log sample rate must be in (0, 1], got {rate}"
+            )
+        self.action = action
+        self.rate = rate if action == SAMPLE else 1.0
+        self.weight = max(1, round(1 / self.rate)) if action == SAMPLE else 1
+
+    def decide(self, rand=random.random):
+        """Return the weight to log the request with, or 0 to skip it"""
+        if self.action == ALWAYS:
+            return 1
+        if self.action == SKIP:
+            return 0
+        return self.weight if rand() < self.rate else 0
+
+
+class LogRuleSet:
+    """
+    Compiled set of logging rules.
+
+    Build it once with `from_settings()` and call `weight_for(path)` per
+    request: a return value of 0 means the request should not be logged.
+    """
+
+    def __init__(self, rules=(), default_action=ALWAYS):
+        self.default = LogRule(default_action)
+        self.prefixes = PrefixTrie()
+        regexes = []
+        for spec in rules:
+            rule = LogRule(spec.get('action', ALWAYS), spec.get('rate', 1.0))
+            if 'prefix' in spec:
+                self.prefixes.insert(spec['prefix'], rule)
+            elif 'regex' in spec:
+                regexes.append((spec['regex'], rule))
+            else:
+                raise ImproperlyConfigured(
+                    f"Request log rule {spec!r} needs a 'prefix' or 'regex' key"
+                )
+        self.regexes = RegexSet(regexes)
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            rules=getattr(settings, 'IP_TRACKING_LOG_RULES', ()),
+            default_action=getattr(settings, 'IP_TRACKING_LOG_DEFAULT_ACTION', ALWAYS),
+        )
+
+    def rule_for(self, path):
+        """Return the rule that applies to path"""
+        rule = self.prefixes.longest_match(path)
+        if rule is None:
+            rule = self.regexes.first_match(path, self.default)
+        return rule
+
+    def weight_for(self, path):
+        """Return the log weight for path (0 means skip)"""
+        return self.rule_for(path).decide()
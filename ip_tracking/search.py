@@ -0,0 +1,290 @@
+"""
+Indexed search for the API (`IndexedSearchFilter`) and the admin
+(`IndexedSearchAdminMixin`).
+
+DRF's SearchFilter and the admin both turn every term into `icontains`
+on every search field: an OR of `UPPER(column) LIKE '%term%'` that reads
+the whole table. Here each term goes only where it can use an index:
+
+- An address is an exact match on the IP fields. A network, as CIDR
+  (`10.1.0.0/16`, `2001:db8::/48`) or as whole leading octets (`10.1.`),
+  is a range of the indexed `ip_key` column on models that have one
+  (RequestLog). IPv6 networks narrower than /64 match their whole /64,
+  the precision of `ip_key`. Other models match IPv4 networks by the
+  text prefixes of their octets, and IPv6 networks as a substring.
+- Other dotted-decimal terms (`10`, `1.1`, `10.1.2`) are the start of
+  addresses: `10.1.2` matches 10.1.2.x, 10.1.20-29.x and 10.1.200-255.x,
+  and `20` also matches IPv6 addresses starting `20`. That is a few
+  `ip_key` ranges, or a `startswith` on models without `ip_key`. These
+  terms search the text fields too.
+- Every other term searches the text fields with `icontains`, and the IP
+  fields too if it could be a piece of an address (`db8`, `:ff`).
+  On PostgreSQL, `ensure_trigram_indexes()` builds GIN trigram indexes
+  (pg_trgm) on `UPPER(column::text)`, the expression `icontains`
+  compares, so substring searches of 3+ characters on the text fields use
+  an index without changing their results. It runs after `migrate`
+  unless `IP_TRACKING_SEARCH_TRIGRAM_INDEXES` is False. Other databases
+  keep scanning.
+"""
+
+import ipaddress
+import logging
+import re
+from functools import reduce
+from operator import or_
+
+from django.contrib.admin.utils import lookup_spawns_duplicates
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import GenericIPAddressField, Q
+from django.utils.text import smart_split, unescape_string_literal
+from rest_framework.filters import SearchFilter
+
+from .utils import ip_key
+
+logger = logging.getLogger(__name__)
+
+# Text columns with a trigram index on PostgreSQL, per model
+TRIGRAM_FIELDS = {
+    'RequestLog': ('path', 'country', 'city'),
+    'SuspiciousIP': ('reason',),
+    'BlockedIP': ('reason',),
+}
+
+# Whole leading octets of an IPv4 address: '10.', '10.1.', '10.1.2.'
+_OCTETS = re.compile(r'^(?:\d{1,3}\.){1,3}$')
+# The start of an IPv4 address ('10', '1.1', '10.1.2'), or of an IPv6
+# address if it has no dots ('20', '2001')
+_IP_START = re.compile(r'^\d{1,3}(?:\.\d{1,3}){0,2}$|^\d{4}$')
+# Could be a piece of an address: 'db8', ':ff', '.1.1'
+_IP_PIECE = re.compile(r'^(?=.*[\d:])[0-9a-fA-F:.]+$')
+
+
+def _runs(values):
+    """[low, high] runs of consecutive integers in sorted values"""
+    runs = []
+    for value in values:
+        if runs and runs[-1][1] == value - 1:
+            runs[-1][1] = value
+        else:
+            runs.append([value, value])
+    return runs
+
+
+class IPStart:
+    """
+    The addresses whose text starts with `text`, as inclusive (version,
+    low, high) ranges of `ip_key`. In IPv4 the leading octets are fixed
+    and the next one is any octet whose digits start with the last part:
+    '10.1.2' is 10.1.2.x, 10.1.20-29.x and 10.1.200-255.x. A term without
+    dots also starts the IPv6 addresses whose first group starts with it.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.ranges = []
+        *octets, last = text.split('.')
+        octets = [int(octet) for octet in octets]
+        if len(last) <= 3 and all(octet <= 255 for octet in octets):
+            shift = 8 * (3 - len(octets))
+            base = 0
+            for octet in octets:
+                base = base << 8 | octet
+            base <<= 8 + shift
+            values = [value for value in range(256) if str(value).startswith(last)]
+            self.ranges += [
+                (4, base | low << shift, base | high << shift | (1 << shift) - 1)
+                for low, high in _runs(values)
+            ]
+        if not octets:
+            values = [value for value in range(1 << 16) if format(value, 'x').startswith(last)]
+            self.ranges += [
+                (6, ip_key(ipaddress.IPv6Address(low << 112)),
+                 ip_key(ipaddress.IPv6Address(high << 112 | (1 << 112) - 1)))
+                for low, high in _runs(values)
+            ]
+        if not self.ranges:
+            raise ValueError(f"{text!r} does not start an IP address")
+
+
+def parse_ip_term(term):
+    """
+    The IPv4Address/IPv6Address, IPv4Network/IPv6Network or IPStart a
+    search term stands for, or None for a text term
+    """
+    try:
+        return ipaddress.ip_address(term)
+    except ValueError:
+        pass
+    if '/' in term:
+        try:
+            network = ipaddress.ip_network(term, strict=False)
+        except ValueError:
+            return None
+        return network.network_address if network.num_addresses == 1 else network
+    if _OCTETS.match(term):
+        octets = term.rstrip('.').split('.')
+        try:
+            return ipaddress.ip_network(
+                '.'.join(octets + ['0'] * (4 - len(octets))) + f'/{8 * len(octets)}'
+            )
+        except ValueError:
+            return None
+    if _IP_START.match(term):
+        try:
+            return IPStart(term)
+        except ValueError:
+            return None
+    return None
+
+
+def ip_key_range(network):
+    """Q for the `ip_version` and `ip_key` values of network's addresses"""
+    low = ip_key(network.network_address)
+    high = ip_key(network.broadcast_address)
+    if low <= high:
+        condition = Q(ip_key__gte=low, ip_key__lte=high)
+    else:
+        # ::/0: the signed keys wrap around
+        condition = Q(ip_key__gte=low) | Q(ip_key__lte=high)
+    return Q(ip_version=network.version) & condition
+
+
+def ip_condition(model, field, value):
+    """Q matching an address, a network or an IPStart on one IP field, or None"""
+    keyed = field == 'ip_address' and any(f.name == 'ip_key' for f in model._meta.get_fields())
+    if isinstance(value, IPStart):
+        if not keyed:
+            return Q(**{f'{field}__startswith': value.text})
+        return reduce(or_, [
+            Q(ip_version=version, ip_key__gte=low, ip_key__lte=high)
+            for version, low, high in value.ranges
+        ])
+    if isinstance(value, (ipaddress.IPv4Address, ipaddress.IPv6Address)):
+        condition = Q(**{field: str(value)})
+        if keyed:
+            # Rows logged before ip_key existed have none; they age out
+            condition &= Q(ip_version=value.version, ip_key=ip_key(value)) | Q(ip_key__isnull=True)
+        return condition
+    if keyed:
+        return ip_key_range(value)
+    if value.version == 4:
+        if value.prefixlen == 0:
+            return ~Q(**{f'{field}__contains': ':'})
+        # Whole octets are text prefixes; a /22 is four /24s (at most 128)
+        prefixlen = -(-value.prefixlen // 8) * 8
+        conditions = []
+        for network in value.subnets(new_prefix=prefixlen):
+            octets = str(network.network_address).split('.')[:prefixlen // 8]
+            conditions.append(Q(**{f'{field}__startswith': '.'.join(octets) + '.'}))
+        return reduce(or_, conditions)
+    return None
+
+
+def search(queryset, search_fields, terms):
+    """
+    Filter queryset to rows matching every term on some search field.
+    search_fields are plain field names of the model.
+    """
+    model = queryset.model
+    ip_fields = []
+    text_fields = []
+    for name in search_fields:
+        field = model._meta.get_field(name)
+        (ip_fields if isinstance(field, GenericIPAddressField) else text_fields).append(name)
+
+    for term in terms:
+        value = parse_ip_term(term) if ip_fields else None
+        if value is not None:
+            conditions = [ip_condition(model, field, value) for field in ip_fields]
+            conditions = [condition for condition in conditions if condition is not None]
+            if not conditions:
+                # A network these fields cannot look up: the plain substring search
+                conditions = [Q(**{f'{field}__icontains': term}) for field in ip_fields + text_fields]
+            elif isinstance(value, IPStart):
+                # Numbers are just as likely part of a path ('2024', '404')
+                conditions += [Q(**{f'{field}__icontains': term}) for field in text_fields]
+        else:
+            # Other pieces of addresses can only be found by a substring scan
+            substring_fields = ip_fields + text_fields if _IP_PIECE.match(term) else text_fields
+            conditions = [Q(**{f'{field}__icontains': term}) for field in substring_fields]
+        if not conditions:
+            return queryset.none()
+        queryset = queryset.filter(reduce(or_, conditions))
+    return queryset
+
+
+class IndexedSearchFilter(SearchFilter):
+    """SearchFilter running `search()` over the view's `search_fields`"""
+
+    def filter_queryset(self, request, queryset, view):
+        search_fields = self.get_search_fields(view, request)
+        terms = self.get_search_terms(request)
+        if not search_fields or not terms:
+            return queryset
+        return search(queryset, search_fields, terms)
+
+
+class IndexedSearchAdminMixin:
+    """ModelAdmin search running `search()` over `search_fields`"""
+
+    def get_search_results(self, request, queryset, search_term):
+        if not self.search_fields or not search_term:
+            return super().get_search_results(request, queryset, search_term)
+        terms = []
+        for bit in smart_split(search_term):
+            if bit.startswith(('"', "'")) and bit[0] == bit[-1]:
+                bit = unescape_string_literal(bit)
+            terms.append(bit)
+        may_have_duplicates = any(
+            lookup_spawns_duplicates(self.opts, field) for field in self.search_fields
+        )
+        return search(queryset, self.search_fields, terms), may_have_duplicates
+
+
+def trigram_indexes():
+    """[(index name, table, column)] of the trigram indexes to build"""
+    from django.apps import apps
+
+    indexes = []
+    for model_name, field_names in TRIGRAM_FIELDS.items():
+        model = apps.get_model('ip_tracking', model_name)
+        table = model._meta.db_table
+        for field_name in field_names:
+            column = model._meta.get_field(field_name).column
+            indexes.append((f'{table}_{column}_trgm', table, column))
+    return indexes
+
+
+def ensure_trigram_indexes(using=DEFAULT_DB_ALIAS):
+    """
+    Create the missing trigram indexes on PostgreSQL, concurrently so that
+    request logging goes on meanwhile. Returns the names created (none on
+    other databases).
+    """
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return []
+    quote = connection.ops.quote_name
+    created = []
+    with connection.cursor() as cursor:
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for name, table, column in trigram_indexes():
+            cursor.execute(
+                'SELECT i.indisvalid FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid '
+                'WHERE c.relname = %s',
+                [name],
+            )
+            row = cursor.fetchone()
+            if row and row[0]:
+                continue
+            if row:
+                # Left invalid by an interrupted concurrent build
+                cursor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {quote(name)}')
+            cursor.execute(
+                f'CREATE INDEX CONCURRENTLY {quote(name)} ON {quote(table)} '
+                f'USING gin ((UPPER({quote(column)}::text)) gin_trgm_ops)'
+            )
+            created.append(name)
+    for name in created:
+        logger.info(f"Created search index {name}")
+    return created
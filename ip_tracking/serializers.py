@@ -2,8 +2,11 @@
 Serializers for IP Tracking API.
 """
 
+from django.conf import settings
 from rest_framework import serializers
+from .feed import parse_event_id
 from .models import RequestLog, BlockedIP, SuspiciousIP
+from .utils import normalize_ip
 
 
 class RequestLogSerializer(serializers.ModelSerializer):
@@ -11,8 +14,9 @@ class RequestLogSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = RequestLog
-        fields = ['id', 'ip_address', 'timestamp', 'path', 'country', 'city']
-        read_only_fields = ['id', 'timestamp']
+        fields = ['id', 'ip_address', 'timestamp', 'path', 'country', 'city', 'weight', 'status_code',
+                  'method', 'path_category']
+        read_only_fields = ['id', 'timestamp', 'weight', 'status_code', 'method', 'path_category']
 
 
 class BlockedIPSerializer(serializers.ModelSerializer):
@@ -20,8 +24,9 @@ class BlockedIPSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = BlockedIP
-        fields = ['id', 'ip_address', 'reason', 'blocked_at']
-        read_only_fields = ['id', 'blocked_at']
+        fields = ['id', 'ip_address', 'prefix_length', 'reason', 'blocked_at', 'expires_at', 'hit_count',
+                  'last_hit_at']
+        read_only_fields = ['id', 'blocked_at', 'hit_count', 'last_hit_at']
     
     def validate_ip_address(self, value):
         """Validate IP address format"""
@@ -32,14 +37,51 @@ class BlockedIPSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Invalid IP address format")
         return value
 
+    def validate(self, attrs):
+        """A network block needs the network address and a valid prefix length"""
+        import ipaddress
+        ip_address = attrs.get('ip_address', getattr(self.instance, 'ip_address', None))
+        prefix_length = attrs.get('prefix_length', getattr(self.instance, 'prefix_length', None))
+        if prefix_length is not None and ip_address:
+            try:
+                network = ipaddress.ip_network(f'{ip_address}/{prefix_length}')
+            except ValueError as e:
+                raise serializers.ValidationError({'prefix_length': str(e)})
+            if network.num_addresses == 1:
+                attrs['prefix_length'] = None
+        return attrs
+
 
 class SuspiciousIPSerializer(serializers.ModelSerializer):
     """Serializer for SuspiciousIP model"""
     
     class Meta:
         model = SuspiciousIP
-        fields = ['id', 'ip_address', 'reason', 'flagged_at', 'resolved']
-        read_only_fields = ['id', 'flagged_at']
+        fields = ['id', 'ip_address', 'reason', 'category', 'hit_count', 'flagged_at', 'last_seen',
+                  'resolved']
+        read_only_fields = ['id', 'category', 'hit_count', 'flagged_at', 'last_seen']
+
+
+class BlocklistBatchCheckSerializer(serializers.Serializer):
+    """IPs to check against the blocklist in one call"""
+    ips = serializers.ListField(
+        child=serializers.CharField(max_length=64),
+        allow_empty=False,
+        help_text="IP addresses to check (at most IP_TRACKING_BLOCKLIST_BATCH_MAX, default 1000)"
+    )
+
+    def validate_ips(self, value):
+        limit = getattr(settings, 'IP_TRACKING_BLOCKLIST_BATCH_MAX', 1000)
+        if len(value) > limit:
+            raise serializers.ValidationError(f"At most {limit} IP addresses per request.")
+        return value
+
+
+class BlocklistBatchResultSerializer(serializers.Serializer):
+    """Which of the submitted IPs are blocked"""
+    blocked = serializers.ListField(child=serializers.CharField())
+    invalid = serializers.ListField(child=serializers.CharField())
+    checked = serializers.IntegerField()
 
 
 class StatisticsSerializer(serializers.Serializer):
@@ -55,3 +97,43 @@ class StatisticsSerializer(serializers.Serializer):
     top_countries = serializers.ListField(child=serializers.DictField())
     top_paths = serializers.ListField(child=serializers.DictField())
     timestamp = serializers.CharField()
+
+
+class LiveFeedQuerySerializer(serializers.Serializer):
+    """Query parameters of the live request feed"""
+    after = serializers.CharField(
+        required=False,
+        help_text="Resume after this cursor (the previous response's cursor, or an SSE event id)"
+    )
+    ip = serializers.CharField(required=False, max_length=64, help_text="Only requests from this IP address")
+    path_prefix = serializers.CharField(required=False, max_length=500, help_text="Only paths starting with this")
+    country = serializers.CharField(required=False, max_length=100, help_text="Only requests from this country")
+    timeout = serializers.FloatField(
+        required=False,
+        min_value=0,
+        help_text="Seconds to wait for an event (at most IP_TRACKING_FEED_POLL_TIMEOUT, default 25)"
+    )
+    limit = serializers.IntegerField(required=False, min_value=1, max_value=500, default=100)
+
+    def validate_after(self, value):
+        if parse_event_id(value) is None:
+            raise serializers.ValidationError("Not a feed cursor.")
+        return value
+
+    def validate_ip(self, value):
+        ip_address = normalize_ip(value)
+        if ip_address is None:
+            raise serializers.ValidationError("Invalid IP address format")
+        return ip_address
+
+    def validate_timeout(self, value):
+        return min(value, getattr(settings, 'IP_TRACKING_FEED_POLL_TIMEOUT', 25))
+
+
+class LiveFeedSerializer(serializers.Serializer):
+    """One long-poll response of the live request feed"""
+    events = RequestLogSerializer(many=True)
+    cursor = serializers.CharField(allow_null=True, help_text="Pass as `after` to get the next events")
+    reset = serializers.BooleanField(
+        help_text="The resume point was no longer buffered and events were missed; reload from request-logs"
+    )
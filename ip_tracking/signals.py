@@ -0,0 +1,67 @@
+"""
+Signal handlers keeping the workers' in-memory blocklists in sync, and
+building the search indexes after migrations.
+"""
+
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .blocklist import ADD, REMOVE, publish_changes
+from .models import BlockedIP
+from .search import ensure_trigram_indexes
+
+logger = logging.getLogger(__name__)
+
+_bulk = threading.local()
+
+
+@contextmanager
+def publishing_in_bulk():
+    """
+    Collect the changes of the BlockedIP saves and deletes in the block and
+    publish them as one batch on commit, e.g. around a queryset .delete()
+    """
+    _bulk.changes = changes = []
+    try:
+        yield
+    finally:
+        _bulk.changes = None
+    if changes:
+        transaction.on_commit(lambda: publish_changes(changes))
+
+
+def _publish(change):
+    changes = getattr(_bulk, 'changes', None)
+    if changes is not None:
+        changes.append(change)
+    else:
+        transaction.on_commit(lambda: publish_changes([change]))
+
+
+@receiver(post_save, sender=BlockedIP)
+def blocked_ip_saved(sender, instance, **kwargs):
+    """Publish the new or updated block once the change is committed"""
+    _publish((ADD, instance.network, instance.expires_at))
+
+
+@receiver(post_delete, sender=BlockedIP)
+def blocked_ip_deleted(sender, instance, **kwargs):
+    """Publish the removal once the change is committed"""
+    _publish((REMOVE, instance.network, None))
+
+
+def create_search_indexes(sender, using, **kwargs):
+    """Build the PostgreSQL trigram indexes used by search (connected in apps.py)"""
+    if not getattr(settings, 'IP_TRACKING_SEARCH_TRIGRAM_INDEXES', True):
+        return
+    try:
+        ensure_trigram_indexes(using)
+    except Exception as e:
+        # e.g. no privilege to create the pg_trgm extension: search still works, unindexed
+        logger.warning(f"Could not create the search trigram indexes: {str(e)}")
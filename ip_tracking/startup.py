@@ -0,0 +1,174 @@
+"""
+Worker startup: import cost, lazy views and warm-up.
+
+Every gunicorn and Celery worker pays for its imports when it boots, and
+again each time it is recycled (`max_requests`), so startup is measured
+like any other hot path:
+
+- `measure_imports(modules)` imports the modules in a fresh interpreter
+  under `python -X importtime` and returns the cost of every module it
+  loaded; `manage.py profile_startup` reports it.
+- `lazy_view(path)` stands in for a view class whose module is expensive
+  to import (the drf-spectacular schema views), importing it on the first
+  request instead of when the URLconf loads.
+- `warm_up()` loads what a new worker's first requests would otherwise
+  pay for: the URLconf with its views, the blocklist, the geolocation
+  HTTP pool and the cached geolocation of the busiest recent clients (see
+  `ip_tracking.geo`). `gunicorn.conf.py` runs it in `post_worker_init`,
+  before the worker accepts connections. Set `IP_TRACKING_WARM_UP =
+  False` to skip it.
+"""
+
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Sum
+from django.urls import get_resolver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+_IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$')
+
+
+def parse_importtime(output):
+    """
+    [(module, self_us, cumulative_us, depth)] from `-X importtime` output,
+    in the order the imports finished
+    """
+    rows = []
+    for line in output.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            rows.append((module, int(self_us), int(cumulative_us), len(indent) // 2))
+    return rows
+
+
+def default_modules():
+    """What a web worker imports before its first response"""
+    modules = []
+    wsgi_application = getattr(settings, 'WSGI_APPLICATION', None)
+    if wsgi_application:
+        modules.append(wsgi_application.rsplit('.', 1)[0])
+    modules.append(settings.ROOT_URLCONF)
+    return modules
+
+
+def measure_imports(modules, timeout=120):
+    """
+    Set up Django and import `modules` in a new interpreter with the
+    current settings and import path; returns parse_importtime() rows.
+    Raises RuntimeError if the interpreter fails.
+    """
+    code = (
+        'import importlib, django\n'
+        'django.setup()\n'
+        f'for name in {list(modules)!r}:\n'
+        '    importlib.import_module(name)\n'
+    )
+    env = {
+        **os.environ,
+        'DJANGO_SETTINGS_MODULE': settings.SETTINGS_MODULE,
+        'PYTHONPATH': os.pathsep.join(path for path in sys.path if path),
+    }
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        env=env, capture_output=True, text=True, timeout=timeout,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'import failed')
+    return parse_importtime(result.stderr)
+
+
+def lazy_view(view_path, **initkwargs):
+    """
+    View function for the class-based view at `view_path`, imported and
+    built with `as_view(**initkwargs)` on the first request
+    """
+    view = None
+
+    def dispatch(request, *args, **kwargs):
+        nonlocal view
+        if view is None:
+            view = import_string(view_path).as_view(**initkwargs)
+        return view(request, *args, **kwargs)
+
+    # Like APIView.as_view(); CSRF is the view's own business
+    dispatch.csrf_exempt = True
+    return dispatch
+
+
+def hot_ips(limit, window):
+    """The `limit` IPs with the most requests in the last `window` seconds"""
+    from .models import RequestLog
+    from .routers import use_replica
+
+    with use_replica():
+        return list(
+            RequestLog.objects
+            .filter(timestamp__gte=timezone.now() - timedelta(seconds=window))
+            .values('ip_address')
+            .annotate(requests=Sum('weight'))
+            .order_by('-requests')
+            .values_list('ip_address', flat=True)[:limit]
+        )
+
+
+def warm_up():
+    """
+    Prepare this worker for traffic. Every step is best effort: a failure
+    is logged and the worker starts anyway. Returns a summary, or None when
+    `IP_TRACKING_WARM_UP` is off.
+    """
+    if not getattr(settings, 'IP_TRACKING_WARM_UP', True):
+        return None
+    from . import geo
+    from .blocklist import get_blocklist
+    from .http import get_http_pool
+
+    started = time.perf_counter()
+    summary = {}
+
+    def step(name, action):
+        step_started = time.perf_counter()
+        try:
+            summary[name] = action()
+        except Exception as e:
+            logger.warning(f"Warm-up step {name} failed: {str(e)}")
+            summary[name] = None
+        summary[f'{name}_ms'] = round((time.perf_counter() - step_started) * 1000, 1)
+
+    step('urls', lambda: len(get_resolver().url_patterns))
+    step('blocklist', lambda: _load_blocklist(get_blocklist()))
+    step('http_pool', lambda: bool(get_http_pool('geo')))
+    step('geo_entries', lambda: geo.preload(hot_ips(
+        getattr(settings, 'IP_TRACKING_WARM_UP_GEO_ENTRIES', 1000),
+        getattr(settings, 'IP_TRACKING_WARM_UP_WINDOW', 900),
+    )))
+    # Requests open their own connections; do not keep the warm-up's around
+    connections.close_all()
+
+    summary['total_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    logger.info(
+        f"Worker {os.getpid()} warmed up in {summary['total_ms']}ms: "
+        f"{summary['blocklist']} blocked IPs, {summary['geo_entries']} geolocation entries"
+    )
+    return summary
+
+
+def _load_blocklist(blocklist):
+    blocklist.maybe_refresh()
+    if not blocklist.loaded:
+        blocklist.reload()
+    # The shared backend keeps most entries in its mapped file
+    shared = getattr(blocklist, 'filter', None)
+    return len(blocklist.entries) + (shared.count if shared is not None else 0)
@@ -1,108 +1,95 @@
-from celery import shared_task
+from celery import chord, group, shared_task
+from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
-from datetime import timedelta
-from django.db.models import Count
-from .models import RequestLog, SuspiciousIP
+from datetime import datetime, timedelta
+from .models import RequestLog, BlockedIP
+from .profiling import profiled
+from .querybudget import tracked
+from .routers import use_replica
+from .signals import publishing_in_bulk
+from . import detection, edge_export, metrics
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
 
 @shared_task
+@profiled('detect_anomalies')
+@tracked('detect_anomalies')
 def detect_anomalies():
     """
     Celery task to detect and flag suspicious IP addresses.
-    Runs hourly to identify IPs that:
+    Runs hourly and evaluates the rules in `IP_TRACKING_ANOMALY_RULES`
+    (see `ip_tracking.rules`) over the last hour of traffic. By default,
+    IPs that:
     1. Exceed 100 requests per hour
     2. Access sensitive paths (e.g., /admin, /login)
+
+    Counts use the `weight` of each row so that sampled paths are scaled
+    back up to their real request volume.
+
+    Repeat or high-severity offenders are escalated to temporary blocks
+    (see `ip_tracking.escalation`).
+
+    With `IP_TRACKING_ANOMALY_SHARDS` greater than 1, the scan is split by
+    IP hash bucket into that many `detect_anomalies_shard` tasks and the
+    results are merged by `merge_anomaly_shards` (a Celery chord), so the
+    run gets faster as workers are added. See `ip_tracking.detection`.
     """
     logger.info("Starting anomaly detection task")
+    metrics.REGISTRY.ensure_flusher()
+    started = time.time()
     
     # Calculate time range for the last hour
     now = timezone.now()
     one_hour_ago = now - timedelta(hours=1)
     
-    # Define sensitive paths
-    sensitive_paths = ['/admin', '/login', '/api/admin', '/api/login', '/admin/', '/login/']
+    shards = getattr(settings, 'IP_TRACKING_ANOMALY_SHARDS', 1)
+    if shards <= 1:
+        with use_replica():
+            partial = detection.scan(one_hour_ago, now)
+        return _finish_detection([partial], now, one_hour_ago, started)
     
-    # Flag 1: IPs with more than 100 requests in the last hour
-    high_volume_ips = (
-        RequestLog.objects
-        .filter(timestamp__gte=one_hour_ago)
-        .values('ip_address')
-        .annotate(request_count=Count('id'))
-        .filter(request_count__gt=100)
+    header = group(
+        detect_anomalies_shard.s(start, end, one_hour_ago.isoformat(), now.isoformat())
+        for start, end in detection.shard_ranges(shards)
     )
-    
-    for ip_data in high_volume_ips:
-        ip_address = ip_data['ip_address']
-        request_count = ip_data['request_count']
-        
-        # Check if this IP is already flagged for this reason recently (last 24 hours)
-        recent_flag = SuspiciousIP.objects.filter(
-            ip_address=ip_address,
-            reason__contains='high volume',
-            flagged_at__gte=now - timedelta(hours=24),
-            resolved=False
-        ).exists()
-        
-        if not recent_flag:
-            SuspiciousIP.objects.create(
-                ip_address=ip_address,
-                reason=f"High volume of requests: {request_count} requests in the last hour"
-            )
-            logger.warning(f"Flagged IP {ip_address} for high volume: {request_count} requests/hour")
-    
-    # Flag 2: IPs accessing sensitive paths
-    sensitive_access_ips = (
-        RequestLog.objects
-        .filter(timestamp__gte=one_hour_ago, path__in=sensitive_paths)
-        .values('ip_address')
-        .annotate(access_count=Count('id'))
-        .filter(access_count__gte=5)  # More than 5 attempts to access sensitive paths
-    )
-    
-    for ip_data in sensitive_access_ips:
-        ip_address = ip_data['ip_address']
-        access_count = ip_data['access_count']
-        
-        # Get the specific paths accessed
-        accessed_paths = (
-            RequestLog.objects
-            .filter(
-                ip_address=ip_address,
-                timestamp__gte=one_hour_ago,
-                path__in=sensitive_paths
-            )
-            .values_list('path', flat=True)
-            .distinct()
-        )
-        paths_str = ', '.join(accessed_paths)
-        
-        # Check if this IP is already flagged for this reason recently
-        recent_flag = SuspiciousIP.objects.filter(
-            ip_address=ip_address,
-            reason__contains='sensitive paths',
-            flagged_at__gte=now - timedelta(hours=24),
-            resolved=False
-        ).exists()
-        
-        if not recent_flag:
-            SuspiciousIP.objects.create(
-                ip_address=ip_address,
-                reason=f"Multiple attempts to access sensitive paths: {access_count} attempts to [{paths_str}]"
-            )
-            logger.warning(f"Flagged IP {ip_address} for accessing sensitive paths: {access_count} attempts")
-    
-    logger.info("Anomaly detection task completed")
-    
+    result = chord(header)(merge_anomaly_shards.s(now.isoformat(), one_hour_ago.isoformat(), started))
+    logger.info(f"Dispatched anomaly detection to {shards} shards")
     return {
-        'high_volume_ips_flagged': len(high_volume_ips),
-        'sensitive_access_ips_flagged': len(sensitive_access_ips),
+        'shards': shards,
+        'merge_task_id': result.id,
         'timestamp': now.isoformat()
     }
 
 
+@shared_task
+@use_replica()
+def detect_anomalies_shard(start_bucket, end_bucket, since, until):
+    """Partial anomaly aggregates for one range of IP hash buckets"""
+    return detection.scan(
+        datetime.fromisoformat(since),
+        datetime.fromisoformat(until),
+        (start_bucket, end_bucket),
+    )
+
+
+@shared_task
+def merge_anomaly_shards(partials, now, since, started):
+    """Chord callback: merge the shard results, then flag and escalate"""
+    return _finish_detection(partials, datetime.fromisoformat(now), datetime.fromisoformat(since), started)
+
+
+def _finish_detection(partials, now, since, started):
+    result = detection.record(detection.merge(partials), now, since)
+    # Wall clock: in a chord, the run spans several worker processes
+    metrics.DETECT_ANOMALIES_SECONDS.observe(time.time() - started)
+    logger.info("Anomaly detection task completed")
+    return result
+
+
 @shared_task
 def cleanup_old_logs(days=30):
     """
@@ -118,3 +105,30 @@ def cleanup_old_logs(days=30):
         'deleted_count': deleted_count,
         'cutoff_date': cutoff_date.isoformat()
     }
+
+
+@shared_task
+def cleanup_expired_blocks():
+    """
+    Remove temporary blocks that have expired, in one DELETE.
+    The removals are published to the workers in one batch, bumping the
+    blocklist version so workers drop them too.
+    """
+    with transaction.atomic(), publishing_in_bulk():
+        _, deleted = BlockedIP.objects.filter(expires_at__lte=timezone.now()).delete()
+    deleted_count = deleted.get(BlockedIP._meta.label, 0)
+    
+    logger.info(f"Removed {deleted_count} expired IP blocks")
+    
+    return {
+        'deleted_count': deleted_count
+    }
+
+
+@shared_task
+def export_edge_blocklist():
+    """
+    Write the active blocks as nginx/ipset/nftables files plus incremental
+    diffs for the edge (see ip_tracking/edge_export.py).
+    """
+    return edge_export.export(getattr(settings, 'IP_TRACKING_EDGE_EXPORT_FORMATS', None))
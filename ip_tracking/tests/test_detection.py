@@ -0,0 +1,138 @@
+from datetime import timedelta
+
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from ip_tracking.detection import record, upsert_flags
+from ip_tracking.escalation import escalate
+from ip_tracking.models import BlockedIP, OffensePeriod, SuspiciousIP
+
+
+class UpsertFlagsTests(TestCase):
+    def setUp(self):
+        self.now = timezone.now().replace(microsecond=0)
+
+    def test_new_flags_are_inserted_and_reported(self):
+        created = upsert_flags([
+            ('10.0.0.1', 'high_volume', 'first'),
+            ('10.0.0.1', 'sensitive_paths', 'first'),
+            ('2001:db8::1', 'high_volume', 'first'),
+        ], self.now)
+        self.assertEqual(sorted(created), [
+            ('10.0.0.1', 'high_volume'), ('10.0.0.1', 'sensitive_paths'), ('2001:db8::1', 'high_volume'),
+        ])
+        flag = SuspiciousIP.objects.get(ip_address='2001:db8::1')
+        self.assertEqual((flag.hit_count, flag.flagged_at, flag.last_seen), (1, self.now, self.now))
+
+    def test_open_flags_are_bumped_not_duplicated(self):
+        upsert_flags([('10.0.0.1', 'high_volume', 'first')], self.now)
+        later = self.now + timedelta(hours=1)
+        created = upsert_flags([('10.0.0.1', 'high_volume', 'second')], later)
+
+        self.assertEqual(created, [])
+        flag = SuspiciousIP.objects.get()
+        self.assertEqual(flag.hit_count, 2)
+        self.assertEqual(flag.reason, 'second')
+        self.assertEqual((flag.flagged_at, flag.last_seen), (self.now, later))
+
+    def test_resolved_flags_get_a_new_row(self):
+        upsert_flags([('10.0.0.1', 'high_volume', 'first')], self.now)
+        SuspiciousIP.objects.update(resolved=True)
+        created = upsert_flags([('10.0.0.1', 'high_volume', 'again')], self.now + timedelta(hours=1))
+
+        self.assertEqual(created, [('10.0.0.1', 'high_volume')])
+        self.assertEqual(SuspiciousIP.objects.filter(resolved=False).get().hit_count, 1)
+        self.assertEqual(SuspiciousIP.objects.count(), 2)
+
+    def test_batches(self):
+        flags = [(f'10.0.0.{i}', 'high_volume', 'reason') for i in range(5)]
+        with self.assertNumQueries(3):
+            created = upsert_flags(flags, self.now, batch_size=2)
+        self.assertEqual(len(created), 5)
+        with self.assertNumQueries(3):
+            self.assertEqual(upsert_flags(flags, self.now, batch_size=2), [])
+        self.assertEqual(set(SuspiciousIP.objects.values_list('hit_count', flat=True)), {2})
+
+
+@override_settings(IP_TRACKING_ESCALATION={
+    'repeat_threshold': 3,
+    'repeat_window_hours': 24,
+    'severe_thresholds': {'high_volume': 1000},
+    'network_thresholds': {'subnet_volume': 5000},
+    'block_minutes': 60,
+    'severe_block_minutes': 24 * 60,
+})
+class EscalationTests(TestCase):
+    def setUp(self):
+        self.base = timezone.now().replace(minute=17, second=0, microsecond=0) - timedelta(hours=30)
+
+    def run_detection(self, hour, ip_address='10.1.1.1', requests=150):
+        """Detect ip_address in the hourly window ending `hour` hours after base"""
+        now = self.base + timedelta(hours=hour)
+        merged = {'high_volume': {ip_address: [requests, None]}}
+        return record(merged, now, now - timedelta(hours=1))['ips_blocked']
+
+    def test_repeat_offender_is_blocked_on_the_threshold(self):
+        self.assertEqual([self.run_detection(hour) for hour in range(3)], [0, 0, 1])
+        block = BlockedIP.objects.get()
+        self.assertIn('repeated anomalies', block.reason)
+        self.assertEqual(block.expires_at, self.base + timedelta(hours=3))
+
+        # Extended by the next offense
+        self.assertEqual(self.run_detection(3), 1)
+        self.assertEqual(BlockedIP.objects.get().expires_at, self.base + timedelta(hours=4))
+        self.assertEqual(SuspiciousIP.objects.get().hit_count, 4)
+
+    def test_same_period_counts_once(self):
+        for _ in range(5):
+            self.assertEqual(self.run_detection(0), 0)
+        self.assertEqual(OffensePeriod.objects.count(), 1)
+        self.assertFalse(BlockedIP.objects.exists())
+
+    def test_resolving_the_flags_clears_the_record(self):
+        self.run_detection(0)
+        self.run_detection(1)
+        SuspiciousIP.objects.update(resolved=True)
+        self.assertEqual([self.run_detection(hour) for hour in range(2, 5)], [0, 0, 1])
+
+    def test_periods_outside_the_window_are_forgotten(self):
+        self.run_detection(0)
+        self.run_detection(1)
+        self.assertEqual(self.run_detection(28), 0)
+        self.assertEqual(list(OffensePeriod.objects.values_list('period', flat=True)), [
+            (self.base + timedelta(hours=27)).replace(minute=0),
+        ])
+
+    def test_high_severity_is_blocked_at_once(self):
+        self.assertEqual(self.run_detection(0, requests=1000), 1)
+        block = BlockedIP.objects.get()
+        self.assertIn('high severity anomaly', block.reason)
+        self.assertEqual(block.expires_at, self.base + timedelta(hours=24))
+
+    def test_permanent_blocks_are_left_alone(self):
+        BlockedIP.objects.create(ip_address='10.1.1.1', reason='manual')
+        self.assertEqual(self.run_detection(0, requests=1000), 0)
+        self.assertIsNone(BlockedIP.objects.get().expires_at)
+
+    def test_networks_over_their_threshold_are_blocked(self):
+        now = self.base
+        networks = [
+            ('10.9.0.0/24', 'subnet_volume', 6000),
+            ('10.8.0.0/24', 'subnet_volume', 4000),
+            ('10.7.0.0/24', 'unconfigured', 9000),
+        ]
+        self.assertEqual(escalate([], now=now, networks=networks), ['10.9.0.0/24'])
+        block = BlockedIP.objects.get()
+        self.assertEqual((block.ip_address, block.prefix_length), ('10.9.0.0', 24))
+        self.assertEqual(block.expires_at, now + timedelta(hours=24))
+
+    def test_network_address_blocked_on_its_own_is_not_replaced(self):
+        BlockedIP.objects.create(ip_address='10.9.0.0', reason='manual')
+        networks = [('10.9.0.0/24', 'subnet_volume', 6000)]
+        self.assertEqual(escalate([], now=self.base, networks=networks), [])
+        self.assertIsNone(BlockedIP.objects.get().prefix_length)
+
+    def test_disabled(self):
+        with override_settings(IP_TRACKING_ESCALATION={'enabled': False}):
+            self.assertEqual(self.run_detection(0, requests=5000), 0)
+        self.assertFalse(OffensePeriod.objects.exists())
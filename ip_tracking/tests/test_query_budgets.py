@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.test import TestCase, override_settings
+
+from ip_tracking.benchmarks import benchmark_ip
+from ip_tracking.management.commands.check_query_budgets import Command
+from ip_tracking.querybudget import assert_query_budget, get_n_plus_one_threshold
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'], SECURE_SSL_REDIRECT=False, RATELIMIT_ENABLE=False)
+class QueryBudgetTests(TestCase):
+    """Every route in api_urls stays within its IP_TRACKING_QUERY_BUDGETS entry"""
+
+    def setUp(self):
+        self.command = Command()
+        self.objects = self.command.seed(rows=25)
+        self.client.force_login(self.objects['user'])
+
+    def test_api_routes(self):
+        budgets = getattr(settings, 'IP_TRACKING_QUERY_BUDGETS', {})
+        max_repeats = get_n_plus_one_threshold() - 1
+        routes = self.command.api_routes()
+        self.assertTrue(routes)
+        for name, pattern in routes:
+            with self.subTest(route=name):
+                self.assertIn(name, budgets, 'no entry in IP_TRACKING_QUERY_BUDGETS')
+                method, url, data = self.command.build_request(name, pattern, self.objects)
+                body = {'data': data, 'content_type': 'application/json'} if data is not None else {}
+                with assert_query_budget(budgets[name], max_repeats, label=name):
+                    response = getattr(self.client, method)(url, REMOTE_ADDR=benchmark_ip(1), **body)
+                self.assertLess(response.status_code, 400)
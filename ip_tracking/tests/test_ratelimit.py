@@ -0,0 +1,170 @@
+import uuid
+from unittest import skipIf
+
+from django.test import SimpleTestCase
+
+from ip_tracking.ratelimit import (
+    SLIDING_WINDOW, TOKEN_BUCKET, Limit, LocalBackend, RedisBackend,
+)
+
+try:
+    import fakeredis
+    # fakeredis needs lupa to evaluate Lua scripts
+    import lupa  # noqa: F401
+except ImportError:
+    fakeredis = None
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class BackendContract:
+    """
+    Checks shared by the Lua script and LocalBackend, which must agree.
+    Subclasses set up `self.backend`.
+    """
+
+    def entry(self, rate, algorithm=TOKEN_BUCKET, cost=1):
+        limit = Limit('ip', rate, algorithm=algorithm, cost=cost)
+        return (limit.cache_key('test', uuid.uuid4().hex), limit)
+
+    def test_token_bucket_allows_the_burst_then_rejects(self):
+        entry = self.entry('3/m')
+        remaining = [self.backend.check([entry]).remaining for _ in range(3)]
+        self.assertEqual(remaining, [2, 1, 0])
+
+        result = self.backend.check([entry])
+        self.assertFalse(result.allowed)
+        self.assertIs(result.limit, entry[1])
+        # One token comes back every 20 seconds
+        self.assertGreater(result.retry_after, 19)
+        self.assertLessEqual(result.retry_after, 20)
+
+    def test_sliding_window_allows_the_limit_then_rejects(self):
+        entry = self.entry('3/m', algorithm=SLIDING_WINDOW)
+        for _ in range(3):
+            self.assertTrue(self.backend.check([entry]).allowed)
+
+        result = self.backend.check([entry])
+        self.assertFalse(result.allowed)
+        self.assertEqual(result.remaining, 0)
+        # The oldest request leaves the window a minute after it was made
+        self.assertGreater(result.retry_after, 59)
+        self.assertLessEqual(result.retry_after, 60)
+
+    def test_cost_is_charged_in_full(self):
+        for algorithm in (TOKEN_BUCKET, SLIDING_WINDOW):
+            with self.subTest(algorithm=algorithm):
+                entry = self.entry('5/m', algorithm=algorithm, cost=2)
+                self.assertEqual(self.backend.check([entry]).remaining, 3)
+                self.assertEqual(self.backend.check([entry]).remaining, 1)
+                self.assertFalse(self.backend.check([entry]).allowed)
+
+    def test_rejected_check_charges_no_limit(self):
+        loose = self.entry('10/m')
+        strict = self.entry('1/m', algorithm=SLIDING_WINDOW)
+        self.assertTrue(self.backend.check([loose, strict]).allowed)
+
+        for _ in range(3):
+            result = self.backend.check([loose, strict])
+            self.assertFalse(result.allowed)
+            self.assertIs(result.limit, strict[1])
+        # Only the allowed check took a token
+        self.assertEqual(self.backend.check([loose]).remaining, 8)
+
+    def test_blocker_is_the_limit_with_the_longest_wait(self):
+        minute = self.entry('1/m')
+        hour = self.entry('1/h')
+        self.assertTrue(self.backend.check([minute, hour]).allowed)
+
+        result = self.backend.check([minute, hour])
+        self.assertFalse(result.allowed)
+        self.assertIs(result.limit, hour[1])
+        self.assertGreater(result.retry_after, 3500)
+
+
+class LocalBackendTests(BackendContract, SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.backend = LocalBackend(clock=self.clock, sweep_interval=10.0)
+
+    def test_token_bucket_refills_over_time(self):
+        entry = self.entry('3/m')
+        for _ in range(3):
+            self.backend.check([entry])
+        self.assertFalse(self.backend.check([entry]).allowed)
+
+        self.clock.now += 20
+        self.assertTrue(self.backend.check([entry]).allowed)
+        self.assertFalse(self.backend.check([entry]).allowed)
+
+    def test_sliding_window_forgets_old_requests(self):
+        entry = self.entry('2/m', algorithm=SLIDING_WINDOW)
+        self.backend.check([entry])
+        self.clock.now += 30
+        self.backend.check([entry])
+        self.assertFalse(self.backend.check([entry]).allowed)
+
+        self.clock.now += 30
+        self.assertTrue(self.backend.check([entry]).allowed)
+        self.assertFalse(self.backend.check([entry]).allowed)
+
+    def test_rejected_checks_do_not_grow_the_window_log(self):
+        entry = self.entry('2/m', algorithm=SLIDING_WINDOW)
+        for _ in range(50):
+            self.backend.check([entry])
+        self.assertEqual(len(self.backend.windows[entry[0]]), 2)
+
+    def test_idle_keys_are_swept_after_their_period(self):
+        minute = self.entry('5/m')
+        window = self.entry('5/m', algorithm=SLIDING_WINDOW)
+        hour = self.entry('5/h')
+        self.backend.check([minute, window, hour])
+        self.assertEqual(len(self.backend.expires), 3)
+
+        # Not swept before the sweep interval, even though idle
+        self.clock.now += 5
+        self.backend.check([self.entry('5/h')])
+        self.assertIn(minute[0], self.backend.buckets)
+
+        self.clock.now += 60
+        self.backend.check([self.entry('5/h')])
+        self.assertNotIn(minute[0], self.backend.buckets)
+        self.assertNotIn(window[0], self.backend.windows)
+        self.assertIn(hour[0], self.backend.buckets)
+        self.assertEqual(set(self.backend.expires), set(self.backend.buckets) | set(self.backend.windows))
+
+        # A swept key starts over with a full bucket
+        self.assertEqual(self.backend.check([minute]).remaining, 4)
+
+
+@skipIf(fakeredis is None, 'fakeredis[lua] is not installed')
+class RedisBackendTests(BackendContract, SimpleTestCase):
+    """Runs the Lua script (fakeredis evaluates it with lupa)"""
+
+    def setUp(self):
+        self.client = fakeredis.FakeStrictRedis()
+        self.backend = RedisBackend(self.client)
+
+    def tearDown(self):
+        self.client.flushall()
+
+    def test_keys_expire_after_their_period(self):
+        bucket = self.entry('5/m')
+        window = self.entry('5/h', algorithm=SLIDING_WINDOW)
+        self.backend.check([bucket, window])
+        self.assertTrue(0 < self.client.pttl(bucket[0]) <= 60 * 1000)
+        self.assertTrue(60 * 1000 < self.client.pttl(window[0]) <= 3600 * 1000)
+
+    def test_rejected_check_writes_nothing(self):
+        full = self.entry('1/m', algorithm=SLIDING_WINDOW)
+        other = self.entry('5/m', algorithm=SLIDING_WINDOW)
+        self.backend.check([full])
+        self.assertFalse(self.backend.check([full, other]).allowed)
+        self.assertEqual(self.client.zcard(full[0]), 1)
+        self.assertFalse(self.client.exists(other[0]))
@@ -6,4 +6,5 @@ app_name = 'ip_tracking'
 urlpatterns = [
     path('login/', views.login_view, name='login'),
     path('api/sensitive/', views.sensitive_api_view, name='sensitive_api'),
+    path('auth/', views.blocklist_auth_view, name='blocklist_auth'),
 ]
@@ -0,0 +1,144 @@
+"""
+Small helpers shared by the middleware, views and tasks.
+"""
+
+import ipaddress
+import zlib
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import caches
+
+# Number of hash buckets RequestLog rows are spread over (see ip_bucket)
+IP_BUCKETS = 1024
+
+
+@lru_cache(maxsize=8)
+def _proxy_networks(proxies):
+    return tuple(ipaddress.ip_network(proxy.strip(), strict=False) for proxy in proxies if proxy.strip())
+
+
+def trusted_proxies():
+    """
+    The networks of `IP_TRACKING_TRUSTED_PROXIES` (addresses or CIDR
+    networks of the reverse proxies in front of Django)
+    """
+    proxies = getattr(settings, 'IP_TRACKING_TRUSTED_PROXIES', ())
+    if isinstance(proxies, str):
+        proxies = proxies.split(',')
+    return _proxy_networks(tuple(proxies))
+
+
+def _is_trusted(address, networks):
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(address in network for network in networks)
+
+
+def get_client_ip(request):
+    """
+    Extract the client's IP address from the request.
+    Handles cases where the request comes through a proxy.
+
+    X-Forwarded-For is only believed when REMOTE_ADDR is one of the
+    `IP_TRACKING_TRUSTED_PROXIES`. Its entries are then walked from the
+    right, skipping trusted proxies, and the first untrusted hop is the
+    client: anything further left was sent by the client itself and can
+    be forged. Without trusted proxies the client is REMOTE_ADDR.
+    """
+    remote_addr = request.META.get('REMOTE_ADDR')
+    x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
+    if not x_forwarded_for:
+        return remote_addr
+    networks = trusted_proxies()
+    if not networks or not _is_trusted(remote_addr, networks):
+        return remote_addr
+    client = remote_addr
+    for hop in reversed(x_forwarded_for.split(',')):
+        hop = hop.strip()
+        if normalize_ip(hop) is None:
+            # Not written by a proxy we trust; the last good hop is all we know
+            break
+        client = hop
+        if not _is_trusted(hop, networks):
+            break
+    return client
+
+
+def normalize_ip(value):
+    """
+    The canonical text form of an IP address (as stored by
+    GenericIPAddressField), or None if value is not an IP address.
+    """
+    try:
+        return str(ipaddress.ip_address(value.strip()))
+    except (AttributeError, ValueError):
+        return None
+
+
+def is_public_ip(ip_address):
+    """
+    Whether an address is globally routable, i.e. worth geolocating.
+    Loopback, private, link-local and reserved ranges (including the
+    198.18.0.0/15 benchmarking range) are not.
+    """
+    try:
+        return ipaddress.ip_address(ip_address).is_global
+    except ValueError:
+        return False
+
+
+def ip_bucket(ip_address):
+    """
+    Stable hash bucket of an address in [0, IP_BUCKETS). All rows of one IP
+    share a bucket, so detection can be split into shards by bucket range.
+    """
+    return zlib.crc32(str(ip_address).encode()) % IP_BUCKETS
+
+
+def ip_key(ip_address):
+    """
+    Packed integer of an address, so that networks are a shift or a range
+    of integers away: IPv4 addresses as their 32-bit value, IPv6 addresses
+    as their first 64 bits (the /64), signed to fit a 64-bit column.
+    """
+    address = ipaddress.ip_address(ip_address)
+    if address.version == 4:
+        return int(address)
+    key = int(address) >> 64
+    return key - (1 << 64) if key >= 1 << 63 else key
+
+
+def ip_version_key(ip_address):
+    """
+    (IP version, ip_key) of an address, or (None, None) if it is not one.
+    The keys of the two versions overlap, so they are only comparable
+    together with the version.
+    """
+    try:
+        address = ipaddress.ip_address(ip_address)
+    except ValueError:
+        return None, None
+    return address.version, ip_key(address)
+
+
+def get_redis_client(alias='default'):
+    """
+    Return the raw redis-py client behind a Django cache alias.
+
+    Works with Django's built-in RedisCache and with django-redis. Returns
+    None for any other backend (locmem, memcached, ...), so callers can fall
+    back to a process-local implementation.
+    """
+    cache = caches[alias]
+    # django.core.cache.backends.redis.RedisCache
+    client = getattr(cache, '_cache', None)
+    if hasattr(client, 'get_client'):
+        return client.get_client(write=True)
+    # django_redis.cache.RedisCache
+    client = getattr(cache, 'client', None)
+    if hasattr(client, 'get_client'):
+        return client.get_client(write=True)
+    return None
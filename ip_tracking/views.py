@@ -1,18 +1,21 @@
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse
 from django.contrib.auth import authenticate, login
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
-from django_ratelimit.decorators import ratelimit
-from django_ratelimit.exceptions import Ratelimited
+from .blocklist import get_blocklist
+from .hits import record_hit
+from .utils import get_client_ip, normalize_ip
+from .metrics import REGISTRY
+import math
 
 
-@ratelimit(key='ip', rate='5/m', method='POST')
-@ratelimit(key='user_or_ip', rate='10/m', method='POST')
 @require_http_methods(["GET", "POST"])
 def login_view(request):
     """
-    Login view with rate limiting:
+    Login view with rate limiting (enforced by RateLimitMiddleware through
+    the 'login' policy in IP_TRACKING_RATE_LIMIT_POLICIES):
     - 5 requests per minute for anonymous users (by IP)
     - 10 requests per minute for authenticated users
     """
@@ -44,34 +47,70 @@ def login_view(request):
         }, status=401)
 
 
-@ratelimit(key='ip', rate='5/m', method='POST')
-@ratelimit(key='user_or_ip', rate='10/m', method='POST')
 @require_http_methods(["POST"])
 def sensitive_api_view(request):
     """
-    Example of a sensitive API endpoint with rate limiting.
+    Example of a sensitive API endpoint with rate limiting (enforced by
+    RateLimitMiddleware through the 'sensitive' policy).
     - 5 requests per minute for anonymous users
     - 10 requests per minute for authenticated users
     """
-    try:
-        # Your sensitive operation here
-        return JsonResponse({
-            'success': True,
-            'message': 'Operation completed successfully'
-        })
-    except Ratelimited:
-        return JsonResponse({
-            'success': False,
-            'error': 'Rate limit exceeded. Please try again later.'
-        }, status=429)
+    # Your sensitive operation here
+    return JsonResponse({
+        'success': True,
+        'message': 'Operation completed successfully'
+    })
 
 
 def rate_limit_handler(request, exception):
     """
     Custom handler for rate limit exceptions.
+    Sets the Retry-After header to the number of seconds until the
+    limiting bucket admits the request again.
     """
-    return JsonResponse({
+    retry_after = max(1, math.ceil(getattr(exception, 'retry_after', 60)))
+    response = JsonResponse({
         'success': False,
         'error': 'Rate limit exceeded. Please try again later.',
-        'retry_after': getattr(exception, 'retry_after', 60)
+        'retry_after': retry_after
     }, status=429)
+    response['Retry-After'] = str(retry_after)
+    return response
+
+
+@require_http_methods(["GET"])
+def metrics_view(request):
+    """
+    Prometheus metrics endpoint.
+    If IP_TRACKING_METRICS_TOKEN is set, scrapers must send it as a bearer token.
+    """
+    token = getattr(settings, 'IP_TRACKING_METRICS_TOKEN', None)
+    if token and request.META.get('HTTP_AUTHORIZATION') != f'Bearer {token}':
+        return HttpResponseForbidden("Invalid metrics token.")
+    return HttpResponse(
+        REGISTRY.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
+
+
+@csrf_exempt
+def blocklist_auth_view(request):
+    """
+    Blocklist check for nginx `auth_request` subrequests: 204 when the IP
+    may pass, 403 when it is blocked, 400 without a valid IP. The IP is
+    taken from the `ip` query parameter, else from the request itself.
+    Answered from the in-memory blocklist, without a database query or a
+    serializer; skip it in IP_TRACKING_LOG_RULES so it is not logged.
+    If IP_TRACKING_BLOCKLIST_TOKEN is set, callers must send it as a bearer token.
+    """
+    token = getattr(settings, 'IP_TRACKING_BLOCKLIST_TOKEN', None)
+    if token and request.META.get('HTTP_AUTHORIZATION') != f'Bearer {token}':
+        return HttpResponse(status=401)
+    ip_address = normalize_ip(request.GET.get('ip') or get_client_ip(request))
+    if ip_address is None:
+        return HttpResponseBadRequest()
+    blocked_by = get_blocklist().blocked_by(ip_address)
+    if blocked_by is not None:
+        record_hit(blocked_by)
+        return HttpResponse(status=403)
+    return HttpResponse(status=204)
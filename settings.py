@@ -31,6 +31,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'ip_tracking.profiling.ProfilingMiddleware',  # Opt-in sampling profiler
+    'ip_tracking.querybudget.QueryTrackingMiddleware',  # X-DB-Queries headers when DEBUG
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -39,6 +41,7 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'ip_tracking.middleware.IPTrackingMiddleware',  # Add the IP tracking middleware
+    'ip_tracking.ratelimit.RateLimitMiddleware',  # Route-level rate limit policies
 ]
 
 ROOT_URLCONF = 'config.urls'
@@ -130,7 +133,7 @@ CACHES = {
 
 
 # Rate Limiting Configuration
-# https://django-ratelimit.readthedocs.io/
+# Built-in engine, see ip_tracking/ratelimit.py
 
 RATELIMIT_ENABLE = True
 RATELIMIT_USE_CACHE = 'default'
@@ -138,6 +141,76 @@ RATELIMIT_USE_CACHE = 'default'
 # Custom view for rate limit exceptions
 RATELIMIT_VIEW = 'ip_tracking.views.rate_limit_handler'
 
+# Reverse proxies whose X-Forwarded-For is believed (addresses or CIDR
+# networks). Without any, clients are identified by REMOTE_ADDR.
+IP_TRACKING_TRUSTED_PROXIES = []
+
+# Rate Limit Policies (enforced by ip_tracking.ratelimit.RateLimitMiddleware)
+# Every policy whose prefix, method and user class match a request applies.
+IP_TRACKING_RATE_LIMIT_POLICIES = [
+    {
+        'name': 'login',
+        'prefix': '/ip_tracking/login/',
+        'methods': ['POST'],
+        'limits': [{'key': 'ip', 'rate': '5/m'}, {'key': 'user_or_ip', 'rate': '10/m'}],
+    },
+    {
+        'name': 'sensitive',
+        'prefix': '/ip_tracking/api/sensitive/',
+        'methods': ['POST'],
+        'limits': [{'key': 'ip', 'rate': '5/m'}, {'key': 'user_or_ip', 'rate': '10/m'}],
+    },
+    {
+        'name': 'api',
+        'prefix': '/api/',
+        'limits': [{'key': 'ip', 'rate': '300/m'}],
+    },
+    {
+        'name': 'api-anon',
+        'prefix': '/api/',
+        'users': 'anonymous',
+        'limits': [{'key': 'ip', 'rate': '60/m'}],
+    },
+    {
+        'name': 'api-write',
+        'prefix': '/api/',
+        'methods': ['POST', 'PUT', 'PATCH', 'DELETE'],
+        'limits': [{'key': 'user_or_ip', 'rate': '30/m'}],
+    },
+]
+
+
+# Request Logging Rules (see ip_tracking/sampling.py)
+# Prefix rules use longest match; 'sample' rows are stored with weight 1/rate.
+IP_TRACKING_LOG_RULES = [
+    {'prefix': '/static/', 'action': 'skip'},
+    {'prefix': '/favicon.ico', 'action': 'skip'},
+    {'prefix': '/metrics', 'action': 'skip'},
+    {'prefix': '/ip_tracking/auth/', 'action': 'skip'},
+]
+IP_TRACKING_LOG_DEFAULT_ACTION = 'always'
+
+# Query budgets per API route name (see ip_tracking/querybudget.py), enforced
+# by `manage.py check_query_budgets`. Counts include the 3 queries added by
+# sessions, auth and request logging.
+IP_TRACKING_QUERY_BUDGETS = {
+    'api-root': 4,
+    'requestlog-list': 6,
+    'requestlog-detail': 5,
+    'requestlog-by-ip': 6,
+    'blockedip-list': 6,
+    'blockedip-detail': 5,
+    'blockedip-check-blocked': 6,
+    'blockedip-check-batch': 4,
+    'suspiciousip-list': 6,
+    'suspiciousip-detail': 5,
+    'suspiciousip-unresolved': 6,
+    'suspiciousip-resolve': 6,
+    'stats': 9,
+    'live-feed': 4,
+    'live-stream': 4,
+}
+
 
 # Celery Configuration
 # https://docs.celeryproject.org/en/stable/django/
@@ -149,15 +222,46 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
 
-# Celery Beat Schedule (for periodic tasks)
-from celery.schedules import crontab
-
-CELERY_BEAT_SCHEDULE = {
-    'detect-anomalies-hourly': {
-        'task': 'ip_tracking.tasks.detect_anomalies',
-        'schedule': crontab(minute=0),  # Run every hour at minute 0
+# Anomaly rules evaluated by detect_anomalies (see ip_tracking/rules.py).
+# `min` is the smallest value that flags an IP within the hourly window.
+IP_TRACKING_ANOMALY_RULES = [
+    {'name': 'high_volume', 'type': 'rate', 'min': 101},
+    {
+        'name': 'sensitive_paths',
+        'type': 'rate',
+        'min': 5,
+        # Login POSTs at any status (a failed admin login is a 200),
+        # anonymous admin GETs (redirected to the login page), other failed
+        # admin/auth requests and any probe; staff browsing the admin or
+        # loading a login page is not counted
+        'categories': {
+            'admin': {'GET': 300, '*': 400},
+            'auth': {'POST': 0, '*': 400},
+            'probe': 0,
+        },
     },
-}
+    {'name': 'path_fanout', 'type': 'fanout', 'min': 100},
+    {'name': 'country_change', 'type': 'country_change', 'min': 3},
+    {'name': 'error_ratio', 'type': 'error_ratio', 'min': 0.8, 'min_status': 400, 'min_requests': 50},
+    # z-score against each IP's own rolling hourly baseline (see ip_tracking.baselines)
+    {'name': 'rate_baseline', 'type': 'baseline', 'min': 4.0, 'scope': 'ip', 'min_rate': 50},
+    # Scanners rotating through the addresses of one network (see SubnetRule)
+    {
+        'name': 'subnet_volume',
+        'type': 'subnet',
+        'min': 500,
+        'ipv4_prefixes': [24],
+        'ipv6_prefixes': [64, 48],
+        'min_ips': 8,
+    },
+]
+
+# Split detect_anomalies into this many parallel tasks by IP hash bucket
+# (a Celery chord; needs a result backend). 1 runs it inline.
+IP_TRACKING_ANOMALY_SHARDS = 1
+
+# The Celery beat schedule is defined in celery.py, so that web workers do
+# not import celery.schedules when loading settings
 
 
 # Logging Configuration
@@ -1,15 +1,15 @@
 """
 Main URL Configuration for alx-backend-security project.
 Includes Swagger documentation endpoints.
+
+The schema views are imported on their first request: drf-spectacular's
+schema generator is one of the slowest imports of a worker's startup.
 """
 
 from django.contrib import admin
 from django.urls import path, include
-from drf_spectacular.views import (
-    SpectacularAPIView,
-    SpectacularSwaggerView,
-    SpectacularRedocView,
-)
+from ip_tracking.startup import lazy_view
+from ip_tracking.views import metrics_view
 
 urlpatterns = [
     # Admin
@@ -19,10 +19,13 @@ urlpatterns = [
     path('ip_tracking/', include('ip_tracking.urls')),
     
     # API Schema and Documentation
-    path('api/schema/', SpectacularAPIView.as_view(), name='schema'),
-    path('swagger/', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger-ui'),
-    path('redoc/', SpectacularRedocView.as_view(url_name='schema'), name='redoc'),
+    path('api/schema/', lazy_view('drf_spectacular.views.SpectacularAPIView'), name='schema'),
+    path('swagger/', lazy_view('drf_spectacular.views.SpectacularSwaggerView', url_name='schema'), name='swagger-ui'),
+    path('redoc/', lazy_view('drf_spectacular.views.SpectacularRedocView', url_name='schema'), name='redoc'),
     
     # API endpoints
     path('api/', include('ip_tracking.api_urls')),
+    
+    # Prometheus metrics
+    path('metrics', metrics_view, name='metrics'),
 ]